@@ -250,14 +250,14 @@ if __name__ == "__main__":
     print(f"   ✅ Created: {created} languages")
     print(f"   ⏭️  Skipped: {skipped} languages")
     print(f"   📝 Total processed: {created + skipped} languages")
-    # Invalidate cached languages so UI sees updates immediately
+    # Bump the language registry version so every process reloads it; saves
+    # already do this, but the cache may have been unreachable at the time
     try:
-        from django.core.cache import cache
-        from django.conf import settings
-        cache.delete(getattr(settings, 'LANGUAGE_CACHE_KEY', 'all_languages'))
-        print("🧹 Cleared language cache key")
+        from website.languages import invalidate
+        invalidate()
+        print("🧹 Language registry version bumped")
     except Exception as e:
-        print(f"⚠️  Could not clear language cache: {e}")
+        print(f"⚠️  Could not bump the language registry version: {e}")
 EOF
     
 else
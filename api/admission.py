@@ -0,0 +1,179 @@
+"""
+Redis-backed admission control for chatbot streams.
+
+Open streams hold leases in Redis sorted sets (one global, one per client IP)
+scored by expiry, so slots held by a crashed worker free themselves. Requests
+arriving while the global cap is reached wait briefly in a FIFO queue; when
+that queue is full, or the client already has too many streams open, they are
+rejected straight away. Redis being unreachable or slow admits everything.
+"""
+import asyncio
+import contextlib
+import logging
+import uuid
+
+import redis.asyncio as redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_KEY = 'chatbot:streams'
+WAITING_KEY = 'chatbot:streams:waiting'
+
+ADMITTED = 1
+QUEUED = 0
+REJECTED = -1
+
+# KEYS: global leases, client leases, waiters
+# ARGV: lease id, lease ttl, global cap, client cap, queue size, max wait
+_ACQUIRE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+for i = 1, 3 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+end
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    return -1
+end
+local free = tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[1])
+local ahead = redis.call('ZRANK', KEYS[3], ARGV[1]) or redis.call('ZCARD', KEYS[3])
+if ahead < free then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    local expires = now + tonumber(ARGV[2])
+    redis.call('ZADD', KEYS[1], expires, ARGV[1])
+    redis.call('ZADD', KEYS[2], expires, ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+if redis.call('ZSCORE', KEYS[3], ARGV[1]) then
+    return 0
+end
+if redis.call('ZCARD', KEYS[3]) >= tonumber(ARGV[5]) then
+    return -1
+end
+redis.call('ZADD', KEYS[3], now + tonumber(ARGV[6]), ARGV[1])
+redis.call('EXPIRE', KEYS[3], math.ceil(tonumber(ARGV[6])) + 1)
+return 0
+"""
+
+# KEYS: global leases, client leases; ARGV: lease id, lease ttl
+_RENEW = """
+local t = redis.call('TIME')
+local expires = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[2])
+for i = 1, 2 do
+    redis.call('ZADD', KEYS[i], 'XX', expires, ARGV[1])
+    redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+_client = None
+_scripts = {}
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.CHATBOT_ADMISSION_REDIS_URL,
+            socket_timeout=settings.CHATBOT_ADMISSION_REDIS_TIMEOUT,
+            socket_connect_timeout=settings.CHATBOT_ADMISSION_REDIS_TIMEOUT,
+        )
+    return _client
+
+
+def _script(source):
+    # Registered scripts run through EVALSHA after the first call
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+def client_ip(request):
+    """Client address as seen by nginx, which sets X-Real-IP"""
+    return request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR', '')
+
+
+class StreamSlot:
+    """A held stream lease; release() it once the stream ends, however it ends"""
+
+    def __init__(self, lease_id=None, client_key=None):
+        self.lease_id = lease_id
+        self.client_key = client_key
+        self._heartbeat = None
+
+    def keep_alive(self):
+        """
+        Renew the lease while the stream runs. Called once streaming starts,
+        so a response that is never sent lets its lease run out.
+        """
+        if self.lease_id is not None and self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._renew())
+
+    async def _renew(self):
+        lease = settings.CHATBOT_STREAM_LEASE
+        while True:
+            await asyncio.sleep(lease / 3)
+            try:
+                await _script(_RENEW)(keys=[GLOBAL_KEY, self.client_key], args=[self.lease_id, lease])
+            except (redis.RedisError, OSError) as e:
+                logger.warning(f"Could not renew chatbot stream lease: {e}")
+
+    async def release(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self.lease_id is None:
+            return
+        lease_id, self.lease_id = self.lease_id, None
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.zrem(GLOBAL_KEY, lease_id)
+                pipe.zrem(self.client_key, lease_id)
+                await pipe.execute()
+        except (redis.RedisError, OSError) as e:
+            # The lease runs out on its own
+            logger.warning(f"Could not release chatbot stream lease: {e}")
+
+
+async def admit(request):
+    """
+    Return a StreamSlot for request, waiting up to CHATBOT_ADMISSION_MAX_WAIT
+    seconds for a free slot, or None if the request must be rejected.
+    """
+    if not settings.CHATBOT_ADMISSION_ENABLED or not settings.CHATBOT_ADMISSION_REDIS_URL:
+        return StreamSlot()
+
+    lease_id = uuid.uuid4().hex
+    client_key = f'{GLOBAL_KEY}:{client_ip(request)}'
+    args = (
+        lease_id,
+        settings.CHATBOT_STREAM_LEASE,
+        settings.CHATBOT_MAX_STREAMS,
+        settings.CHATBOT_MAX_STREAMS_PER_CLIENT,
+        settings.CHATBOT_ADMISSION_QUEUE_SIZE,
+        settings.CHATBOT_ADMISSION_MAX_WAIT,
+    )
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.CHATBOT_ADMISSION_MAX_WAIT
+    try:
+        while True:
+            result = await _script(_ACQUIRE)(keys=[GLOBAL_KEY, client_key, WAITING_KEY], args=args)
+            if result == ADMITTED:
+                return StreamSlot(lease_id, client_key)
+            if result == REJECTED:
+                return None
+            if loop.time() >= deadline:
+                await get_redis().zrem(WAITING_KEY, lease_id)
+                return None
+            await asyncio.sleep(settings.CHATBOT_ADMISSION_POLL_INTERVAL)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Chatbot admission control unavailable, admitting: {e}")
+        return StreamSlot()
+    except asyncio.CancelledError:
+        # Client left while queued; give up the queue position
+        with contextlib.suppress(redis.RedisError, OSError):
+            await get_redis().zrem(WAITING_KEY, lease_id)
+        raise
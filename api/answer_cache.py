@@ -0,0 +1,133 @@
+"""
+Cache of completed chatbot answers.
+
+Answers are keyed by (paste content digest, normalized question, model) and
+stored as the list of streamed chunks so a hit replays like a live answer.
+Identical questions asked while an answer is still streaming share a single
+upstream completion within the worker.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from pastebinir.metrics import cache_lookup
+from website.cache_utils import record_chatbot_answer
+from .duck_ai import MODEL, stream_completion
+
+logger = logging.getLogger(__name__)
+
+# Upstream completions in flight in this worker, by answer key
+_flights = {}
+
+
+def normalize_question(question):
+    """Fold case, whitespace and trailing punctuation so rephrasings share a key"""
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?.!').strip().lower()
+
+
+def answer_key(content, question, model=MODEL):
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    key = hashlib.sha256(f"{digest}\0{normalize_question(question)}\0{model}".encode()).hexdigest()
+    return f'chatbot_answer_{key}'
+
+
+class _Flight:
+    """One upstream completion, fanned out to every request waiting on it"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    async def publish(self, chunk):
+        async with self.changed:
+            self.chunks.append(chunk)
+            self.changed.notify_all()
+
+    async def finish(self, error=None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        try:
+            sent = 0
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: len(self.chunks) > sent or self.done)
+                    pending = self.chunks[sent:]
+                    finished = self.done and len(self.chunks) == sent + len(pending)
+                for chunk in pending:
+                    yield chunk
+                sent += len(pending)
+                if finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            # Nobody is listening any more, stop paying for the upstream stream
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()
+
+
+async def _store(key, paste_id, chunks):
+    if sum(len(chunk) for chunk in chunks) > settings.CHATBOT_ANSWER_CACHE_MAX_SIZE:
+        logger.debug(f"Answer {key} too large to cache")
+        return
+    timeout = settings.CHATBOT_ANSWER_CACHE_TIMEOUT
+    await cache.aset(key, chunks, timeout)
+
+    # Record the answer against the paste so it can be dropped on deletion
+    await sync_to_async(record_chatbot_answer)(paste_id, key, timeout)
+
+
+async def _fill(key, paste_id, prompt, flight):
+    error = None
+    try:
+        async for chunk in stream_completion(prompt):
+            await flight.publish(chunk)
+    except asyncio.CancelledError:
+        error = ConnectionAbortedError("Answer stream cancelled")
+    except Exception as e:
+        error = e
+    try:
+        await flight.finish(error)
+        if error is None and flight.chunks:
+            await _store(key, paste_id, flight.chunks)
+    except Exception as e:
+        logger.error(f"Failed to cache chatbot answer: {e}", exc_info=True)
+    finally:
+        _flights.pop(key, None)
+
+
+async def cached_ai_response(paste, question, prompt):
+    """
+    Async generator yielding the answer to question about paste, replaying a
+    cached answer or joining an identical in-flight one when possible.
+    """
+    key = answer_key(paste.ciphertext, question)
+    chunks = await cache.aget(key)
+    cache_lookup('chatbot_answer', chunks is not None)
+    if chunks is not None:
+        logger.info(f"Replaying cached answer for paste {paste.id}")
+        for chunk in chunks:
+            yield chunk
+        return
+
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = _Flight()
+        flight.task = asyncio.create_task(_fill(key, paste.id, prompt, flight))
+    async for chunk in flight.subscribe():
+        yield chunk
@@ -0,0 +1,131 @@
+"""
+Token-budgeted context selection for chatbot prompts.
+
+Large pastes are split into line-aligned chunks which are ranked against the
+question with a cheap lexical score. Only the best chunks that fit the token
+budget are sent, in their original order, so prompt size (and with it time to
+first token) stays bounded whatever the paste size.
+"""
+import math
+import re
+
+from django.conf import settings
+
+# Identifiers and words; camelCase / snake_case parts are matched separately too
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+')
+_PART_RE = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+')
+
+# Words that say nothing about which part of the code a question is about
+_STOPWORDS = frozenset('''
+a an and are as at be but by can code could do does explain find for from
+how i in is it its me my of on or please should that the this to was what
+when where which while who why will with would you your there their bug
+bugs wrong
+'''.split())
+
+
+def estimate_tokens(text):
+    """Rough token count, about four characters per token for code"""
+    return len(text) // 4 + 1
+
+
+def _terms(text):
+    terms = []
+    for word in _WORD_RE.findall(text):
+        lowered = word.lower()
+        terms.append(lowered)
+        parts = _PART_RE.findall(word.replace('_', ' '))
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return terms
+
+
+def split_chunks(content, chunk_lines=None, max_tokens=None):
+    """
+    Split content into (first_line, last_line, text) windows of whole lines.
+    A window closes after chunk_lines lines or before the line that would
+    take it over max_tokens.
+    """
+    chunk_lines = chunk_lines or settings.CHATBOT_CONTEXT_CHUNK_LINES
+    max_tokens = max_tokens or settings.CHATBOT_CONTEXT_TOKEN_BUDGET
+    chunks = []
+    lines = content.splitlines()
+    start = 0
+    while start < len(lines):
+        end = start
+        size = 0
+        while end < len(lines) and end - start < chunk_lines:
+            cost = estimate_tokens(lines[end])
+            if end > start and size + cost > max_tokens:
+                break
+            size += cost
+            end += 1
+        text = '\n'.join(lines[start:end])
+        if estimate_tokens(text) > max_tokens:
+            # A single enormous line (minified code); cut it to fit and say so
+            marker = f"... (rest of line {start + 1} omitted) ..."
+            text = text[:max(0, (max_tokens - 1) * 4 - len(marker) - 1)] + '\n' + marker
+        chunks.append((start + 1, end, text))
+        start = end
+    return chunks
+
+
+def _rank(chunks, question):
+    """Indexes of chunks, best match for the question first (BM25-style)"""
+    query = [term for term in set(_terms(question)) if term not in _STOPWORDS and len(term) > 1]
+    if not query:
+        return list(range(len(chunks)))
+    # Substring counts on the lowered text keep scoring in C even for multi-MB pastes
+    lowered = [text.lower() for _, _, text in chunks]
+    counts = [{term: chunk.count(term) for term in query} for chunk in lowered]
+    lengths = [estimate_tokens(chunk) for chunk in lowered]
+    average = sum(lengths) / len(lengths)
+    idf = {}
+    for term in query:
+        df = sum(1 for count in counts if count[term])
+        idf[term] = math.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+    scores = []
+    for index, count in enumerate(counts):
+        norm = 1.2 * (0.25 + 0.75 * lengths[index] / average)
+        score = 0.0
+        for term in query:
+            tf = count[term]
+            if tf:
+                score += idf[term] * tf * 2.2 / (tf + norm)
+        scores.append(score)
+    # Ties (including no match at all) keep document order, so the head of
+    # the paste is preferred when nothing in it matches the question
+    return sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+
+
+def build_context(content, question, budget=None):
+    """
+    Return the part of content worth sending for question, at most roughly
+    budget tokens long. Omitted regions are marked with their line ranges.
+    """
+    budget = budget or settings.CHATBOT_CONTEXT_TOKEN_BUDGET
+    if estimate_tokens(content) <= budget:
+        return content
+
+    chunks = split_chunks(content, max_tokens=budget)
+    selected = []
+    used = 0
+    for index in _rank(chunks, question):
+        cost = estimate_tokens(chunks[index][2])
+        if used + cost > budget:
+            continue
+        selected.append(index)
+        used += cost
+
+    parts = []
+    previous_end = 0
+    for index in sorted(selected):
+        first, last, text = chunks[index]
+        if first > previous_end + 1:
+            parts.append(f"... (lines {previous_end + 1}-{first - 1} omitted) ...")
+        parts.append(text)
+        previous_end = last
+    total_lines = chunks[-1][1]
+    if previous_end < total_lines:
+        parts.append(f"... (lines {previous_end + 1}-{total_lines} omitted) ...")
+    return '\n'.join(parts)
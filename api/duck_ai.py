@@ -1,70 +1,132 @@
-import json
+"""
+Chat completions through g4f.
+
+g4f and its provider modules take a large share of a worker's import time and
+memory, and most processes (scheduler workers, workers that never get a chat
+request) do not need them; they are imported on the first chat request.
+"""
 import logging
-import asyncio
-from g4f.client import AsyncClient
-from g4f.Provider import RetryProvider, Phind, FreeChatgpt, Liaobots, OpenaiChat
+from django.conf import settings
+
+from .provider_router import ProviderRouter
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_ai_response(prompt):
+MODEL = "gpt-4o-mini"
+
+# Clients and the router are shared by every chat stream served from this process
+_clients = {}
+_router = None
+
+
+def get_client(provider):
+    """
+    Return the process-wide AsyncClient for provider, creating it on first use.
+    """
+    if provider not in _clients:
+        from g4f.client import AsyncClient
+        _clients[provider] = AsyncClient(provider=provider)
+    return _clients[provider]
+
+
+def _resolve_providers(names):
+    from g4f import Provider
+    providers = []
+    for name in names:
+        provider = getattr(Provider, name, None)
+        if provider is None:
+            logger.warning(f"Chatbot provider {name} is not available in this g4f release, skipping")
+            continue
+        providers.append(provider)
+    return providers
+
+
+async def _open_stream(provider, prompt, model):
     """
-    This function takes a prompt and yields the response from the g4f AI as a stream.
-    Uses the new AsyncClient API for better streaming support.
+    The completion's text chunks. Chunks without text (e.g. the leading role
+    chunk) are dropped here, so the router times the first real token.
     """
-    async def _stream_response():
-        try:
-            # Use a retry provider to avoid providers that return 429 / unavailable
-            client = AsyncClient(
-                provider=RetryProvider([Phind, FreeChatgpt, Liaobots, OpenaiChat], shuffle=False)
-            )
-            
-            stream = client.chat.completions.stream(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                web_search=False
-            )
-
-            async for chunk in stream:
-                # Some providers emit different structures; handle robustly
-                try:
-                    if hasattr(chunk, "choices") and chunk.choices:
-                        choice = chunk.choices[0]
-                        # Streaming delta content
-                        if hasattr(choice, "delta") and choice.delta:
-                            content = choice.delta.get("content") if isinstance(choice.delta, dict) else getattr(choice.delta, "content", None)
-                            if content:
-                                yield content
-                                continue
-                        # Non-streaming fallback (full message)
-                        if hasattr(choice, "message") and choice.message:
-                            content = choice.message.get("content") if isinstance(choice.message, dict) else getattr(choice.message, "content", None)
-                            if content:
-                                yield content
-                                continue
-                except Exception:
-                    # Skip malformed chunks silently
-                    continue
-                    
-        except Exception as e:
-            yield f"An error occurred: {e}"
-    
-    # Create an async generator and run it in a new event loop
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
+    stream = get_client(provider).chat.completions.stream(
+        model=model,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        web_search=False
+    )
     try:
-        async_gen = _stream_response()
-        while True:
+        async for chunk in stream:
             try:
-                chunk = loop.run_until_complete(async_gen.__anext__())
-                yield chunk
-            except StopAsyncIteration:
-                break
+                content = _chunk_content(chunk)
+            except Exception:
+                # Skip malformed chunks silently
+                continue
+            if content:
+                yield content
     finally:
-        loop.close()
+        aclose = getattr(stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+def get_router():
+    """
+    Return the process-wide ProviderRouter over CHATBOT_PROVIDERS.
+    """
+    global _router
+    if _router is None:
+        _router = ProviderRouter(
+            _resolve_providers(settings.CHATBOT_PROVIDERS),
+            _open_stream,
+            window=settings.CHATBOT_PROVIDER_WINDOW,
+            error_rate=settings.CHATBOT_CIRCUIT_ERROR_RATE,
+            min_requests=settings.CHATBOT_CIRCUIT_MIN_REQUESTS,
+            cooldown=settings.CHATBOT_CIRCUIT_COOLDOWN,
+            first_token_timeout=settings.CHATBOT_FIRST_TOKEN_TIMEOUT,
+            hedge_after=settings.CHATBOT_HEDGE_AFTER,
+        )
+    return _router
+
+
+def _chunk_content(chunk):
+    """
+    Extract the text carried by a streamed chunk, or None if it has none.
+    Some providers emit different structures; handle robustly.
+    """
+    if hasattr(chunk, "choices") and chunk.choices:
+        choice = chunk.choices[0]
+        # Streaming delta content
+        if hasattr(choice, "delta") and choice.delta:
+            content = choice.delta.get("content") if isinstance(choice.delta, dict) else getattr(choice.delta, "content", None)
+            if content:
+                return content
+        # Non-streaming fallback (full message)
+        if hasattr(choice, "message") and choice.message:
+            content = choice.message.get("content") if isinstance(choice.message, dict) else getattr(choice.message, "content", None)
+            if content:
+                return content
+    return None
+
+
+async def stream_completion(prompt, model=MODEL):
+    """
+    Async generator yielding the completion for prompt as a stream.
+    Runs on the caller's event loop and lets upstream errors propagate.
+    """
+    async for content in get_router().stream(prompt, model):
+        yield content
+
+
+async def get_ai_response(prompt):
+    """
+    Async generator yielding the response from the g4f AI as a stream,
+    reporting upstream errors as a final text chunk.
+    """
+    try:
+        async for content in stream_completion(prompt):
+            yield content
+    except Exception as e:
+        yield f"An error occurred: {e}"
@@ -0,0 +1,129 @@
+import secrets
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.serializers import PasteSerializer, fast_lookups, fast_representation
+from api.views import LanguageListAPIView, PasteListCreateAPIView
+from website.history import HISTORY_COOKIE
+from website.models import HistoryEntry, Language, Paste
+
+
+class LegacyLanguageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Language
+        fields = '__all__'
+
+
+class LegacyPasteSerializer(serializers.ModelSerializer):
+    # The serializers as they were before sparse fieldsets and the fast path
+    lang = LegacyLanguageSerializer()
+
+    class Meta:
+        model = Paste
+        fields = ['id', 'created', 'lang']
+
+
+class Command(BaseCommand):
+    help = 'Compare per-request time of the REST API list serializers on a throwaway dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pastes', type=int, default=200, help='Pastes per list response')
+        parser.add_argument('--languages', type=int, default=50, help='Distinct languages among them')
+        parser.add_argument('--iterations', type=int, default=50, help='Requests timed per case')
+
+    def handle(self, *args, **options):
+        count = options['pastes']
+        iterations = options['iterations']
+        # Everything is created inside a transaction that is rolled back
+        with transaction.atomic():
+            token = self.populate(count, options['languages'])
+            ids = list(HistoryEntry.objects.filter(client_token=token).values_list('paste_id', flat=True))
+            renderer = JSONRenderer()
+
+            def legacy():
+                pastes = Paste.objects.filter(id__in=ids).order_by('-created', '-id')
+                return renderer.render(LegacyPasteSerializer(pastes, many=True).data)
+
+            def model_serializer():
+                pastes = Paste.objects.listing().select_related('lang').filter(id__in=ids).order_by('-created', '-id')
+                return renderer.render(PasteSerializer(pastes, many=True).data)
+
+            def fast_path():
+                columns = PasteSerializer.fast_columns
+                fields = list(columns)
+                rows = Paste.objects.filter(id__in=ids).order_by('-created', '-id').values(*fast_lookups(columns, fields))
+                return renderer.render([fast_representation(row, columns, fields) for row in rows])
+
+            factory = APIRequestFactory()
+            paste_list = PasteListCreateAPIView.as_view()
+            language_list = LanguageListAPIView.as_view()
+
+            def endpoint():
+                request = factory.get('/api/pastes/', {'page_size': count})
+                request.COOKIES[HISTORY_COOKIE] = token
+                return paste_list(request).render()
+
+            def sparse_endpoint():
+                request = factory.get('/api/pastes/', {'page_size': count, 'fields': 'id,created'})
+                request.COOKIES[HISTORY_COOKIE] = token
+                return paste_list(request).render()
+
+            def languages():
+                return language_list(factory.get('/api/languages/')).render()
+
+            self.stdout.write(f"{count} pastes per response, {iterations} iterations each\n")
+            self.stdout.write(f"{'case':<40}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}")
+            for name, case in [
+                ('ModelSerializer, no select_related', legacy),
+                ('ModelSerializer + select_related', model_serializer),
+                ('values() fast path', fast_path),
+                ('GET /api/pastes/', endpoint),
+                ('GET /api/pastes/?fields=id,created', sparse_endpoint),
+                ('GET /api/languages/', languages),
+            ]:
+                self.report(name, case, iterations)
+            transaction.set_rollback(True)
+
+    def populate(self, count, language_count):
+        suffix = secrets.token_hex(4)
+        languages = Language.objects.bulk_create(
+            Language(displayname=f'Benchmark {i}', alias=f'benchmark-{suffix}-{i}') for i in range(language_count)
+        )
+        ids = set()
+        while len(ids) < count:
+            ids.add(secrets.token_hex(3))
+        ids -= set(Paste.objects.filter(id__in=ids).values_list('id', flat=True))
+        pastes = []
+        for i, paste_id in enumerate(ids):
+            paste = Paste(id=paste_id, ciphertext=f'print({i})\n' * 20, lang=languages[i % len(languages)])
+            paste.compute_metadata()
+            pastes.append(paste)
+        Paste.objects.bulk_create(pastes)
+        token = secrets.token_urlsafe(24)
+        HistoryEntry.objects.bulk_create(
+            HistoryEntry(client_token=token, paste_id=paste.id, created=paste.created, preview=paste.preview)
+            for paste in pastes
+        )
+        return token
+
+    def report(self, name, case, iterations):
+        with CaptureQueriesContext(connection) as queries:
+            case()
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            case()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(0.95 * len(timings)))]
+        self.stdout.write(
+            f"{name:<40}{statistics.mean(timings):>10.2f}{statistics.median(timings):>10.2f}"
+            f"{p95:>10.2f}{len(queries):>9}"
+        )
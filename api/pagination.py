@@ -0,0 +1,18 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class PasteCursorPagination(CursorPagination):
+    """Newest first; the cursor is opaque so pages stay stable as pastes are added"""
+    ordering = ('-created', '-id')
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class LanguageCursorPagination(CursorPagination):
+    ordering = ('displayname', 'id')
+    # Large enough that clients listing every language get a single page
+    page_size = settings.API_MAX_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
@@ -0,0 +1,282 @@
+"""
+Latency-aware routing across chatbot providers.
+
+Every provider's time to first token and failures are tracked over a rolling
+window. Providers are tried fastest-first, a circuit opens for providers that
+keep failing, and a second provider can optionally be hedged in when the first
+one is slow to produce its first token.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class NoProviderAvailable(Exception):
+    """Every provider failed, or every circuit is open"""
+
+
+class ProviderHealth:
+    """Rolling time-to-first-token / error statistics and circuit state for one provider"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window, error_rate, min_requests, cooldown):
+        self.name = name
+        self.window = window
+        self.error_rate_threshold = error_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        # (timestamp, time to first token or None on failure)
+        self.samples = deque()
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0
+
+    def _prune(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def state(self, now=None):
+        if self.opened_at is None:
+            return self.CLOSED
+        now = time.monotonic() if now is None else now
+        if now - self.opened_at >= self.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def available(self, now):
+        state = self.state(now)
+        if state == self.CLOSED:
+            return True
+        # A half-open circuit lets a single trial request through
+        return state == self.HALF_OPEN and not self.trial_in_flight
+
+    def started(self, now):
+        self.requests += 1
+        if self.state(now) == self.HALF_OPEN:
+            self.trial_in_flight = True
+
+    def record_success(self, now, ttft):
+        self._prune(now)
+        self.samples.append((now, ttft))
+        if self.opened_at is not None:
+            logger.info(f"Chatbot provider {self.name} recovered, closing circuit")
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self, now):
+        self._prune(now)
+        self.samples.append((now, None))
+        self.failures += 1
+        if self.trial_in_flight or (
+            len(self.samples) >= self.min_requests and self.error_rate(now) >= self.error_rate_threshold
+        ):
+            if self.opened_at is None or self.trial_in_flight:
+                logger.warning(f"Opening circuit for chatbot provider {self.name}")
+            self.opened_at = now
+        self.trial_in_flight = False
+
+    def record_abandoned(self, now, elapsed):
+        # Lost a hedge race or the client went away: not a failure, but the
+        # first token is at least this late, so keep it as a latency sample
+        self._prune(now)
+        self.samples.append((now, elapsed))
+        self.trial_in_flight = False
+
+    def error_rate(self, now):
+        self._prune(now)
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ttft in self.samples if ttft is None) / len(self.samples)
+
+    def ttft_quantile(self, now, q):
+        self._prune(now)
+        latencies = sorted(ttft for _, ttft in self.samples if ttft is not None)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def expected_latency(self, now):
+        """Ranking key: median time to first token inflated by the error rate"""
+        self._prune(now)
+        if not self.samples:
+            # Never tried in this window, worth exploring
+            return 0.0
+        median = self.ttft_quantile(now, 0.5)
+        if median is None:
+            return math.inf
+        return median / max(1.0 - self.error_rate(now), 0.1)
+
+    def snapshot(self, now):
+        return {
+            'provider': self.name,
+            'state': self.state(now),
+            'requests': self.requests,
+            'failures': self.failures,
+            'hedges': self.hedges,
+            'window_samples': len(self.samples),
+            'window_error_rate': round(self.error_rate(now), 3),
+            'ttft_p50': self.ttft_quantile(now, 0.5),
+            'ttft_p95': self.ttft_quantile(now, 0.95),
+        }
+
+
+class _Attempt:
+    def __init__(self, provider, health, stream, now):
+        self.provider = provider
+        self.health = health
+        self.stream = stream
+        self.started = now
+        self.first = asyncio.ensure_future(stream.__anext__())
+
+    async def abandon(self):
+        self.first.cancel()
+        await asyncio.gather(self.first, return_exceptions=True)
+        try:
+            await self.stream.aclose()
+        except Exception:
+            pass
+
+
+class ProviderRouter:
+    """
+    Streams a completion from the best available provider.
+
+    open_stream(provider, prompt, model) must return an async iterator of
+    non-empty text chunks, as the time to the first one is the provider's
+    time to first token; anything with a __name__ (or a str) works as a
+    provider, so local stub providers can be routed exactly like real ones.
+    """
+
+    def __init__(self, providers, open_stream, window=300, error_rate=0.5, min_requests=4,
+                 cooldown=60, first_token_timeout=30, hedge_after=None):
+        self.providers = list(providers)
+        self.open_stream = open_stream
+        self.first_token_timeout = first_token_timeout
+        self.hedge_after = hedge_after or None
+        self.health = {
+            provider: ProviderHealth(_name(provider), window, error_rate, min_requests, cooldown)
+            for provider in self.providers
+        }
+
+    def order(self, now=None):
+        """Available providers, most promising first"""
+        now = time.monotonic() if now is None else now
+        candidates = [p for p in self.providers if self.health[p].available(now)]
+        return sorted(candidates, key=lambda p: (self.health[p].expected_latency(now), self.providers.index(p)))
+
+    def metrics(self):
+        now = time.monotonic()
+        return [self.health[provider].snapshot(now) for provider in self.providers]
+
+    def _launch(self, candidates, pending, prompt, model):
+        for provider in candidates:
+            now = time.monotonic()
+            health = self.health[provider]
+            # Re-check, another request may have taken the half-open trial meanwhile
+            if not health.available(now):
+                continue
+            health.started(now)
+            try:
+                stream = aiter(self.open_stream(provider, prompt, model))
+            except Exception as e:
+                logger.warning(f"Chatbot provider {health.name} failed to start: {e}")
+                health.record_failure(now)
+                continue
+            attempt = _Attempt(provider, health, stream, now)
+            pending[attempt.first] = attempt
+            return attempt
+        return None
+
+    async def stream(self, prompt, model):
+        """Async generator yielding the completion from whichever provider answers first"""
+        candidates = iter(self.order())
+        pending = {}
+        errors = []
+        winner = None
+        first_chunk = None
+        primary = self._launch(candidates, pending, prompt, model)
+        hedge_at = primary.started + self.hedge_after if primary and self.hedge_after else None
+        try:
+            while pending and winner is None:
+                deadlines = [a.started + self.first_token_timeout for a in pending.values()]
+                if hedge_at is not None:
+                    deadlines.append(hedge_at)
+                timeout = max(0.0, min(deadlines) - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                now = time.monotonic()
+
+                for future in done:
+                    attempt = pending.pop(future)
+                    if winner is not None:
+                        # Both hedged providers answered at once; keep the first
+                        attempt.health.record_abandoned(now, now - attempt.started)
+                        await attempt.abandon()
+                        continue
+                    try:
+                        first_chunk = future.result()
+                    except StopAsyncIteration:
+                        errors.append(f"{attempt.health.name}: empty response")
+                        attempt.health.record_failure(now)
+                    except Exception as e:
+                        errors.append(f"{attempt.health.name}: {e}")
+                        attempt.health.record_failure(now)
+                    else:
+                        winner = attempt
+                        attempt.health.record_success(now, now - attempt.started)
+
+                if winner is not None:
+                    break
+
+                for future, attempt in list(pending.items()):
+                    if now - attempt.started >= self.first_token_timeout:
+                        del pending[future]
+                        errors.append(f"{attempt.health.name}: no response after {self.first_token_timeout}s")
+                        attempt.health.record_failure(now)
+                        await attempt.abandon()
+
+                if hedge_at is not None and now >= hedge_at:
+                    # At most one hedge per primary attempt
+                    hedge_at = None
+                    if primary.first in pending and self._launch(candidates, pending, prompt, model):
+                        primary.health.hedges += 1
+                        logger.info(f"Hedging slow chatbot provider {primary.health.name}")
+                if not pending:
+                    # Fall over to the next provider, hedging against it in turn
+                    primary = self._launch(candidates, pending, prompt, model)
+                    hedge_at = primary.started + self.hedge_after if primary and self.hedge_after else None
+        finally:
+            now = time.monotonic()
+            for attempt in pending.values():
+                attempt.health.record_abandoned(now, now - attempt.started)
+                await attempt.abandon()
+
+        if winner is None:
+            raise NoProviderAvailable("; ".join(errors) or "No chatbot provider is currently available")
+
+        try:
+            yield first_chunk
+            async for chunk in winner.stream:
+                yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            raise
+        except Exception:
+            winner.health.record_failure(time.monotonic())
+            raise
+        finally:
+            try:
+                await winner.stream.aclose()
+            except Exception:
+                pass
+
+
+def _name(provider):
+    return provider if isinstance(provider, str) else getattr(provider, '__name__', repr(provider))
@@ -1,16 +1,128 @@
+from django.utils import timezone
 from rest_framework import serializers
 
 from website.models import Language, Paste
 
 
-class LanguageSerializer(serializers.ModelSerializer):
+def requested_fields(request, available):
+    """
+    Names from the comma separated ?fields= parameter that are in available,
+    in the order of available, or all of them when the parameter is missing.
+    Unknown names are ignored, but naming no known field is a 400.
+    """
+    param = request.query_params.get('fields') if request is not None else None
+    if not param:
+        return list(available)
+    wanted = {name.strip() for name in param.split(',')}
+    fields = [name for name in available if name in wanted]
+    if not fields:
+        raise serializers.ValidationError({'fields': [f"No such field, choose from: {', '.join(available)}."]})
+    return fields
+
+
+class SparseFieldsetMixin:
+    """Drop the fields the client did not ask for with ?fields="""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        # Nested serializers have no request of their own to honour
+        if request is None or self.parent is not None:
+            return
+        keep = set(requested_fields(request, self.fields))
+        for name in list(self.fields):
+            if name not in keep:
+                self.fields.pop(name)
+
+
+def fast_lookups(columns, fields):
+    """ORM lookups to pass to values() for the given output fields"""
+    lookups = []
+    for name in fields:
+        column = columns[name]
+        if isinstance(column, dict):
+            lookups.extend(column.values())
+        else:
+            lookups.append(column)
+    return lookups
+
+
+def fast_row(instance, lookups):
+    """The values() row of lookups for an instance that has no database row to query"""
+    row = {}
+    for lookup in lookups:
+        value = instance
+        for name in lookup.split('__'):
+            value = getattr(value, name) if value is not None else None
+        row[lookup] = value
+    return row
+
+
+def fast_representation(row, columns, fields):
+    """
+    Build the response item for a values() row without going through the
+    serializer fields. Datetimes are left to the JSON renderer, which formats
+    them the way DateTimeField does.
+    """
+    item = {}
+    for name in fields:
+        column = columns[name]
+        if isinstance(column, dict):
+            nested = {key: row[lookup] for key, lookup in column.items()}
+            # A missing related object, which its serializer renders as null
+            item[name] = nested if any(value is not None for value in nested.values()) else None
+        else:
+            value = row[column]
+            if hasattr(value, 'tzinfo') and value.tzinfo is not None:
+                value = timezone.localtime(value)
+            item[name] = value
+    return item
+
+
+class LanguageSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # Output field -> values() lookup, for read-only list responses
+    fast_columns = {'id': 'id', 'displayname': 'displayname', 'alias': 'alias'}
+
     class Meta:
         model = Language
         fields = '__all__'
 
-class PasteSerializer(serializers.ModelSerializer):
+class PasteSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # No preview: anyone may look up any paste, including one-time pastes
+    # that must not give away their content before being viewed
     lang = LanguageSerializer()
+    fast_columns = {
+        'id': 'id',
+        'created': 'created',
+        'lang': {'id': 'lang__id', 'displayname': 'lang__displayname', 'alias': 'lang__alias'},
+        'size': 'size',
+        'line_count': 'line_count',
+    }
+
     class Meta:
         model = Paste
-        fields = ['id', 'created', 'lang']
+        fields = ['id', 'created', 'lang', 'size', 'line_count']
+        read_only_fields = ['size', 'line_count']
+
+
+class HistorySerializer(PasteSerializer):
+    """A client's paste history, read from HistoryEntry rows; previews of their own pastes"""
+    fast_columns = {
+        'id': 'paste_id',
+        'created': 'created',
+        'lang': {'id': 'paste__lang__id', 'displayname': 'paste__lang__displayname', 'alias': 'paste__lang__alias'},
+        'size': 'paste__size',
+        'line_count': 'paste__line_count',
+        'preview': 'preview',
+    }
+
+    class Meta(PasteSerializer.Meta):
+        fields = PasteSerializer.Meta.fields + ['preview']
+
 
+class PasteBatchItemSerializer(serializers.Serializer):
+    """One paste of a batch create request"""
+    content = serializers.CharField(trim_whitespace=False)
+    language = serializers.IntegerField()
+    expiration = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    one_time = serializers.BooleanField(required=False, default=False)
@@ -1,3 +1,313 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import socket
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from website import cache_utils, write_behind
+from website.models import Language, Paste
+
+from . import admission, answer_cache, duck_ai
+from .chat_context import estimate_tokens, split_chunks
+from .provider_router import NoProviderAvailable, ProviderHealth, ProviderRouter
+from .serializers import PasteSerializer, fast_representation, requested_fields
+
+
+class Stub:
+    """
+    A local provider: after delay seconds it raises error, if given, or
+    streams chunks
+    """
+
+    def __init__(self, name, *chunks, delay=0.0, error=None):
+        self.__name__ = name
+        self.chunks = chunks
+        self.delay = delay
+        self.error = error
+
+    async def stream(self):
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for chunk in self.chunks:
+            yield chunk
+
+
+def open_stub(provider, prompt, model):
+    return provider.stream()
+
+
+def in_order(router, *providers):
+    """Make router try providers in this order whatever their latency, skipping open circuits"""
+    router.order = lambda now=None: [p for p in providers if router.health[p].available(time.monotonic())]
+
+
+async def complete(router):
+    return ''.join([chunk async for chunk in router.stream('prompt', 'model')])
+
+
+class ProviderRouterTests(SimpleTestCase):
+    async def test_failover(self):
+        broken = Stub('broken', error=RuntimeError('down'))
+        working = Stub('working', 'hello', ' world')
+        router = ProviderRouter([broken, working], open_stub)
+        self.assertEqual(await complete(router), 'hello world')
+        self.assertEqual(router.health[broken].failures, 1)
+        self.assertEqual(router.health[working].failures, 0)
+
+    async def test_every_provider_failing(self):
+        router = ProviderRouter([Stub('a', error=RuntimeError('down')), Stub('b')], open_stub)
+        with self.assertRaises(NoProviderAvailable):
+            await complete(router)
+
+    async def test_circuit_opens_and_closes(self):
+        flaky = Stub('flaky', error=RuntimeError('down'))
+        backup = Stub('backup', 'ok')
+        router = ProviderRouter([flaky, backup], open_stub, min_requests=2, error_rate=0.5, cooldown=0.05)
+        in_order(router, flaky, backup)
+        health = router.health[flaky]
+        self.assertEqual(await complete(router), 'ok')
+        self.assertEqual(health.state(), ProviderHealth.CLOSED)  # fewer than min_requests
+        self.assertEqual(await complete(router), 'ok')
+        self.assertEqual(health.state(), ProviderHealth.OPEN)
+        self.assertEqual(router.order(), [backup])
+
+        await asyncio.sleep(0.06)
+        self.assertEqual(health.state(), ProviderHealth.HALF_OPEN)
+        # The trial request succeeds, closing the circuit
+        flaky.error, flaky.chunks = None, ('recovered',)
+        self.assertEqual(await complete(router), 'recovered')
+        self.assertEqual(health.state(), ProviderHealth.CLOSED)
+
+    async def test_failed_trial_reopens_the_circuit(self):
+        flaky = Stub('flaky', error=RuntimeError('down'))
+        backup = Stub('backup', 'ok')
+        router = ProviderRouter([flaky, backup], open_stub, min_requests=1, cooldown=0.05)
+        in_order(router, flaky, backup)
+        await complete(router)
+        self.assertEqual(router.health[flaky].state(), ProviderHealth.OPEN)
+        await asyncio.sleep(0.06)
+        self.assertEqual(await complete(router), 'ok')
+        self.assertEqual(router.health[flaky].state(), ProviderHealth.OPEN)
+        self.assertEqual(router.health[flaky].failures, 2)
+
+    async def test_hedging(self):
+        slow = Stub('slow', 'slow answer', delay=1)
+        fast = Stub('fast', 'fast answer', delay=0.01)
+        router = ProviderRouter([slow, fast], open_stub, hedge_after=0.05)
+        started = time.monotonic()
+        self.assertEqual(await complete(router), 'fast answer')
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(router.health[slow].hedges, 1)
+
+    async def test_failover_attempts_are_hedged(self):
+        # The first primary is hedged, then both fail; the next primary is slow
+        # and must be hedged in turn
+        providers = [
+            Stub('first', error=RuntimeError('down'), delay=0.1),
+            Stub('second', error=RuntimeError('down')),
+            Stub('third', 'slow answer', delay=1),
+            Stub('fourth', 'fast answer'),
+        ]
+        router = ProviderRouter(providers, open_stub, hedge_after=0.05)
+        started = time.monotonic()
+        self.assertEqual(await complete(router), 'fast answer')
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(router.health[providers[2]].hedges, 1)
+
+    async def test_first_token_timeout(self):
+        hung = Stub('hung', 'late', delay=1)
+        router = ProviderRouter([hung, Stub('backup', 'ok')], open_stub, first_token_timeout=0.05)
+        self.assertEqual(await complete(router), 'ok')
+        self.assertEqual(router.health[hung].failures, 1)
+
+
+def chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content), message=None)])
+
+
+class OpenStreamTests(SimpleTestCase):
+    async def test_time_to_first_token_skips_empty_chunks(self):
+        async def stream(**kwargs):
+            # Role chunk at once, text later
+            yield chunk(None)
+            await asyncio.sleep(0.1)
+            yield chunk('hi')
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(stream=stream)))
+        provider = Stub('g4f')
+        router = ProviderRouter([provider], duck_ai._open_stream)
+        with mock.patch.object(duck_ai, 'get_client', return_value=client):
+            self.assertEqual(await complete(router), 'hi')
+        self.assertGreaterEqual(router.health[provider].ttft_quantile(time.monotonic(), 0.5), 0.1)
+
+
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(admission, _client=None, _scripts={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_hanging_redis_admits(self):
+        # Accepts connections, as the backlog does, but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        self.addCleanup(server.close)
+        url = f'redis://127.0.0.1:{server.getsockname()[1]}/0'
+        request = RequestFactory().post('/api/chatbot/')
+        with override_settings(CHATBOT_ADMISSION_REDIS_URL=url, CHATBOT_ADMISSION_REDIS_TIMEOUT=0.1):
+            started = time.monotonic()
+            with self.assertLogs('api.admission', 'WARNING'):
+                slot = await admission.admit(request)
+        self.assertIsNotNone(slot)
+        self.assertIsNone(slot.lease_id)
+        self.assertLess(time.monotonic() - started, 1)
+        await admission.get_redis().aclose()
+
+
+@override_settings(CHATBOT_ANSWER_CACHE_MAX_PER_PASTE=2)
+class AnswerIndexTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    async def test_oldest_answers_are_evicted(self):
+        for key in ['a1', 'a2', 'a3']:
+            await answer_cache._store(key, 'abc123', ['answer'])
+        self.assertIsNone(cache.get('a1'))
+        self.assertEqual(cache.get(cache_utils.chatbot_answers_key('abc123')), ['a2', 'a3'])
+        cache_utils.invalidate_paste_cache(['abc123'])
+        self.assertEqual(cache.get_many(['a2', 'a3']), {})
+
+    @override_settings(CHATBOT_ANSWER_CACHE_MAX_PER_PASTE=20)
+    async def test_concurrent_answers_are_all_recorded(self):
+        keys = [f'a{i}' for i in range(10)]
+        await asyncio.gather(*(answer_cache._store(key, 'abc123', ['answer']) for key in keys))
+        self.assertCountEqual(cache.get(cache_utils.chatbot_answers_key('abc123')), keys)
+
+    def test_redis_index_is_updated_by_one_script(self):
+        client = mock.Mock()
+        record = client.register_script.return_value
+        record.return_value = [b'a1']
+        with mock.patch.object(cache_utils, 'get_redis_connection', return_value=client), \
+                mock.patch.object(cache, 'delete_many') as delete_many:
+            cache_utils.record_chatbot_answer('abc123', 'a3', 60)
+        record.assert_called_once_with(keys=[cache.make_key('chatbot_answers_abc123')], args=['a3', 2, 60])
+        delete_many.assert_called_once_with(['a1'])
+
+
+class FastRepresentationTests(SimpleTestCase):
+    def test_missing_language_is_null(self):
+        columns = PasteSerializer.fast_columns
+        row = {'lang__id': None, 'lang__displayname': None, 'lang__alias': None}
+        self.assertEqual(fast_representation(row, columns, ['lang']), {'lang': None})
+
+    def test_requested_fields(self):
+        request = Request(RequestFactory().get('/', {'fields': 'size,id,bogus'}))
+        self.assertEqual(requested_fields(request, PasteSerializer.fast_columns), ['id', 'size'])
+
+    def test_no_known_field_is_rejected(self):
+        request = Request(RequestFactory().get('/', {'fields': 'bogus'}))
+        with self.assertRaises(ValidationError):
+            requested_fields(request, PasteSerializer.fast_columns)
+
+
+class QueueStub:
+    """The write-behind Redis commands the API sends, over a dict of queued rows"""
+
+    def __init__(self):
+        self.rows = {}
+        self.results = []
+
+    def hget(self, key, paste_id):
+        return self.rows.get(paste_id)
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return contextlib.nullcontext(self)
+
+    def hexists(self, key, paste_id):
+        self.results.append(paste_id in self.rows)
+
+    def execute(self):
+        return self.results
+
+    def register_script(self, script):
+        return self.enqueue
+
+    def enqueue(self, keys, args, client=None):
+        paste_id, row = args
+        queued = int(self.rows.setdefault(paste_id, row) == row)
+        if client is None:
+            return queued
+        client.results.append(queued)
+
+
+@override_settings(PASTE_WRITE_BEHIND=True, PASTE_WRITE_BEHIND_REDIS_URL='redis://write-behind',
+                   PASTE_CACHE_INVALIDATION_REDIS_URL=None)
+class WriteBehindAPITests(TestCase):
+    """The batch endpoints with pastes still queued for write-behind"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lang = Language.objects.create(displayname='Python', alias='python')
+
+    def setUp(self):
+        self.queue = QueueStub()
+        patcher = mock.patch.object(write_behind, 'get_redis', return_value=self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetch_many_finds_pending_pastes(self):
+        Paste.objects.create(id='aaa111', ciphertext='stored', lang=self.lang)
+        write_behind.save_paste(Paste(id='bbb222', ciphertext='one\ntwo', lang=self.lang))
+        response = self.client.get('/api/pastes/', {'ids': 'aaa111,bbb222,ccc333', 'fields': 'id,lang,line_count'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'id': 'aaa111', 'lang': {'id': self.lang.id, 'displayname': 'Python', 'alias': 'python'}, 'line_count': 1},
+            {'id': 'bbb222', 'lang': {'id': self.lang.id, 'displayname': 'Python', 'alias': 'python'}, 'line_count': 2},
+            {'id': 'ccc333', 'error': 'Not found.'},
+        ])
+
+    def test_batch_create_is_queued(self):
+        response = self.client.post('/api/pastes/batch/', {'pastes': [
+            {'content': 'first', 'language': self.lang.id},
+            {'content': 'second', 'language': self.lang.id},
+        ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        ids = [result['id'] for result in response.json()['results']]
+        self.assertEqual(set(self.queue.rows), set(ids))
+        self.assertFalse(Paste.objects.exists())
+        self.assertEqual(write_behind.pending_paste(ids[1]).ciphertext, 'second')
+
+    @override_settings(PASTE_WRITE_BEHIND=False)
+    def test_batch_create_inserts_without_write_behind(self):
+        response = self.client.post('/api/pastes/batch/', {'pastes': [{'content': 'a\nb', 'language': self.lang.id}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        paste = Paste.objects.get(id=response.json()['results'][0]['id'])
+        self.assertEqual(paste.line_count, 2)
+        self.assertFalse(self.queue.rows)
+
+
+class SplitChunksTests(SimpleTestCase):
+    def test_chunks_hold_whole_lines_within_budget(self):
+        lines = [f'line {i} ' + 'x' * 90 for i in range(10)]
+        chunks = split_chunks('\n'.join(lines), chunk_lines=40, max_tokens=60)
+        for first, last, text in chunks:
+            self.assertEqual(text, '\n'.join(lines[first - 1:last]))
+            self.assertLessEqual(estimate_tokens(text), 60)
+        self.assertEqual([(first, last) for first, last, _ in chunks], [(1, 2), (3, 4), (5, 6), (7, 8), (9, 10)])
+
+    def test_long_line_is_cut_with_a_marker(self):
+        [(first, last, text)] = split_chunks('y' * 1000, chunk_lines=40, max_tokens=60)
+        self.assertEqual((first, last), (1, 1))
+        self.assertTrue(text.endswith('... (rest of line 1 omitted) ...'))
+        self.assertLessEqual(estimate_tokens(text), 60)
@@ -1,15 +1,39 @@
 from django.urls import path, include
-from drf_spectacular.views import SpectacularRedocView, SpectacularAPIView
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
+
+from pastebinir.db_router import replica_reads
+
+from .views import PasteListCreateAPIView, PasteBatchCreateAPIView, PasteRetrieveUpdateDestroyAPIView, LanguageListAPIView, ChatbotAPIView, ChatbotProvidersAPIView, test_view
+
+
+def lazy_view(dotted_path, **initkwargs):
+    """
+    The class-based view at dotted_path, imported on its first request. For
+    rarely used views whose modules are expensive to import, such as the
+    schema generator.
+    """
+    view = None
+
+    @csrf_exempt
+    def wrapper(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(dotted_path).as_view(**initkwargs)
+        return view(request, *args, **kwargs)
+    return wrapper
 
-from .views import PasteListCreateAPIView, PasteRetrieveUpdateDestroyAPIView, LanguageListAPIView, ChatbotAPIView, test_view
 
 urlpatterns = [
-    path('pastes/', PasteListCreateAPIView.as_view(), name='paste-list-create'),
+    # Creating a paste runs in its own transaction
+    path('pastes/', replica_reads(PasteListCreateAPIView.as_view()), name='paste-list-create'),
     path('auth/',include('dj_rest_auth.urls')),
-    path('schema/', SpectacularAPIView.as_view(), name='schema'),
-    path('schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    path('schema/', lazy_view('drf_spectacular.views.SpectacularAPIView'), name='schema'),
+    path('schema/redoc/', lazy_view('drf_spectacular.views.SpectacularRedocView', url_name='schema'), name='redoc'),
+    path('pastes/batch/', PasteBatchCreateAPIView.as_view(), name='paste-batch-create'),
     path('pastes/<str:pk>/', PasteRetrieveUpdateDestroyAPIView.as_view(), name='paste-detail'),
-    path('languages/', LanguageListAPIView.as_view(), name='language-list'),
+    path('languages/', replica_reads(LanguageListAPIView.as_view()), name='language-list'),
     path('chatbot/', ChatbotAPIView.as_view(), name='chatbot'),
+    path('chatbot/providers/', ChatbotProvidersAPIView.as_view(), name='chatbot-providers'),
     path('test/', test_view, name='test'),
 ]
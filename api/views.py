@@ -1,25 +1,41 @@
-from django.shortcuts import get_object_or_404
-from rest_framework import generics, status, views
+from rest_framework import generics, serializers, status, views
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, BasePermission
-from website.models import Paste, Language
-from .serializers import PasteSerializer, LanguageSerializer
+from rest_framework.permissions import AllowAny, BasePermission, IsAdminUser
+from website.models import HistoryEntry, Paste, Language
+from website.cache_utils import invalidate_paste_cache
+from website.write_behind import pending_ids, pending_paste, save_paste, save_pastes
+from website.history import (
+    finish_response, forget_pastes, get_history_token, import_legacy_history, record_paste, record_pastes,
+)
+from website.languages import get_registry
+from .pagination import LanguageCursorPagination, PasteCursorPagination
+from .serializers import (
+    HistorySerializer, LanguageSerializer, PasteBatchItemSerializer, PasteSerializer, fast_lookups, fast_representation,
+    fast_row, requested_fields,
+)
+import asyncio
 import hashlib
 import random
 import time
 from django.utils import timezone
 from datetime import timedelta
-from dotenv import load_dotenv
-import os
 import json
 import logging
-from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
-# Import the new duck_ai function
-from .duck_ai import get_ai_response
+from pastebinir.metrics import CHATBOT_FIRST_TOKEN_SECONDS
 
+# Chatbot answers are served through the answer cache
+from .admission import admit
+from .answer_cache import cached_ai_response
+from .chat_context import build_context
+from .duck_ai import get_router
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 
 class BotTokenPermission(BasePermission):
@@ -28,94 +44,237 @@ class BotTokenPermission(BasePermission):
     def has_permission(self, request, view):
         return True
 
-class PasteListCreateAPIView(generics.ListCreateAPIView):
-    serializer_class = PasteSerializer
+class RelatedFieldsMixin:
+    """select_related() whatever nested serializers the response will render"""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer = self.get_serializer()
+        related = [
+            field.source for field in serializer.fields.values()
+            if isinstance(field, serializers.BaseSerializer) and field.source != '*'
+        ]
+        return queryset.select_related(*related) if related else queryset
+
+
+class FastListMixin:
+    """
+    Answer read-only list requests straight from QuerySet.values() rows using
+    the serializer's fast_columns, skipping per-object field machinery. The
+    output matches what the serializer would produce.
+    """
+
+    def list(self, request, *args, **kwargs):
+        columns = self.get_serializer_class().fast_columns
+        fields = requested_fields(request, columns)
+        lookups = fast_lookups(columns, fields)
+        if self.pagination_class is not None:
+            # The cursor is taken from the ordering fields of each row
+            lookups += [name.lstrip('-') for name in self.pagination_class.ordering]
+        queryset = self.filter_queryset(self.get_queryset()).values(*dict.fromkeys(lookups))
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else queryset
+        data = [fast_representation(row, columns, fields) for row in rows]
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+
+class PasteListCreateAPIView(FastListMixin, generics.ListCreateAPIView):
+    serializer_class = HistorySerializer
+    pagination_class = PasteCursorPagination
     permission_classes = [BotTokenPermission]  # Use custom bot permission
     def generate_unique_id(self):
         while True:
             unique_string = f"{timezone.now().timestamp()}{random.randint(0, 999999)}"
             hash_object = hashlib.sha256(unique_string.encode())
             unique_id = hash_object.hexdigest()[:6]
-            if not Paste.objects.filter(id=unique_id).exists():
+            if not Paste.objects.filter(id=unique_id).exists() and not pending_ids([unique_id]):
                 return unique_id
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
-        id = self.generate_unique_id()
-        print(f"Generated ID: {id} (Type: {type(id)})")
         content = request.data.get('content')
         password = request.data.get('password')
         lang_id = request.data.get('language')
-        print(lang_id)
-        lang = get_object_or_404(Language, id=lang_id)
         expiration_days = request.data.get('expiration')
         one_time = request.data.get('one_time', False)
 
         if not lang_id:
             return Response({"error": "Language is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-        lang = get_object_or_404(Language, id=lang_id)
+        lang = get_registry().get(lang_id)
+        if lang is None:
+            raise Http404("No Language matches the given query.")
 
         if content:
             id = self.generate_unique_id()
             expires = None
             if expiration_days:
                 expires = timezone.now() + timedelta(days=int(expiration_days))
-            paste = Paste.objects.create(id=id, salt=None, iv=None, ciphertext=content, lang=lang, expires=expires, one_time=one_time)
-            pastes_cookie = request.COOKIES.get('pasteHistory', '')
-            if pastes_cookie:
-                pastes_list = pastes_cookie.split(',')
-                if id not in pastes_list:
-                    pastes_list.append(id)
-            else:
-                pastes_list = [id]
-            response = Response({"id": id}, status=status.HTTP_201_CREATED)
-            response.set_cookie('pasteHistory', ','.join(pastes_list), max_age=31536000)
-            return response
+            paste = save_paste(Paste(id=id, salt=None, iv=None, ciphertext=content, lang=lang, expires=expires, one_time=one_time))
+            token = record_paste(get_history_token(request), paste)
+            response = Response({"id": paste.id}, status=status.HTTP_201_CREATED)
+            return finish_response(request, response, token)
         return Response({"error": "Content is required."}, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
-        pastes_cookie = self.request.COOKIES.get('pasteHistory', '')
-        pastes_list = pastes_cookie.split(',') if pastes_cookie else []
-        return Paste.objects.filter(id__in=pastes_list)
+        # The client's history, bounded to HISTORY_MAX_ENTRIES
+        token = import_legacy_history(self.request) or get_history_token(self.request)
+        self.history_token = token
+        if not token:
+            return HistoryEntry.objects.none()
+        return HistoryEntry.objects.filter(client_token=token).order_by('-created', '-id')
 
-    def get(self, request, *args, **kwargs):
-        pastes = self.get_queryset()
-        paste_list = [{"id": paste.id, "created": paste.created} for paste in pastes]
-        return Response(paste_list)
+    def list(self, request, *args, **kwargs):
+        if 'ids' in request.query_params:
+            return self.fetch_many(request)
+        return finish_response(request, super().list(request, *args, **kwargs), self.history_token)
+
+    def fetch_many(self, request):
+        """GET ?ids=a,b,c: several pastes in one query, with an error for each one not found or no longer available"""
+        ids = [paste_id.strip() for paste_id in request.query_params['ids'].split(',') if paste_id.strip()]
+        if not ids:
+            return Response({"error": "ids is empty."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > settings.API_BATCH_MAX_SIZE:
+            return Response({"error": f"At most {settings.API_BATCH_MAX_SIZE} ids per request."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        columns = PasteSerializer.fast_columns
+        fields = requested_fields(request, columns)
+        # Expired and used up pastes are reported as not found, like their pages
+        lookups = fast_lookups(columns, fields)
+        rows = Paste.objects.available().filter(id__in=ids).values(*dict.fromkeys(lookups + ['id']))
+        found = {row['id']: fast_representation(row, columns, fields) for row in rows}
+        # Pastes still queued for write-behind have no row yet
+        now = timezone.now()
+        for paste_id in pending_ids(paste_id for paste_id in ids if paste_id not in found):
+            paste = pending_paste(paste_id)
+            if paste is not None and not (paste.expires and paste.expires < now):
+                found[paste_id] = fast_representation(fast_row(paste, lookups), columns, fields)
+        results = [found[paste_id] if paste_id in found else {"id": paste_id, "error": "Not found."} for paste_id in ids]
+        return Response({"results": results})
+
+
+class PasteBatchCreateAPIView(views.APIView):
+    """
+    POST {"pastes": [...]}: create up to API_BATCH_MAX_SIZE pastes with one
+    bulk insert, or one round trip to the write-behind queue. Each result
+    carries either the new id or that item's errors; valid items are created
+    even when others are rejected.
+    """
+    permission_classes = [BotTokenPermission]
+
+    def post(self, request, *args, **kwargs):
+        items = request.data.get('pastes') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response({"error": "pastes must be a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.API_BATCH_MAX_SIZE:
+            return Response({"error": f"At most {settings.API_BATCH_MAX_SIZE} pastes per request."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            serializer = PasteBatchItemSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {"errors": serializer.errors}
+        registry = get_registry()
+
+        now = timezone.now()
+        pastes = []
+        for index, data in valid:
+            lang = registry.get(data['language'])
+            if lang is None:
+                results[index] = {"errors": {"language": ["Language not found."]}}
+                continue
+            expires = now + timedelta(days=data['expiration']) if data.get('expiration') else None
+            paste = Paste(salt=None, iv=None, ciphertext=data['content'], lang=lang, expires=expires,
+                          one_time=data['one_time'])
+            pastes.append((index, paste))
+
+        if pastes:
+            # Same path as single creation, queued when write-behind is enabled
+            save_pastes([paste for _, paste in pastes])
+            for index, paste in pastes:
+                results[index] = {"id": paste.id}
+            token = record_pastes(get_history_token(request), [paste for _, paste in pastes])
+        else:
+            token = None
+        response_status = status.HTTP_201_CREATED if pastes else status.HTTP_400_BAD_REQUEST
+        return finish_response(request, Response({"results": results}, status=response_status), token)
 
 
-class PasteRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Paste.objects.all()
+class PasteRetrieveUpdateDestroyAPIView(RelatedFieldsMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Paste.objects.listing()
     serializer_class = PasteSerializer
 
+    def perform_destroy(self, instance):
+        paste_id = instance.id
+        instance.delete()
+        forget_pastes([paste_id])
+        invalidate_paste_cache([paste_id])
 
-class LanguageListAPIView(generics.ListAPIView):
+
+class LanguageListAPIView(FastListMixin, generics.ListAPIView):
     queryset = Language.objects.all()
     serializer_class = LanguageSerializer
+    pagination_class = LanguageCursorPagination
     permission_classes = [BotTokenPermission]  # Use custom bot permission
 
+    def list(self, request, *args, **kwargs):
+        if request.query_params:
+            # Sparse fieldsets and explicit pages go through the queryset
+            return super().list(request, *args, **kwargs)
+        registry = get_registry()
+        if registry.etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(registry.json, content_type='application/json')
+        response['ETag'] = registry.etag
+        return response
+
 # Add the new chatbot view
-class ChatbotAPIView(views.APIView):
-    permission_classes = [BotTokenPermission]
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatbotAPIView(View):
+    """
+    Native async view so open chat streams share the worker's event loop
+    instead of each pinning a sync worker. Must be served through ASGI.
+    """
+    http_method_names = ['post', 'options']
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # ATOMIC_REQUESTS cannot wrap async views
+        return transaction.non_atomic_requests(super().as_view(**initkwargs))
 
-    def stream_ai_response(self, prompt):
+    async def stream_ai_response(self, paste, question, prompt, slot):
         """
-        Generator function to stream the AI response, ensuring all chunks are
-        properly formatted as JSON strings.
+        Async generator to stream the AI response, ensuring all chunks are
+        properly formatted as JSON strings. Cached answers are replayed the
+        same way as live ones. The stream slot is released however the
+        stream ends, including the client disconnecting.
         """
+        started = time.perf_counter()
+        first_chunk = True
         try:
+            slot.keep_alive()
             logger.info("Streaming AI response...")
             # Send an initial comment to kick-start the event stream and flush proxies
             yield ": connected" + "\n\n"
-            for chunk in get_ai_response(prompt):
+            async for chunk in cached_ai_response(paste, question, prompt):
                 # Ensure the chunk is a string and not empty before processing.
                 if isinstance(chunk, str) and chunk.strip():
+                    if first_chunk:
+                        CHATBOT_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                        first_chunk = False
                     # Always wrap the chunk in a JSON object.
                     response_data = {'response_chunk': chunk}
                     yield f"data: {json.dumps(response_data)}\n\n"
                 else:
                     # Log and skip non-string or empty chunks.
                     logger.warning(f"Skipping invalid chunk: {chunk}")
-            
+
             # Signal the end of the stream.
             yield f"data: {json.dumps({'end_of_stream': True})}\n\n"
             logger.info("Finished streaming AI response.")
@@ -126,29 +285,61 @@ class ChatbotAPIView(views.APIView):
             error_data = {'error': str(e)}
             yield f"data: {json.dumps(error_data)}\n\n"
 
-    def post(self, request, *args, **kwargs):
+        finally:
+            await slot.release()
+
+    async def post(self, request, *args, **kwargs):
         logger.info("ChatbotAPIView received a POST request.")
-        paste_id = request.data.get('paste_id')
-        question = request.data.get('question')
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            data = request.POST
+        if not isinstance(data, dict):
+            data = {}
+        paste_id = data.get('paste_id')
+        question = data.get('question')
 
         if not all([paste_id, question]):
             logger.error("Missing paste_id or question.")
-            return Response({"error": "paste_id and question are required."}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({"error": "paste_id and question are required."}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
             logger.info(f"Fetching paste with id: {paste_id}")
-            paste = Paste.objects.get(id=paste_id)
+            try:
+                paste = await Paste.objects.aget(id=paste_id)
+            except Paste.DoesNotExist:
+                # It may still be queued for write-behind
+                paste = await asyncio.to_thread(pending_paste, paste_id)
+                if paste is None:
+                    raise
             logger.info("Paste fetched successfully.")
+            if paste.salt:
+                # Only ciphertext is stored for these, which means nothing to the model
+                return JsonResponse({"error": "Password-protected pastes cannot be discussed with the assistant."}, status=status.HTTP_400_BAD_REQUEST)
+
+            slot = await admit(request)
+            if slot is None:
+                logger.warning("Too many chatbot streams, rejecting request.")
+                response = JsonResponse({"error": "Too many chat requests, please try again shortly."}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+                response['Retry-After'] = str(settings.CHATBOT_RETRY_AFTER)
+                return response
+
+            # Ranking a large paste is CPU-bound, keep it off the event loop
+            try:
+                context = await asyncio.to_thread(build_context, paste.ciphertext, question)
+            except BaseException:
+                await slot.release()
+                raise
             prompt = (
                 f"Please answer the following question about the provided code. "
                 f"Keep your answer concise and to the point. "
                 f"Use Markdown for formatting, especially for code snippets, and use lists to break up long paragraphs.\n\n"
-                f"Here is the code:\n\n{paste.ciphertext}\n\n"
+                f"Here is the code:\n\n{context}\n\n"
                 f"Question: {question}"
             )
-            
+
             response = StreamingHttpResponse(
-                self.stream_ai_response(prompt),
+                self.stream_ai_response(paste, question, prompt, slot),
                 content_type='text/event-stream; charset=utf-8'
             )
             # Required headers to avoid buffering and enable incremental flush
@@ -156,7 +347,7 @@ class ChatbotAPIView(views.APIView):
             response['X-Accel-Buffering'] = 'no'
             response['Connection'] = 'keep-alive'
             return response
-            
+
         except Paste.DoesNotExist:
             logger.error(f"Paste with id {paste_id} not found.")
             return JsonResponse({"error": "Paste not found."}, status=status.HTTP_404_NOT_FOUND)
@@ -164,5 +355,12 @@ class ChatbotAPIView(views.APIView):
             logger.error(f"An unexpected error occurred: {e}", exc_info=True)
             return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class ChatbotProvidersAPIView(views.APIView):
+    """Per-provider latency, error and circuit metrics of this worker's chatbot router"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_router().metrics())
+
 def test_view(request):
     return JsonResponse({"status": "ok"})
@@ -1,37 +1,45 @@
 #!/bin/bash
 
-# SQLite Database Backup Script
-BACKUP_DIR="./backups"
-DB_FILE="db.sqlite3"
+# Database Backup Script
+# Writes the whole database, on any backend, into backups/<timestamp>/:
+#   data.json.gz      everything but pastes (languages, users, history, tokens, ...) from dumpdata
+#   pastes.ndjson.gz  every paste, streamed by export_pastes
+# Restore into a migrated database, pastes last so their languages and owners exist:
+#   python manage.py loaddata backups/<timestamp>/data.json.gz
+#   python manage.py import_pastes backups/<timestamp>/pastes.ndjson.gz
+# Set MANAGE to run it elsewhere, e.g. MANAGE="docker compose exec -T django python manage.py"
+BACKUP_ROOT="./backups"
+MANAGE="${MANAGE:-python manage.py}"
 TIMESTAMP=$(date +"%Y%m%d_%H%M%S")
-BACKUP_FILE="${BACKUP_DIR}/db_backup_${TIMESTAMP}.sqlite3"
+BACKUP_DIR="${BACKUP_ROOT}/${TIMESTAMP}"
 
-# Create backup directory if it doesn't exist
+# Create backup directory
 mkdir -p "$BACKUP_DIR"
 
-# Check if database file exists
-if [ ! -f "$DB_FILE" ]; then
-    echo "❌ Database file $DB_FILE not found!"
-    exit 1
-fi
-
-# Create backup
-echo "📦 Creating backup of $DB_FILE..."
-cp "$DB_FILE" "$BACKUP_FILE"
+# Create backup; written through standard output so MANAGE may run in a container.
+# Content types and permissions are recreated by migrate, the rest refers to them by natural key
+set -o pipefail
+echo "📦 Dumping database..."
+$MANAGE dumpdata --natural-foreign --natural-primary \
+    --exclude contenttypes --exclude auth.Permission --exclude website.Paste \
+    | gzip > "$BACKUP_DIR/data.json.gz" \
+    && echo "📦 Exporting pastes..." \
+    && $MANAGE export_pastes - > "$BACKUP_DIR/pastes.ndjson.gz"
 
 if [ $? -eq 0 ]; then
-    echo "✅ Backup created successfully: $BACKUP_FILE"
-    
+    echo "✅ Backup created successfully: $BACKUP_DIR"
+
     # Show backup size
-    BACKUP_SIZE=$(du -h "$BACKUP_FILE" | cut -f1)
+    BACKUP_SIZE=$(du -sh "$BACKUP_DIR" | cut -f1)
     echo "📊 Backup size: $BACKUP_SIZE"
-    
+
     # Keep only last 10 backups
     echo "🧹 Cleaning old backups (keeping last 10)..."
-    ls -t "$BACKUP_DIR"/db_backup_*.sqlite3 | tail -n +11 | xargs -r rm
-    
+    ls -dt "$BACKUP_ROOT"/*/ | tail -n +11 | xargs -r rm -r
+
     echo "🎉 Backup completed successfully!"
 else
+    rm -rf "$BACKUP_DIR"
     echo "❌ Backup failed!"
     exit 1
-fi 
\ No newline at end of file
+fi
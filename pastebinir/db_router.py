@@ -0,0 +1,103 @@
+"""
+Read-replica routing.
+
+Views marked with replica_reads() run outside ATOMIC_REQUESTS, and their
+reads go to a random alias from DATABASE_REPLICAS when the request is a GET
+or HEAD. Everything else, and every write, uses the primary ("default").
+Marked views may still write (the paste views count views and delete used up
+pastes); each write commits on its own, and switches the rest of the request
+to the primary. Reads stay on the primary:
+
+* for the rest of a request once it has written anything, and
+* for REPLICA_STICKY_SECONDS after a client made a successful unsafe request
+  (a paste create, say), through a short-lived cookie. Clients therefore read
+  their own writes even when the replicas lag.
+
+Without replicas configured only the non-atomic part applies.
+"""
+import contextvars
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import transaction
+
+from .ratelimit import resolved
+
+PRIMARY = 'default'
+STICKY_COOKIE = 'dbprimary'
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+
+
+def replica_reads(view):
+    """
+    Run view outside ATOMIC_REQUESTS and allow its reads to use a replica
+    until it first writes
+    """
+    view = transaction.non_atomic_requests(view)
+    view.replica_reads = True
+    return view
+
+
+def using_replica():
+    return _use_replica.get()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        # Later reads of this request must see what it wrote
+        _use_replica.set(False)
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        return self.process_response(request, await self.get_response(request))
+
+    def process_request(self, request):
+        match = resolved(request)
+        _use_replica.set(
+            bool(settings.DATABASE_REPLICAS)
+            and request.method in ('GET', 'HEAD')
+            and match is not None and getattr(match.func, 'replica_reads', False)
+            and STICKY_COOKIE not in request.COOKIES
+        )
+
+    def process_response(self, request, response):
+        _use_replica.set(False)
+        if (settings.DATABASE_REPLICAS and request.method not in ('GET', 'HEAD', 'OPTIONS')
+                and response.status_code < 400):
+            response.set_cookie(
+                STICKY_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        return response
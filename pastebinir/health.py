@@ -0,0 +1,144 @@
+"""
+Liveness and readiness probes.
+
+/health/live/ answers from the event loop without touching anything else: a
+worker that can run it is alive. /health/ready/ checks the dependencies (every
+database, the cache, the Redis instances of the optional features, pending
+migrations) in parallel on a small thread pool. It gives up on checks still
+running after HEALTH_READINESS_TIMEOUT seconds, and reuses its result for
+HEALTH_READINESS_CACHE_SECONDS, so frequent probing costs at most one round of
+checks per worker every few seconds and a hung dependency never blocks a
+worker.
+
+Optional features fail open when their Redis is down, so those checks are
+reported but do not make the worker unready.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import JsonResponse
+
+# Not needed for readiness, see the module docstring
+OPTIONAL_REDIS_URLS = (
+    'CHATBOT_ADMISSION_REDIS_URL',
+    'PASTE_WRITE_BEHIND_REDIS_URL',
+    'PASTE_CACHE_INVALIDATION_REDIS_URL',
+    'RATE_LIMIT_REDIS_URL',
+)
+
+# Checks stuck on a dead dependency hold at most these threads
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='readiness')
+_result = None
+_running = None
+_migrations_applied = False
+
+
+def check_database(alias):
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    finally:
+        # Pool threads must not keep connections (or pool slots) between checks
+        connection.close()
+
+
+def check_cache():
+    cache.set(settings.HEALTHCHECK_CACHE_KEY, 'ok', 10)
+    if cache.get(settings.HEALTHCHECK_CACHE_KEY) != 'ok':
+        raise RuntimeError('value written to the cache could not be read back')
+
+
+def check_redis(url):
+    client = redis.Redis.from_url(
+        url, socket_timeout=settings.HEALTH_READINESS_TIMEOUT,
+        socket_connect_timeout=settings.HEALTH_READINESS_TIMEOUT,
+    )
+    try:
+        client.ping()
+    finally:
+        client.close()
+
+
+def check_migrations():
+    global _migrations_applied
+    if _migrations_applied:
+        # Loading the migration graph is slow; once applied they stay applied
+        return
+    try:
+        executor = MigrationExecutor(connections['default'])
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            raise RuntimeError('unapplied migrations')
+    finally:
+        connections['default'].close()
+    _migrations_applied = True
+
+
+def readiness_checks():
+    """{name: (check, critical)}"""
+    checks = {
+        f'database:{alias}': (lambda alias=alias: check_database(alias), True)
+        for alias in settings.DATABASES
+    }
+    checks['cache'] = (check_cache, True)
+    checks['migrations'] = (check_migrations, True)
+    urls = {getattr(settings, name, None) for name in OPTIONAL_REDIS_URLS} - {None}
+    for url in sorted(urls):
+        checks[f'redis:{url.rsplit("@", 1)[-1]}'] = (lambda url=url: check_redis(url), False)
+    return checks
+
+
+async def _run_checks():
+    global _result
+    loop = asyncio.get_running_loop()
+    checks = readiness_checks()
+    futures = {name: loop.run_in_executor(_executor, check) for name, (check, _) in checks.items()}
+    _, pending = await asyncio.wait(futures.values(), timeout=settings.HEALTH_READINESS_TIMEOUT)
+    results = {}
+    ready = True
+    for name, future in futures.items():
+        if future in pending:
+            # Retrieved later so a late failure is not logged as unhandled
+            future.add_done_callback(lambda f: f.exception())
+            status = 'timed out'
+        elif future.exception() is not None:
+            status = f'{type(future.exception()).__name__}: {future.exception()}'
+        else:
+            status = 'ok'
+        results[name] = status
+        if status != 'ok' and checks[name][1]:
+            ready = False
+    _result = (time.monotonic(), ready, results)
+    return _result
+
+
+async def readiness():
+    """(checked at, ready, {check: status}), from the last few seconds if possible"""
+    global _running
+    if _result is not None and time.monotonic() - _result[0] < settings.HEALTH_READINESS_CACHE_SECONDS:
+        return _result
+    loop = asyncio.get_running_loop()
+    # Concurrent probes share one round of checks
+    if _running is None or _running.done() or _running.get_loop() is not loop:
+        _running = loop.create_task(_run_checks())
+    return await asyncio.shield(_running)
+
+
+@transaction.non_atomic_requests
+async def live(request):
+    return JsonResponse({'status': 'ok'})
+
+
+@transaction.non_atomic_requests
+async def ready(request):
+    checked, is_ready, results = await readiness()
+    return JsonResponse(
+        {'status': 'ok' if is_ready else 'unavailable', 'age': round(time.monotonic() - checked, 1), 'checks': results},
+        status=200 if is_ready else 503,
+    )
@@ -0,0 +1,203 @@
+"""
+Prometheus metrics, served at /metrics to private and loopback addresses.
+
+Gunicorn runs several worker processes, and the scheduler runs in its own
+container. When PROMETHEUS_MULTIPROC_DIR is set (the entrypoint empties it on
+boot), every process writes its samples to memory-mapped files there, and
+/metrics adds up the files of that directory and of METRICS_EXTRA_DIRS (the
+scheduler's directory on the shared metrics volume). Without it, as under
+runserver, the metrics of the current process are served.
+
+Only counters and histograms are used: their files stay valid after a worker
+exits, so restarted workers need no clean-up.
+"""
+import glob
+import ipaddress
+import os
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from api.admission import client_ip
+
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+MAX_LOGGED_QUERIES = 1000  # per request, see RequestStats.log
+
+REQUEST_LATENCY = Histogram(
+    'pastebinir_request_duration_seconds',
+    'Time until the response is returned (headers, for streaming responses), by view',
+    ['view', 'method', 'status'],
+)
+REQUEST_DB_QUERIES = Histogram(
+    'pastebinir_request_db_queries',
+    'SQL queries run per request, by view',
+    ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+REQUEST_DB_SECONDS = Histogram(
+    'pastebinir_request_db_seconds',
+    'Time spent in SQL queries per request, by view',
+    ['view'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+CACHE_LOOKUPS = Counter(
+    'pastebinir_cache_lookups',
+    'Cache lookups by cache and result (hit or miss)',
+    ['cache', 'result'],
+)
+KEY_DERIVATION_SECONDS = Histogram(
+    'pastebinir_key_derivation_seconds',
+    'Time to derive a paste key from its password (PBKDF2)',
+    buckets=(0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1),
+)
+LANGUAGE_DETECTION_SECONDS = Histogram(
+    'pastebinir_language_detection_seconds',
+    'Time to detect the language of a paste',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+CHATBOT_FIRST_TOKEN_SECONDS = Histogram(
+    'pastebinir_chatbot_first_token_seconds',
+    'Time from the start of a chatbot stream to its first answer chunk',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60),
+)
+CLEANUP_BATCH_PASTES = Histogram(
+    'pastebinir_cleanup_batch_pastes',
+    'Pastes deleted per expired paste clean-up',
+    buckets=(0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+)
+
+
+def cache_lookup(cache, hit):
+    """Count a lookup in the named cache"""
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+class RequestStats:
+    __slots__ = ('queries', 'seconds', 'log')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        # [{'sql', 'seconds', 'alias'}] while a profiler wants the queries
+        self.log = None
+
+
+# Shared by reference with the threads sync_to_async runs ORM calls in
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.queries += 1
+        stats.seconds += elapsed
+        if stats.log is not None and len(stats.log) < MAX_LOGGED_QUERIES:
+            # Without parameters, they may hold paste contents
+            stats.log.append({'sql': sql, 'seconds': elapsed, 'alias': context['connection'].alias})
+
+
+def current_request_stats():
+    """The RequestStats of the request being handled, or None outside MetricsMiddleware"""
+    return _request_stats.get()
+
+
+@receiver(connection_created)
+def _instrument_connection(sender, connection, **kwargs):
+    # Fired again whenever the connection reopens
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class MetricsMiddleware:
+    """Records latency and SQL per request; goes first in MIDDLEWARE"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self._observe(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self._observe(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def _observe(self, request, response, stats, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        # Label values must come from a small set
+        method = request.method if request.method in METHODS else 'other'
+        REQUEST_LATENCY.labels(view, method, response.status_code).observe(elapsed)
+        REQUEST_DB_QUERIES.labels(view).observe(stats.queries)
+        REQUEST_DB_SECONDS.labels(view).observe(stats.seconds)
+
+
+class _DirectoriesCollector:
+    """Adds up the metric files of several multiprocess directories"""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def collect(self):
+        files = [name for path in self.paths for name in glob.glob(os.path.join(path, '*.db'))]
+        return MultiProcessCollector.merge(files, accumulate=True)
+
+
+def registry():
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not directory:
+        return REGISTRY
+    collected = CollectorRegistry()
+    collected.register(_DirectoriesCollector([directory, *settings.METRICS_EXTRA_DIRS]))
+    return collected
+
+
+def is_internal(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return address.is_private or address.is_loopback
+
+
+@transaction.non_atomic_requests
+def metrics(request):
+    # Scraped from inside the deployment; nginx passes the public address in X-Real-IP
+    if not is_internal(client_ip(request)):
+        raise Http404
+    return HttpResponse(generate_latest(registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,274 @@
+"""
+Opt-in request profiling.
+
+A request is profiled when it is picked at random (PROFILING_SAMPLE_RATE, 0 by
+default) or when a staff user sends the PROFILING_HEADER header. While it
+runs, a background thread samples its Python stack every PROFILING_INTERVAL
+seconds, and the SQL it executes is logged (through the query wrapper of
+pastebinir/metrics.py). Sampled requests slower than PROFILING_SLOW_THRESHOLD
+seconds, and every requested one, are stored as a RequestProfile; the admin
+shows their queries and offers the stacks as pstats or speedscope JSON.
+Requested profiles also get their ID in an X-Profile-Id response header.
+
+Under ASGI a request runs partly on the event loop, shared with other
+requests, and partly in its own thread for sync code (sync views, ORM calls).
+Each sample takes the loop thread's stack while the request's task is the one
+running there, else the request thread's stack while it is busy, else counts
+as <awaiting> (I/O, other tasks, or asyncio.to_thread work).
+
+Profiling off costs a header lookup per request.
+"""
+import asyncio
+import json
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from website.models import RequestProfile
+
+from .metrics import current_request_stats
+
+MAX_DEPTH = 128
+AWAITING = ('~', 0, '<awaiting>')
+
+
+def _idle(frame):
+    """Whether frame is an executor thread waiting for work"""
+    code = frame.f_code
+    return code.co_name == '_worker' and code.co_filename.endswith(os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of one request until stop()"""
+
+    def __init__(self, interval, loop=None, task=None):
+        super().__init__(name='profiler', daemon=True)
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.loop = loop
+        self.task = task
+        self.sync_thread_id = None
+        self.frames = []  # [(file, first line, function)]
+        self.frame_index = {}
+        self.samples = []  # [[frame indexes, root first]]
+        self.weights = []  # seconds per sample
+        self.stopped = threading.Event()
+
+    def add_sync_thread(self):
+        """Called from the thread the request's sync code runs in"""
+        self.sync_thread_id = threading.get_ident()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            self._sample(now - last)
+            last = now
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def _frame(self, key):
+        index = self.frame_index.get(key)
+        if index is None:
+            index = self.frame_index[key] = len(self.frames)
+            self.frames.append(key)
+        return index
+
+    def _sample(self, weight):
+        frames = sys._current_frames()
+        frame = None
+        if self.task is None or asyncio.current_task(self.loop) is self.task:
+            frame = frames.get(self.thread_id)
+        elif self.sync_thread_id is not None:
+            frame = frames.get(self.sync_thread_id)
+            if frame is not None and _idle(frame):
+                frame = None
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            stack.append(self._frame((code.co_filename, code.co_firstlineno, code.co_name)))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples.append(stack or [self._frame(AWAITING)])
+        self.weights.append(weight)
+
+    def stacks(self):
+        return {'interval': self.interval, 'frames': self.frames, 'samples': self.samples, 'weights': self.weights}
+
+
+def to_speedscope(profile):
+    """Stacks of a RequestProfile in the speedscope file format"""
+    stacks = profile.stacks
+    name = f'{profile.method} {profile.path}'
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'pastebinir',
+        'activeProfileIndex': 0,
+        'shared': {'frames': [{'name': function, 'file': file, 'line': line} for file, line, function in stacks['frames']]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(stacks['weights']),
+            'samples': stacks['samples'],
+            'weights': stacks['weights'],
+        }],
+    }).encode()
+
+
+def to_pstats(profile):
+    """
+    Stacks of a RequestProfile as a marshalled pstats file, for pstats.Stats or
+    snakeviz. Call counts are sample counts.
+    """
+    stacks = profile.stacks
+    frames = [tuple(frame) for frame in stacks['frames']]
+    # function: [primitive calls, calls, own time, cumulative time, {caller: [same]}]
+    stats = {}
+    for sample, weight in zip(stacks['samples'], stacks['weights']):
+        keys = [frames[index] for index in sample]
+        seen = set()
+        for depth, key in enumerate(keys):
+            entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+            own = weight if depth == len(keys) - 1 else 0.0
+            entry[2] += own
+            if depth:
+                caller = entry[4].setdefault(keys[depth - 1], [0, 0, 0.0, 0.0])
+                caller[0] += 1
+                caller[1] += 1
+                caller[2] += own
+                caller[3] += weight
+            # Recursive frames count once towards cumulative time
+            if key not in seen:
+                seen.add(key)
+                entry[0] += 1
+                entry[1] += 1
+                entry[3] += weight
+    return marshal.dumps({
+        key: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+        for key, (cc, nc, tt, ct, callers) in stats.items()
+    })
+
+
+def save_profile(request, response, reason, duration, sampler, queries, query_count, query_seconds):
+    """
+    Store a RequestProfile. queries is the log, which stops at
+    MAX_LOGGED_QUERIES; query_count and query_seconds cover every query.
+    """
+    match = getattr(request, 'resolver_match', None)
+    profile = RequestProfile.objects.create(
+        method=request.method[:10],
+        path=request.get_full_path()[:2048],
+        view=match.view_name if match is not None else '',
+        status=response.status_code,
+        duration=duration,
+        reason=reason,
+        query_count=query_count,
+        query_seconds=query_seconds,
+        stacks=sampler.stacks(),
+        queries=queries,
+    )
+    # Keep the newest PROFILING_MAX_STORED
+    oldest_kept = RequestProfile.objects.order_by('-id').values_list('id', flat=True)[
+        settings.PROFILING_MAX_STORED - 1:settings.PROFILING_MAX_STORED]
+    RequestProfile.objects.filter(id__lt=oldest_kept).delete()
+    return profile
+
+
+class ProfilingMiddleware:
+    """Goes after AuthenticationMiddleware, which requested profiles need"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.header = 'HTTP_' + settings.PROFILING_HEADER.upper().replace('-', '_')
+
+    def _sampled(self):
+        return settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.header in request.META and request.user.is_staff:
+            reason = RequestProfile.REQUESTED
+        elif self._sampled():
+            reason = RequestProfile.SAMPLED
+        else:
+            return self.get_response(request)
+        sampler, queries, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            duration, query_count, query_seconds = self._stop(sampler, queries, started)
+        if self._keep(reason, duration):
+            profile = save_profile(request, response, reason, duration, sampler, queries, query_count, query_seconds)
+            self._finish(response, reason, profile)
+        return response
+
+    async def __acall__(self, request):
+        if self.header in request.META and (await request.auser()).is_staff:
+            reason = RequestProfile.REQUESTED
+        elif self._sampled():
+            reason = RequestProfile.SAMPLED
+        else:
+            return await self.get_response(request)
+        sampler, queries, started = self._start(asyncio.get_running_loop(), asyncio.current_task())
+        # The request's sync code runs in this thread too
+        await sync_to_async(sampler.add_sync_thread, thread_sensitive=True)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            duration, query_count, query_seconds = self._stop(sampler, queries, started)
+        if self._keep(reason, duration):
+            profile = await sync_to_async(save_profile)(
+                request, response, reason, duration, sampler, queries, query_count, query_seconds,
+            )
+            self._finish(response, reason, profile)
+        return response
+
+    def _start(self, loop=None, task=None):
+        queries = []
+        stats = current_request_stats()
+        if stats is not None:
+            stats.log = queries
+        sampler = Sampler(settings.PROFILING_INTERVAL, loop, task)
+        sampler.start()
+        return sampler, queries, (time.perf_counter(), *self._query_totals(queries))
+
+    def _stop(self, sampler, queries, started):
+        """Duration, query count and query time since _start()"""
+        duration = time.perf_counter() - started[0]
+        sampler.stop()
+        query_count, query_seconds = self._query_totals(queries)
+        stats = current_request_stats()
+        if stats is not None:
+            stats.log = None
+        return duration, query_count - started[1], query_seconds - started[2]
+
+    def _query_totals(self, queries):
+        """Queries run so far and their time; unlike the log, the request stats are not capped"""
+        stats = current_request_stats()
+        if stats is None:
+            return len(queries), sum(query['seconds'] for query in queries)
+        return stats.queries, stats.seconds
+
+    def _keep(self, reason, duration):
+        return reason == RequestProfile.REQUESTED or duration >= settings.PROFILING_SLOW_THRESHOLD
+
+    def _finish(self, response, reason, profile):
+        if reason == RequestProfile.REQUESTED:
+            response['X-Profile-Id'] = str(profile.pk)
@@ -0,0 +1,161 @@
+"""
+Per-client rate limiting shared by every app node.
+
+Each client IP has one token bucket per route class (create, view, api,
+chatbot) in Redis, updated by a Lua script so a request costs exactly one
+round trip. Limits come from RATE_LIMITS. When Redis is unreachable or slow,
+requests are let through and Redis is left alone for RATE_LIMIT_BACKOFF
+seconds.
+"""
+import logging
+import time
+
+import redis
+import redis.asyncio as aredis
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+
+from api.admission import client_ip
+
+logger = logging.getLogger(__name__)
+
+# KEYS: bucket; ARGV: capacity, tokens per second
+# Returns {allowed, tokens left, seconds until the next token}
+_TAKE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, math.floor(tokens), math.ceil((1 - tokens) / rate)}
+"""
+
+CREATE_VIEWS = {'create_paste', 'paste-list-create', 'paste-batch-create'}
+PASTE_VIEWS = {'view_encrypted_paste', 'view_raw_paste'}
+
+
+def resolved(request):
+    """
+    The ResolverMatch of request, or None when no view matches. Resolved once
+    and shared by the middleware that needs the view before Django resolves it.
+    """
+    try:
+        return request._resolved
+    except AttributeError:
+        pass
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        match = None
+    request._resolved = match
+    return match
+
+
+def route_of(request):
+    """Which RATE_LIMITS entry applies to request, or None"""
+    match = resolved(request)
+    if match is None:
+        return None
+    name = match.url_name
+    if name == 'chatbot':
+        return 'chatbot'
+    if request.method == 'POST' and name in CREATE_VIEWS:
+        return 'create'
+    if request.path_info.startswith('/api/'):
+        return 'api'
+    if name in PASTE_VIEWS:
+        return 'view'
+    return None
+
+
+class RateLimitMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.client = None
+        self.script = None
+        self.down_until = 0.0
+
+    def _connect(self):
+        options = {
+            'socket_timeout': settings.RATE_LIMIT_REDIS_TIMEOUT,
+            'socket_connect_timeout': settings.RATE_LIMIT_REDIS_TIMEOUT,
+        }
+        module = aredis if self.async_mode else redis
+        self.client = module.Redis.from_url(settings.RATE_LIMIT_REDIS_URL, **options)
+        self.script = self.client.register_script(_TAKE)
+
+    def _bucket(self, request):
+        """(route, key, capacity, rate) of the bucket request draws from, or None"""
+        if not settings.RATE_LIMIT_ENABLED or not settings.RATE_LIMIT_REDIS_URL:
+            return None
+        if time.monotonic() < self.down_until:
+            return None
+        route = route_of(request)
+        if route is None or route not in settings.RATE_LIMITS:
+            return None
+        ip = client_ip(request)
+        if ip in settings.RATE_LIMIT_EXEMPT_IPS:
+            return None
+        requests, window = settings.RATE_LIMITS[route]
+        if self.client is None:
+            self._connect()
+        return route, f'ratelimit:{route}:{ip}', requests, requests / window
+
+    def _failed(self, e):
+        logger.warning(f"Rate limiter unavailable, not limiting for {settings.RATE_LIMIT_BACKOFF}s: {e}")
+        self.down_until = time.monotonic() + settings.RATE_LIMIT_BACKOFF
+
+    def _rejected(self, request, route, retry_after):
+        logger.info(f"Rate limited {client_ip(request)} on {route}")
+        if request.path_info.startswith('/api/'):
+            response = JsonResponse({"error": "Too many requests."}, status=429)
+        else:
+            response = HttpResponse("Too many requests, please slow down.", status=429, content_type='text/plain')
+        response['Retry-After'] = str(max(1, retry_after))
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        bucket = self._bucket(request)
+        if bucket is not None:
+            route, key, capacity, rate = bucket
+            try:
+                allowed, _, retry_after = self.script(keys=[key], args=[capacity, rate])
+            except (redis.RedisError, OSError) as e:
+                self._failed(e)
+            else:
+                if not allowed:
+                    return self._rejected(request, route, retry_after)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        bucket = self._bucket(request)
+        if bucket is not None:
+            route, key, capacity, rate = bucket
+            try:
+                allowed, _, retry_after = await self.script(keys=[key], args=[capacity, rate])
+            except (redis.RedisError, OSError) as e:
+                self._failed(e)
+            else:
+                if not allowed:
+                    return self._rejected(request, route, retry_after)
+        return await self.get_response(request)
@@ -0,0 +1,50 @@
+"""
+Session middleware that leaves the anonymous read path alone.
+
+GET and HEAD requests to the views named in SESSIONLESS_VIEWS get an empty,
+never-saved session instead of the stored one: nothing is read from or
+written to the session store, and no session cookie is set. Those views do
+not depend on who is logged in; CSRF protection of their forms uses Django's
+double-submit cookie (CSRF_USE_SESSIONS = False), which needs no session.
+Requests asking to be profiled keep their session.
+
+Under ASGI only requests with a session take a thread hop, to save it.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+
+from .ratelimit import resolved
+
+
+def is_sessionless(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if settings.PROFILING_HEADER in request.headers:
+        # Only staff may ask for a profile, see pastebinir/profiling.py
+        return False
+    match = resolved(request)
+    return match is not None and match.url_name in settings.SESSIONLESS_VIEWS
+
+
+class SelectiveSessionMiddleware(SessionMiddleware):
+    def process_request(self, request):
+        if is_sessionless(request):
+            # A store without a key never loads; the user is anonymous
+            request.session = self.SessionStore(None)
+            request.sessionless = True
+            return
+        super().process_request(request)
+
+    async def __acall__(self, request):
+        # Creating the store does no I/O, the session loads on first access
+        self.process_request(request)
+        response = await self.get_response(request)
+        if getattr(request, 'sessionless', False):
+            return response
+        return await sync_to_async(self.process_response, thread_sensitive=True)(request, response)
+
+    def process_response(self, request, response):
+        if getattr(request, 'sessionless', False):
+            return response
+        return super().process_response(request, response)
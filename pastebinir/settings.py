@@ -58,11 +58,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pastebinir.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'pastebinir.ratelimit.RateLimitMiddleware',
+    'pastebinir.sessions.SelectiveSessionMiddleware',
+    'pastebinir.db_router.ReplicaRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'pastebinir.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -91,25 +95,55 @@ WSGI_APPLICATION = 'pastebinir.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
-DATABASES = {
-    "default": {
+DB_POOL = env("DB_POOL", default="true").lower() == "true"
+
+
+def database(host, port):
+    config = {
         "ENGINE": "django.db.backends.postgresql",
         "NAME": env("POSTGRES_NAME", default="postgres"),
         "USER": env("POSTGRES_USER", default="postgres"),
         "PASSWORD": env("POSTGRES_PASSWORD", default="postgres"),
-        "HOST": env("POSTGRES_HOST", default="localhost"),
-        "PORT": 5432,
+        "HOST": host,
+        "PORT": int(port),
+        "OPTIONS": {},
+    }
+    if DB_POOL:
+        # psycopg pool per worker process; it replaces persistent connections
+        # (Django refuses CONN_MAX_AGE with a pool) and checks connections itself
+        config["CONN_MAX_AGE"] = 0
+        config["OPTIONS"]["pool"] = {
+            "min_size": int(env("DB_POOL_MIN_SIZE", 2)),
+            "max_size": int(env("DB_POOL_MAX_SIZE", 10)),  # at least the worker's thread count
+            "timeout": float(env("DB_POOL_TIMEOUT", 10)),  # seconds to wait for a free connection
+            "max_lifetime": float(env("DB_POOL_MAX_LIFETIME", 1800)),
+            "max_idle": float(env("DB_POOL_MAX_IDLE", 300)),
+        }
+    else:
         # Keep DB connections alive for a short time and health-check before use
         # Helps auto-recover from "[BAD]" connections after PostgreSQL restarts or network hiccups
-        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", 60)),
-        "CONN_HEALTH_CHECKS": True,
+        config["CONN_MAX_AGE"] = int(env("DB_CONN_MAX_AGE", 60))
+        config["CONN_HEALTH_CHECKS"] = True
+    return config
+
+
+DATABASES = {
+    "default": {
+        **database(env("POSTGRES_HOST", default="localhost"), env("POSTGRES_PORT", default=5432)),
+        # Views marked replica_reads() opt out, see pastebinir/db_router.py
         "ATOMIC_REQUESTS": True,
-        "OPTIONS": {
-            "pool": {"max_lifetime": 60},
-        },
-    }
+    },
 }
 
+# Optional read replicas as "host[:port],host[:port]", same credentials as the primary
+DATABASE_REPLICAS = []
+for index, address in enumerate(filter(None, env("POSTGRES_REPLICA_HOSTS", default="").split(","))):
+    host, _, port = address.strip().partition(":")
+    DATABASES[f"replica_{index}"] = {**database(host, port or 5432), "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append(f"replica_{index}")
+DATABASE_ROUTERS = ["pastebinir.db_router.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = int(env("REPLICA_STICKY_SECONDS", 15))  # reads stay on the primary after a write
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -152,6 +186,11 @@ REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS" : "drf_spectacular.openapi.AutoSchema",
 }
 
+# REST API list pagination
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+API_BATCH_MAX_SIZE = 100  # pastes per batch create or fetch request
+
 SPECTACULAR_SETTINGS = {
     "TITLE" : "Pasted IR Documentation",
     "DESCRIPTION": "A simple django based pastebin",
@@ -165,11 +204,17 @@ SESSION_COOKIE_SAMESITE = 'Strict'  # Prevent CSRF attacks
 SESSION_COOKIE_AGE = 3600  # Session expires in 1 hour (3600 seconds)
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True  # Session expires when browser closes
 SESSION_SAVE_EVERY_REQUEST = True  # Update session on every request
+# Anonymous GETs of these views skip the session store entirely, see pastebinir/sessions.py
+SESSIONLESS_VIEWS = {
+    'home', 'create_paste', 'history', 'about', 'view_encrypted_paste', 'view_raw_paste', 'health_live', 'health_ready',
+    'metrics',
+}
 
 # CSRF Security
 CSRF_COOKIE_SECURE = True  # Only send CSRF cookies over HTTPS
 CSRF_COOKIE_HTTPONLY = False  # Allow JavaScript access to CSRF token (needed for forms)
 CSRF_COOKIE_SAMESITE = 'Lax'  # Allow CSRF tokens for same-site requests
+CSRF_USE_SESSIONS = False  # Double-submit cookie, forms never need a session
 CSRF_TRUSTED_ORIGINS = ['https://pasted.ir', 'https://www.pasted.ir']
 
 # Security settings for static files
@@ -183,10 +228,21 @@ SECURE_HSTS_INCLUDE_SUBDOMAINS = True
 SECURE_HSTS_PRELOAD = True
 SECURE_REFERRER_POLICY = 'strict-origin-when-cross-origin'
 
-# Rate limiting
+# Rate limiting, see pastebinir/ratelimit.py
 RATE_LIMIT_ENABLED = True
 RATE_LIMIT_REQUESTS = 100  # requests per hour
 RATE_LIMIT_WINDOW = 3600  # 1 hour
+# Per route (requests, window in seconds): a client may burst up to requests,
+# after which tokens come back at requests / window per second
+RATE_LIMITS = {
+    'create': (RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW),
+    'view': (300, 60),
+    'api': (120, 60),
+    'chatbot': (20, 60),
+}
+RATE_LIMIT_EXEMPT_IPS = [ip for ip in env("RATE_LIMIT_EXEMPT_IPS", "").split(",") if ip]  # e.g. the Telegram bot host
+RATE_LIMIT_REDIS_TIMEOUT = 0.1  # seconds, slower Redis answers let the request through
+RATE_LIMIT_BACKOFF = 5  # seconds without rate limiting after Redis failed
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
@@ -197,6 +253,14 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
 
+# Hashed file names (safe to cache forever) with .gz and .br copies for nginx
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "pastebinir.storage.CompressedManifestStaticFilesStorage"},
+}
+# Collected into the image at build time and copied to STATIC_ROOT on boot
+STATIC_BUILD_ROOT = BASE_DIR / 'staticfiles-build'
+
 # Static files finders
 STATICFILES_FINDERS = [
     'django.contrib.staticfiles.finders.FileSystemFinder',
@@ -204,8 +268,6 @@ STATICFILES_FINDERS = [
 ]
 
 # Cache configuration
-import os
-
 # Use Redis if available, otherwise fall back to local memory
 if os.environ.get('REDIS_HOST', 'redis') == 'redis':
     CACHES = {
@@ -218,6 +280,12 @@ if os.environ.get('REDIS_HOST', 'redis') == 'redis':
             'TIMEOUT': 300,  # 5 minutes default
         }
     }
+    CHATBOT_ADMISSION_REDIS_URL = 'redis://redis:6379/1'
+    PASTE_WRITE_BEHIND_REDIS_URL = 'redis://redis:6379/2'
+    PASTE_CACHE_INVALIDATION_REDIS_URL = 'redis://redis:6379/1'
+    RATE_LIMIT_REDIS_URL = 'redis://redis:6379/1'
+    # Sessions (admin and API logins) live in Redis, saving one costs no SQL
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 else:
     # Fallback to local memory cache for development
     CACHES = {
@@ -230,10 +298,72 @@ else:
             }
         }
     }
-
-# Cache languages for better performance
-LANGUAGE_CACHE_KEY = 'all_languages'
-LANGUAGE_CACHE_TIMEOUT = 3600  # 1 hour
+    # No shared store: admit every chatbot stream, insert pastes directly,
+    # read them from the database every time and do not rate limit
+    CHATBOT_ADMISSION_REDIS_URL = None
+    PASTE_WRITE_BEHIND_REDIS_URL = None
+    PASTE_CACHE_INVALIDATION_REDIS_URL = None
+    RATE_LIMIT_REDIS_URL = None
+    # Local memory is per process, so sessions need the database behind it
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Server-side paste history, see website/history.py
+HISTORY_MAX_ENTRIES = 100  # per client, oldest entries are dropped
+HISTORY_PAGE_SIZE = 20
+HISTORY_COOKIE_AGE = 31536000  # 1 year
+
+# Paste row cache, see website/paste_cache.py
+PASTE_ROW_CACHE_TIMEOUT = 60 * 60  # shared (Redis) tier
+PASTE_ROW_TOMBSTONE_TIMEOUT = 60  # seconds a deleted paste's row may not be cached again; longer than any DB read
+PASTE_LOCAL_CACHE_ENTRIES = 1000  # per process
+PASTE_LOCAL_CACHE_MAX_BYTES = 32 * 1024 * 1024  # per process, counted on paste bodies
+PASTE_LOCAL_CACHE_TTL = 60  # seconds, in case an invalidation message is lost
+PASTE_VIEW_COUNT_FLUSH_INTERVAL = 5  # seconds view counts of cached pastes are buffered
+
+# Precompressed paste pages, see website/compressed_pages.py
+PASTE_PAGE_CACHE_TIMEOUT = 60 * 60
+PASTE_PAGE_CACHE_MAX_BYTES = 4 * 1024 * 1024  # compressed; larger pages are compressed per request
+PASTE_PAGE_MIN_COMPRESS_SIZE = 1024  # bytes, smaller pages are sent as they are
+PASTE_PAGE_BROTLI_QUALITY = 9  # 11 compresses a little better but several times slower
+PASTE_PAGE_GZIP_LEVEL = 9
+
+# Write-behind paste creation, see website/write_behind.py
+PASTE_WRITE_BEHIND = env("PASTE_WRITE_BEHIND", default="false").lower() == "true"
+PASTE_WRITE_BEHIND_BATCH_SIZE = 500  # pastes per bulk insert
+PASTE_WRITE_BEHIND_CLAIM_IDLE = 300  # seconds before another flusher takes over unacknowledged pastes
+
+# In-process language registry, see website/languages.py
+LANGUAGE_REGISTRY_CHECK_INTERVAL = 5  # seconds between version checks against the shared cache
+LANGUAGE_REGISTRY_MAX_AGE = 3600  # reload regardless, covers changes made without signals
+
+# Cache completed chatbot answers for repeated questions about a paste
+CHATBOT_ANSWER_CACHE_TIMEOUT = int(os.getenv("CHATBOT_ANSWER_CACHE_TIMEOUT", 24 * 3600))
+CHATBOT_ANSWER_CACHE_MAX_SIZE = 64 * 1024  # characters, larger answers are not cached
+CHATBOT_ANSWER_CACHE_MAX_PER_PASTE = 20  # oldest answers are evicted first
+
+# Only the parts of large pastes most relevant to the question are sent to the chatbot
+CHATBOT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHATBOT_CONTEXT_TOKEN_BUDGET", 3000))
+CHATBOT_CONTEXT_CHUNK_LINES = 40
+
+# Chatbot provider routing, see api/provider_router.py
+CHATBOT_PROVIDERS = [name.strip() for name in env("CHATBOT_PROVIDERS", "Phind,FreeChatgpt,Liaobots,OpenaiChat").split(",") if name.strip()]
+CHATBOT_PROVIDER_WINDOW = 300  # seconds of latency / error history per provider
+CHATBOT_CIRCUIT_ERROR_RATE = 0.5  # open the circuit at this error rate...
+CHATBOT_CIRCUIT_MIN_REQUESTS = 4  # ...once the window holds this many requests
+CHATBOT_CIRCUIT_COOLDOWN = 60  # seconds before an open circuit lets a trial request through
+CHATBOT_FIRST_TOKEN_TIMEOUT = 30  # seconds before giving up on a provider
+CHATBOT_HEDGE_AFTER = float(os.getenv("CHATBOT_HEDGE_AFTER", 0))  # seconds, 0 disables hedging
+
+# Chatbot stream admission control, see api/admission.py
+CHATBOT_ADMISSION_ENABLED = True
+CHATBOT_MAX_STREAMS = int(os.getenv("CHATBOT_MAX_STREAMS", 200))  # across all workers and nodes
+CHATBOT_MAX_STREAMS_PER_CLIENT = int(os.getenv("CHATBOT_MAX_STREAMS_PER_CLIENT", 3))  # per client IP
+CHATBOT_ADMISSION_QUEUE_SIZE = 50  # requests allowed to wait for a free slot
+CHATBOT_ADMISSION_MAX_WAIT = 3  # seconds a request may wait before being rejected
+CHATBOT_ADMISSION_POLL_INTERVAL = 0.1  # seconds between slot checks while waiting
+CHATBOT_ADMISSION_REDIS_TIMEOUT = 0.1  # seconds, slower Redis answers admit the request
+CHATBOT_STREAM_LEASE = 60  # seconds; renewed while streaming, frees slots of crashed workers
+CHATBOT_RETRY_AFTER = 5  # seconds, sent as Retry-After with 429 responses
 
 
 # Scheduled tasks are now defined in website/scheduler_tasks.py
@@ -259,6 +389,21 @@ HEALTH_CHECK = {
 # Health Check Cache Key
 HEALTHCHECK_CACHE_KEY = 'pastedir_healthcheck'
 
+# /health/ready/, see pastebinir/health.py
+HEALTH_READINESS_TIMEOUT = 2  # seconds before a dependency check counts as failed
+HEALTH_READINESS_CACHE_SECONDS = 5  # a worker reuses its last result this long
+
+# /metrics, see pastebinir/metrics.py. Worker processes write their samples to
+# PROMETHEUS_MULTIPROC_DIR; these directories (the scheduler's) are added in
+METRICS_EXTRA_DIRS = [path for path in env("METRICS_EXTRA_DIRS", "").split(",") if path]
+
+# Request profiling, see pastebinir/profiling.py
+PROFILING_SAMPLE_RATE = float(env("PROFILING_SAMPLE_RATE", "0"))  # fraction of requests profiled, 0 = only on request
+PROFILING_HEADER = 'X-Profile'  # staff requests carrying it are always profiled and stored
+PROFILING_INTERVAL = 0.005  # seconds between stack samples
+PROFILING_SLOW_THRESHOLD = float(env("PROFILING_SLOW_THRESHOLD", "1"))  # seconds; faster sampled requests are dropped
+PROFILING_MAX_STORED = 500  # newest profiles kept
+
 # Scheduler Configuration
 SCHEDULER_CONFIG = SchedulerConfiguration(
     EXECUTIONS_IN_PAGE=20,
@@ -21,8 +21,13 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from . import health, metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('health/live/', health.live, name='health_live'),
+    path('health/ready/', health.ready, name='health_ready'),
+    path('metrics', metrics.metrics, name='metrics'),
     path('', include('website.urls')),
     path('api/', include('api.urls')),
 ]
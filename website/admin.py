@@ -1,8 +1,109 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+
+from pastebinir.profiling import to_pstats, to_speedscope
+from website.cache_utils import invalidate_paste_cache
+from website.history import forget_pastes
+from website.models import Paste, Language, RequestProfile, User
+
+
+@admin.register(Paste)
+class PasteAdmin(admin.ModelAdmin):
+    list_display = ('id', 'lang', 'created', 'expires', 'size', 'line_count', 'one_time', 'view_count')
+    list_select_related = ('lang',)
+    search_fields = ('id',)
+
+    def get_queryset(self, request):
+        # The change form defers ciphertext too; it is loaded on first access
+        return super().get_queryset(request).listing()
+
+    # Like the views, drop the cached copies and history entries of what changes
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change:
+            invalidate_paste_cache([obj.id])
+
+    def delete_model(self, request, obj):
+        paste_id = obj.id
+        super().delete_model(request, obj)
+        forget_pastes([paste_id])
+        invalidate_paste_cache([paste_id])
+
+    def delete_queryset(self, request, queryset):
+        paste_ids = list(queryset.values_list('id', flat=True))
+        super().delete_queryset(request, Paste.objects.filter(id__in=paste_ids))
+        forget_pastes(paste_ids)
+        invalidate_paste_cache(paste_ids)
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created', 'method', 'path', 'view', 'status', 'duration', 'query_count', 'query_seconds', 'reason')
+    list_filter = ('reason', 'view')
+    search_fields = ('path',)
+    fields = (
+        'created', 'method', 'path', 'view', 'status', 'duration', 'reason', 'query_count', 'query_seconds',
+        'downloads', 'sql',
+    )
+    readonly_fields = fields
+    # Listings never need the stacks or the query log
+    list_defer = ('stacks', 'queries')
+    exports = {
+        'pstats': (to_pstats, 'application/octet-stream', 'pstats'),
+        'speedscope': (to_speedscope, 'application/json', 'speedscope.json'),
+    }
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if request.resolver_match.url_name == 'website_requestprofile_changelist':
+            queryset = queryset.defer(*self.list_defer)
+        return queryset
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path(
+                '<int:pk>/download/<str:export>/', self.admin_site.admin_view(self.download),
+                name='website_requestprofile_download',
+            ),
+        ] + super().get_urls()
+
+    def download(self, request, pk, export):
+        if export not in self.exports:
+            raise Http404
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        if not self.has_view_permission(request, profile):
+            raise PermissionDenied
+        render, content_type, suffix = self.exports[export]
+        response = HttpResponse(render(profile), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="profile-{profile.pk}.{suffix}"'
+        return response
+
+    @admin.display(description='Stacks')
+    def downloads(self, obj):
+        return format_html_join(' | ', '<a href="{}">{}</a>', (
+            (reverse('admin:website_requestprofile_download', args=[obj.pk, export]), export)
+            for export in self.exports
+        ))
+
+    @admin.display(description='SQL')
+    def sql(self, obj):
+        return format_html(
+            '<ol>{}</ol>',
+            format_html_join('', '<li>{} ms ({}) <pre>{}</pre></li>', (
+                (f"{query['seconds'] * 1000:.2f}", query['alias'], query['sql']) for query in obj.queries
+            )),
+        )
 
-from website.models import Paste, Language, User
 
-admin.site.register(Paste)
 admin.site.register(Language)
 admin.site.register(User)
-
@@ -0,0 +1,149 @@
+"""
+Helpers of the HTTP benchmark commands: a throwaway gunicorn server on the
+current settings and a keep-alive load generator.
+"""
+import contextlib
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+SERVERS = {
+    # Sync workers, the default server; the chatbot service runs the ASGI setup
+    'wsgi': ['pastebinir.wsgi:application'],
+    'asgi': ['pastebinir.asgi:application', '--worker-class', 'uvicorn_worker.UvicornWorker'],
+}
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    body: bytes = None
+    headers: dict = None
+    status: int = 200  # expected
+
+
+def process_rss(pid):
+    """Resident memory in bytes of one process, 0 when it is gone (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def worker_rss(master_pid):
+    """Resident memory in bytes of the gunicorn master and its workers (Linux only)"""
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if int(pid) == master_pid or ppid == master_pid:
+            total += process_rss(pid)
+    return total
+
+
+@contextlib.contextmanager
+def serve(name, workers, port, probe_path='/health/live/', cwd=None):
+    """
+    Run gunicorn with the SERVERS entry name until the block exits; yields its
+    process. cwd is the checkout to serve, this one by default.
+    """
+    env = dict(os.environ, RATE_LIMIT_EXEMPT_IPS='127.0.0.1')
+    env.setdefault('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', *SERVERS[name], '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        env=env, cwd=cwd or settings.BASE_DIR,
+    )
+    try:
+        wait_ready(server, port, probe_path)
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def wait_ready(server, port, path):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise CommandError(f'Server exited with status {server.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', path)
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError('Server did not start within 30 seconds')
+
+
+def load(port, make_request, concurrency, total, on_response=None):
+    """
+    Send total requests over concurrency keep-alive connections. make_request(i)
+    returns the Request to send as the i-th one; on_response(response), when
+    given, sees every response with the expected status. Returns (latencies of
+    those responses, number of other outcomes).
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+    lock = threading.Lock()
+
+    def client():
+        nonlocal errors
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        timings = []
+        failed = 0
+        while True:
+            with lock:
+                i = next(remaining, None)
+            if i is None:
+                break
+            request = make_request(i)
+            started = time.perf_counter()
+            try:
+                connection.request(request.method, request.path, request.body, request.headers or {})
+                response = connection.getresponse()
+                response.read()
+                if response.status == request.status:
+                    timings.append(time.perf_counter() - started)
+                    if on_response is not None:
+                        on_response(response)
+                else:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+        connection.close()
+        with lock:
+            latencies.extend(timings)
+            errors += failed
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from . import paste_cache, write_behind
+from .compressed_pages import page_keys
+
+# KEYS: answer index; ARGV: answer key, answers kept, timeout
+_RECORD_ANSWER = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'zset' then
+    redis.call('DEL', KEYS[1])
+end
+local t = redis.call('TIME')
+redis.call('ZADD', KEYS[1], tonumber(t[1]) * 1000000 + tonumber(t[2]), ARGV[1])
+local evicted = redis.call('ZRANGE', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+if #evicted > 0 then
+    redis.call('ZREM', KEYS[1], unpack(evicted))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return evicted
+"""
+
+
+def paste_cache_key(paste_id):
+    """Key of the short-expiry marker set for 10 minute / 1 hour pastes"""
+    return f'paste_{paste_id}'
+
+
+def chatbot_answers_key(paste_id):
+    """Key of the cached chatbot answer keys recorded for a paste"""
+    return f'chatbot_answers_{paste_id}'
+
+
+def _redis():
+    """The Redis client behind the cache, None unless it is django-redis"""
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def record_chatbot_answer(paste_id, answer_key, timeout):
+    """
+    Record a cached answer against its paste, deleting the paste's oldest
+    answers beyond CHATBOT_ANSWER_CACHE_MAX_PER_PASTE. On Redis the index is
+    a sorted set updated by one script, so concurrent answers are not lost.
+    Other caches are local to the process; run it through sync_to_async() so
+    updates take turns on one thread.
+    """
+    index_key = chatbot_answers_key(paste_id)
+    limit = settings.CHATBOT_ANSWER_CACHE_MAX_PER_PASTE
+    client = _redis()
+    if client is not None:
+        record = client.register_script(_RECORD_ANSWER)
+        evicted = [key.decode() for key in record(keys=[cache.make_key(index_key)], args=[answer_key, limit, timeout])]
+    else:
+        answer_keys = [key for key in cache.get(index_key, []) if key != answer_key] + [answer_key]
+        evicted = answer_keys[:-limit]
+        cache.set(index_key, answer_keys[-limit:], timeout)
+    if evicted:
+        cache.delete_many(evicted)
+
+
+def _recorded_answers(index_keys):
+    client = _redis()
+    if client is None:
+        return [key for answer_keys in cache.get_many(index_keys).values() for key in answer_keys]
+    with client.pipeline(transaction=False) as pipe:
+        for index_key in index_keys:
+            pipe.zrange(cache.make_key(index_key), 0, -1)
+        # An index still holding a value of another type has nothing to add
+        results = pipe.execute(raise_on_error=False)
+    return [key.decode() for answer_keys in results if isinstance(answer_keys, list) for key in answer_keys]
+
+
+def invalidate_paste_cache(paste_ids):
+    """
+    Drop every cache entry tied to the given pastes, and any copy still
+    queued for write-behind. Call this wherever pastes are deleted.
+    """
+    paste_ids = list(paste_ids)
+    if not paste_ids:
+        return
+    write_behind.discard(paste_ids)
+    keys = [paste_cache_key(paste_id) for paste_id in paste_ids] + page_keys(paste_ids)
+    index_keys = [chatbot_answers_key(paste_id) for paste_id in paste_ids]
+    keys.extend(_recorded_answers(index_keys))
+    cache.delete_many(keys + index_keys)
+    # Drops the cached rows; other processes drop their in-memory copies too
+    paste_cache.publish_invalidation(paste_ids)
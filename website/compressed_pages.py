@@ -0,0 +1,103 @@
+"""
+Precompressed paste pages.
+
+The page and raw view of a plain paste are the same for every client, so each
+is compressed once per encoding (brotli or gzip, whichever the client prefers)
+and the compressed body kept in the cache for PASTE_PAGE_CACHE_TIMEOUT seconds,
+or until the paste expires or is deleted. Later requests get those bytes as
+they are. Clients that accept neither encoding, and pages too small to gain
+from compression, get a freshly rendered page.
+"""
+import gzip
+
+import brotli
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+
+from pastebinir.metrics import cache_lookup
+
+# Preferred first
+ENCODINGS = ('br', 'gzip')
+PAGE_KINDS = ('view', 'raw')
+
+
+def page_key(paste_id, kind, encoding):
+    """Key of the compressed page of a paste"""
+    return f'paste_page_{paste_id}_{kind}_{encoding}'
+
+
+def page_keys(paste_ids):
+    """Keys of every compressed page of the given pastes"""
+    return [
+        page_key(paste_id, kind, encoding)
+        for paste_id in paste_ids for kind in PAGE_KINDS for encoding in ENCODINGS
+    ]
+
+
+def accepted_encoding(request):
+    """The preferred encoding of ENCODINGS the client accepts, or None"""
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.partition(';')
+        params = params.replace(' ', '')
+        try:
+            quality = float(params[2:]) if params.startswith('q=') else 1
+        except ValueError:
+            quality = 1
+        # q=0 means not acceptable
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.PASTE_PAGE_BROTLI_QUALITY)
+    # mtime=0 makes the output depend on the content only
+    return gzip.compress(content, compresslevel=settings.PASTE_PAGE_GZIP_LEVEL, mtime=0)
+
+
+def _timeout(paste):
+    timeout = settings.PASTE_PAGE_CACHE_TIMEOUT
+    if paste.expires:
+        timeout = min(timeout, int((paste.expires - timezone.now()).total_seconds()))
+    return timeout
+
+
+def _compressed_response(body, encoding):
+    response = HttpResponse(body, content_type='text/html; charset=utf-8')
+    response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def cached_page(request, paste, kind, render):
+    """
+    The page of paste for request, compressed from the cache when possible.
+    render() returns the uncompressed HttpResponse.
+    """
+    encoding = accepted_encoding(request)
+    cacheable = encoding and not paste.one_time and not paste.salt
+    if cacheable:
+        key = page_key(paste.id, kind, encoding)
+        body = cache.get(key)
+        cache_lookup('paste_page', body is not None)
+        if body is not None:
+            return _compressed_response(body, encoding)
+    response = render()
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if not cacheable or response.status_code != 200 or len(response.content) < settings.PASTE_PAGE_MIN_COMPRESS_SIZE:
+        return response
+    timeout = _timeout(paste)
+    if timeout <= 0:
+        return response
+    body = compress(response.content, encoding)
+    if len(body) <= settings.PASTE_PAGE_CACHE_MAX_BYTES:
+        cache.set(key, body, timeout)
+    return _compressed_response(body, encoding)
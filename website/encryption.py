@@ -5,6 +5,9 @@ from cryptography.hazmat.primitives import hashes
 import os
 import base64
 
+from pastebinir.metrics import KEY_DERIVATION_SECONDS
+
+@KEY_DERIVATION_SECONDS.time()
 def derive_key(password: str, salt: bytes) -> bytes:
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
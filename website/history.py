@@ -0,0 +1,165 @@
+"""
+Server-side paste history for anonymous clients.
+
+Each browser (or API client) gets a random history token cookie; the pastes it
+creates are recorded against that token in HistoryEntry with a precomputed
+preview, capped at HISTORY_MAX_ENTRIES per token, and read newest first with
+keyset pagination on (created, id).
+
+Entries are not removed by a cascade: the code paths that delete pastes call
+forget_pastes(), and pages leave out entries whose paste is gone anyway, such
+as pastes deleted from the admin or with their owner.
+"""
+import secrets
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import HistoryEntry, Paste, make_preview
+from .write_behind import pending_ids
+
+HISTORY_COOKIE = 'historyToken'
+LEGACY_HISTORY_COOKIE = 'pasteHistory'
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def get_history_token(request):
+    token = request.COOKIES.get(HISTORY_COOKIE, '')
+    if 16 <= len(token) <= 43 and token.replace('-', '').replace('_', '').isalnum():
+        return token
+    return None
+
+
+def set_history_cookie(response, token):
+    response.set_cookie(
+        HISTORY_COOKIE,
+        token,
+        max_age=settings.HISTORY_COOKIE_AGE,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite='Lax',
+    )
+
+
+def record_paste(token, paste):
+    """
+    Add paste to the history of token (a new token is issued when None) and
+    trim that history to HISTORY_MAX_ENTRIES. Returns the token.
+    """
+    return record_pastes(token, [paste])
+
+
+def record_pastes(token, pastes):
+    """record_paste() for several pastes at once"""
+    token = token or secrets.token_urlsafe(24)
+    HistoryEntry.objects.bulk_create(
+        [
+            HistoryEntry(client_token=token, paste_id=paste.id, created=paste.created, preview=paste.history_preview())
+            for paste in pastes
+        ],
+        ignore_conflicts=True,
+    )
+    _trim(token)
+    return token
+
+
+def _trim(token):
+    overflow = list(
+        HistoryEntry.objects.filter(client_token=token)
+        .order_by('-created', '-id')
+        .values_list('id', flat=True)[settings.HISTORY_MAX_ENTRIES:settings.HISTORY_MAX_ENTRIES + 100]
+    )
+    if overflow:
+        HistoryEntry.objects.filter(id__in=overflow).delete()
+
+
+def import_legacy_history(request):
+    """
+    Move the pre-token pasteHistory cookie into the history store. Returns the
+    token to set, or None when there is nothing to import. Only the newest
+    HISTORY_MAX_ENTRIES pastes are kept.
+    """
+    legacy = request.COOKIES.get(LEGACY_HISTORY_COOKIE, '')
+    if not legacy:
+        return None
+    token = get_history_token(request) or secrets.token_urlsafe(24)
+    paste_ids = [paste_id for paste_id in legacy.split(',') if paste_id][-settings.HISTORY_MAX_ENTRIES:]
+    pastes = Paste.objects.filter(id__in=paste_ids).values_list('id', 'created', 'salt', 'preview')
+    HistoryEntry.objects.bulk_create(
+        [
+            HistoryEntry(client_token=token, paste_id=paste_id, created=created,
+                         preview=make_preview('', encrypted=True) if salt else preview)
+            for paste_id, created, salt, preview in pastes
+        ],
+        ignore_conflicts=True,
+    )
+    _trim(token)
+    return token
+
+
+def forget_pastes(paste_ids):
+    """Remove deleted pastes from every history"""
+    HistoryEntry.objects.filter(paste_id__in=list(paste_ids)).delete()
+
+
+def encode_cursor(entry):
+    return f"{(entry.created - _EPOCH) // _MICROSECOND}-{entry.id}"
+
+
+def _decode_cursor(cursor):
+    try:
+        micros, entry_id = cursor.split('-', 1)
+        return _EPOCH + int(micros) * _MICROSECOND, int(entry_id)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def history_page(token, before=None, limit=None):
+    """
+    One page of the history of token, newest first, starting after the
+    cursor before. Returns (entries, cursor of the next page or None).
+    """
+    if not token:
+        return [], None
+    limit = limit or settings.HISTORY_PAGE_SIZE
+    entries, cursor = _paginate(list(_page_query(token, before, limit)), limit)
+    existing = set(Paste.objects.filter(id__in=[entry.paste_id for entry in entries]).values_list('id', flat=True))
+    return _without_deleted(entries, existing), cursor
+
+
+def _page_query(token, before, limit):
+    entries = HistoryEntry.objects.filter(client_token=token).order_by('-created', '-id')
+    position = _decode_cursor(before) if before else None
+    if position:
+        created, entry_id = position
+        entries = entries.filter(Q(created__lt=created) | Q(created=created, id__lt=entry_id))
+    # One extra entry tells whether there is a next page
+    return entries[:limit + 1]
+
+
+def _paginate(entries, limit):
+    if len(entries) > limit:
+        entries = entries[:limit]
+        return entries, encode_cursor(entries[-1])
+    return entries, None
+
+
+def _without_deleted(entries, existing):
+    """entries whose paste is in existing or still queued for write-behind"""
+    missing = {entry.paste_id for entry in entries} - existing
+    if missing:
+        existing = existing | pending_ids(missing)
+        entries = [entry for entry in entries if entry.paste_id in existing]
+    return entries
+
+
+def finish_response(request, response, token):
+    """Set the history cookie if it changed and drop the legacy cookie"""
+    if token and token != get_history_token(request):
+        set_history_cookie(response, token)
+    if LEGACY_HISTORY_COOKIE in request.COOKIES:
+        response.delete_cookie(LEGACY_HISTORY_COOKIE)
+    return response
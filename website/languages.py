@@ -0,0 +1,110 @@
+"""
+In-process registry of languages.
+
+Each process keeps an immutable snapshot of the Language table: the ordered
+list, lookups by id and alias, and the /api/languages/ payload already encoded
+as JSON. Snapshots are versioned through a single key in the shared cache,
+which Language save/delete signals replace; a process compares its version
+with that key at most every LANGUAGE_REGISTRY_CHECK_INTERVAL seconds and
+reloads from the database when they differ.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from pastebinir.metrics import cache_lookup
+from .models import Language
+
+VERSION_KEY = 'languages:version'
+
+
+class LanguageRegistry:
+    """One immutable snapshot of the Language table"""
+
+    def __init__(self, version, languages):
+        self.version = version
+        self.languages = tuple(languages)
+        self.by_id = {language.id: language for language in self.languages}
+        self.by_alias = {language.alias.lower(): language for language in self.languages}
+        # Same shape as a single page of the paginated language list
+        self.json = json.dumps({
+            'next': None,
+            'previous': None,
+            'results': [
+                {'id': language.id, 'displayname': language.displayname, 'alias': language.alias}
+                for language in self.languages
+            ],
+        }).encode()
+        self.etag = f'"{hashlib.sha256(self.json).hexdigest()[:32]}"'
+        self.loaded = time.monotonic()
+        self.checked = self.loaded
+
+    def get(self, language_id):
+        """Language with that id (any int-like value), or None"""
+        try:
+            return self.by_id.get(int(language_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_by_alias(self, alias):
+        return self.by_alias.get(alias.lower())
+
+    def first(self):
+        return self.languages[0] if self.languages else None
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    cache_lookup('language_version', version is not None)
+    if version is None:
+        # Key evicted or never set: start a new version everyone will pick up
+        version = uuid.uuid4().hex
+        if not cache.add(VERSION_KEY, version, None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def get_registry():
+    """The current snapshot, reloaded when the shared version has moved on"""
+    global _registry
+    registry = _registry
+    now = time.monotonic()
+    if registry is not None and now - registry.checked < settings.LANGUAGE_REGISTRY_CHECK_INTERVAL:
+        return registry
+    with _lock:
+        registry = _registry
+        if registry is not None and now - registry.checked < settings.LANGUAGE_REGISTRY_CHECK_INTERVAL:
+            return registry
+        version = _current_version()
+        if (registry is None or registry.version != version
+                or now - registry.loaded >= settings.LANGUAGE_REGISTRY_MAX_AGE):
+            # Version read before the table, so a change made meanwhile is seen next time
+            registry = LanguageRegistry(version, Language.objects.order_by('displayname', 'id'))
+        else:
+            registry.checked = now
+        _registry = registry
+        return registry
+
+
+def invalidate():
+    """Start a new version, making every process reload its registry"""
+    global _registry
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    _registry = None
+
+
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def _language_changed(sender, **kwargs):
+    invalidate()
@@ -0,0 +1,273 @@
+import http.client
+import io
+import json
+import secrets
+import statistics
+import time
+from datetime import timedelta
+from http.cookies import SimpleCookie
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from website import write_behind
+from website.benchmarking import SERVERS, Request, load, percentile, serve
+from website.cache_utils import invalidate_paste_cache
+from website.history import HISTORY_COOKIE, forget_pastes, record_pastes
+from website.models import Language, Paste
+
+HTTP_CASES = [
+    'create_plain', 'create_encrypted', 'create_autodetect',
+    'view_small', 'raw_small', 'view_large', 'raw_large',
+    'one_time',
+    'api_list', 'api_retrieve', 'api_languages',
+]
+CASES = HTTP_CASES + ['cleanup']
+
+CODE = '''import sys
+
+
+def main(argv):
+    """Print the arguments"""
+    for arg in argv:
+        print(arg)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+'''
+
+
+def paste_ids(count):
+    """count random paste IDs not in use yet"""
+    ids = set()
+    while len(ids) < count:
+        ids.add(secrets.token_hex(3))
+        if len(ids) == count:
+            ids -= set(Paste.objects.filter(id__in=ids).values_list('id', flat=True))
+    return list(ids)
+
+
+def seed(count, content, lang, **fields):
+    pastes = []
+    for paste_id in paste_ids(count):
+        paste = Paste(id=paste_id, ciphertext=content, lang=lang, **fields)
+        paste.compute_metadata()
+        pastes.append(paste)
+    Paste.objects.bulk_create(pastes, batch_size=1000)
+    return [paste.id for paste in pastes]
+
+
+def text(size):
+    """About size bytes of code-like text"""
+    return (CODE * (size // len(CODE) + 1))[:size]
+
+
+class Command(BaseCommand):
+    help = (
+        'End-to-end benchmark of the paste, API and clean-up paths against the configured database and '
+        'cache (run it on a local PostgreSQL and Redis). Serves the site under gunicorn, reports '
+        'throughput and p50/p99 per case, and fails when a case is slower than the stored baseline '
+        'by more than --margin (the vs columns, positive is slower). Creates and deletes its own pastes; '
+        'the clean-up case also deletes every other expired paste.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+        parser.add_argument('--server', choices=list(SERVERS), default='wsgi')
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent client connections')
+        parser.add_argument('--requests', type=int, default=500, help='Requests timed per HTTP case')
+        parser.add_argument('--large-size', type=int, default=4 * 2 ** 20, help='Size of the large paste in bytes')
+        parser.add_argument('--backlog', type=int, default=20000, help='Expired pastes per clean-up run')
+        parser.add_argument('--cleanup-runs', type=int, default=3)
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'benchmark-baseline.json'),
+                            help='Results to compare against')
+        parser.add_argument('--save-baseline', action='store_true', help='Store this run as the baseline')
+        parser.add_argument('--margin', type=float, default=0.2,
+                            help='Allowed slowdown against the baseline, 0.2 = 20%% on p50, p99 and throughput')
+
+    def handle(self, *args, **options):
+        backends = {'database': connection.vendor, 'cache': settings.CACHES['default']['BACKEND']}
+        if connection.vendor != 'postgresql' or 'redis' not in backends['cache'].lower():
+            self.stderr.write(self.style.WARNING(
+                f"Running on {backends['database']} and {backends['cache']}, not PostgreSQL and Redis"
+            ))
+        lang = Language.objects.order_by('id').first()
+        if lang is None:
+            raise CommandError('Add at least one language first')
+        manifest = getattr(staticfiles_storage, 'manifest_name', None)
+        if not settings.DEBUG and manifest and not staticfiles_storage.exists(manifest):
+            # Every page would fail on its static file URLs
+            raise CommandError('Static files are not collected, run sync_static first')
+
+        results = {}
+        cases = [case for case in HTTP_CASES if case in options['cases']]
+        if cases:
+            results.update(self.run_http(cases, lang, options))
+        if 'cleanup' in options['cases']:
+            results['cleanup'] = self.run_cleanup(lang, options)
+
+        self.stdout.write(
+            f"{'case':<20}{'ok':>7}{'errors':>8}{'rate/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+            f"{'vs rate':>9}{'vs p50':>9}{'vs p99':>9}"
+        )
+        baseline = self.load_baseline(options['baseline'], backends)
+        failures = []
+        for case, result in results.items():
+            line = (
+                f"{case:<20}{result['ok']:>7}{result['errors']:>8}{result['throughput']:>10.1f}"
+                f"{result['p50']:>10.2f}{result['p99']:>10.2f}"
+            )
+            if result['errors']:
+                failures.append(f"{case}: {result['errors']} errors")
+            base = baseline.get(case)
+            if base is not None:
+                changes = {
+                    # Positive is slower
+                    'throughput': base['throughput'] / result['throughput'] - 1 if result['throughput'] else float('inf'),
+                    'p50': result['p50'] / base['p50'] - 1 if base['p50'] else 0,
+                    'p99': result['p99'] / base['p99'] - 1 if base['p99'] else 0,
+                }
+                line += ''.join(f"{change:>+9.0%}" for change in changes.values())
+                failures += [
+                    f"{case}: {metric} {change:+.0%} against the baseline"
+                    for metric, change in changes.items() if change > options['margin']
+                ]
+            self.stdout.write(line)
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump({'backends': backends, 'results': results}, f, indent=2)
+            self.stdout.write(f"Saved the baseline to {options['baseline']}")
+        elif failures:
+            raise CommandError('Performance regressions:\n' + '\n'.join(failures))
+
+    def load_baseline(self, path, backends):
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if stored['backends'] != backends:
+            raise CommandError(f"The baseline was recorded on {stored['backends']}, this run uses {backends}")
+        return stored['results']
+
+    def summarize(self, latencies, errors, elapsed, done=None):
+        latencies.sort()
+        return {
+            'ok': len(latencies),
+            'errors': errors,
+            'throughput': (len(latencies) if done is None else done) / elapsed,
+            'p50': (statistics.median(latencies) if latencies else 0) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+        }
+
+    def run_http(self, cases, lang, options):
+        count = options['requests']
+        warmup = options['concurrency'] * 2
+        small = seed(1, text(4096), lang)[0]
+        large = seed(1, text(options['large_size']), lang)[0]
+        one_time = seed(count + warmup, text(4096), lang, one_time=True) if 'one_time' in cases else []
+        history = seed(settings.API_PAGE_SIZE, text(512), lang)
+        token = record_pastes(None, Paste.objects.filter(id__in=history))
+        user = get_user_model().objects.create_user(f'benchmark-{secrets.token_hex(4)}')
+        api_token = Token.objects.create(user=user)
+        created = []
+        seeded = [small, large, *one_time, *history]
+        try:
+            with serve(options['server'], options['workers'], options['port']):
+                csrf = self.csrf_token(options['port'])
+                requests = self.requests(lang, small, large, one_time, token, api_token.key, csrf)
+                results = {}
+                for case in cases:
+                    make_request = requests[case]
+                    on_response = None
+                    if case.startswith('create'):
+                        on_response = lambda response: created.append(response.getheader('Location').strip('/'))
+                    if case == 'one_time':
+                        # Warm up on pastes of their own, each is consumed once
+                        consume = make_request
+                        make_request = lambda i: consume(i + warmup)
+                        load(options['port'], consume, options['concurrency'], warmup)
+                    else:
+                        load(options['port'], make_request, options['concurrency'], warmup, on_response)
+                    started = time.perf_counter()
+                    latencies, errors = load(options['port'], make_request, options['concurrency'], count, on_response)
+                    results[case] = self.summarize(latencies, errors, time.perf_counter() - started)
+                return results
+        finally:
+            if write_behind.enabled():
+                write_behind.flush()
+            ids = seeded + created
+            Paste.objects.filter(id__in=ids).delete()
+            forget_pastes(ids)
+            invalidate_paste_cache(ids)
+            user.delete()
+
+    def csrf_token(self, port):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.request('GET', '/create/')
+        response = connection.getresponse()
+        response.read()
+        cookies = SimpleCookie()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            cookies.load(header)
+        if settings.CSRF_COOKIE_NAME not in cookies:
+            raise CommandError('The create page set no CSRF cookie')
+        return cookies[settings.CSRF_COOKIE_NAME].value
+
+    def requests(self, lang, small, large, one_time, history_token, api_token, csrf):
+        """{case: make_request(i)}"""
+        browser = {'Accept-Encoding': 'gzip, deflate, br'}
+        form = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Cookie': f'{settings.CSRF_COOKIE_NAME}={csrf}',
+        }
+
+        def create(**fields):
+            body = urlencode({
+                'csrfmiddlewaretoken': csrf, 'content': text(2048), 'language': lang.id, 'expiration': '1', **fields,
+            }).encode()
+            request = Request('POST', '/create/', body, form, 302)
+            return lambda i: request
+
+        def get(path, headers=None):
+            request = Request('GET', path, headers=headers)
+            return lambda i: request
+
+        return {
+            'create_plain': create(),
+            'create_encrypted': create(password='benchmark password'),
+            'create_autodetect': create(language='auto'),
+            'view_small': get(f'/{small}/', browser),
+            'raw_small': get(f'/{small}/raw/', browser),
+            'view_large': get(f'/{large}/', browser),
+            'raw_large': get(f'/{large}/raw/', browser),
+            'one_time': lambda i: Request('GET', f'/{one_time[i]}/', headers=browser),
+            'api_list': get('/api/pastes/', {'Cookie': f'{HISTORY_COOKIE}={history_token}'}),
+            'api_retrieve': get(f'/api/pastes/{small}/', {'Authorization': f'Token {api_token}'}),
+            'api_languages': get('/api/languages/'),
+        }
+
+    def run_cleanup(self, lang, options):
+        """Time cleanup_expired_pastes over a fresh backlog of expired pastes, --cleanup-runs times"""
+        durations = []
+        deleted = 0
+        for _ in range(options['cleanup_runs']):
+            expired = timezone.now() - timedelta(days=1)
+            ids = seed(options['backlog'], text(1024), lang, expires=expired)
+            started = time.perf_counter()
+            call_command('cleanup_expired_pastes', stdout=io.StringIO())
+            durations.append(time.perf_counter() - started)
+            deleted += len(ids)
+        return self.summarize(durations, 0, sum(durations), done=deleted)
@@ -0,0 +1,99 @@
+import secrets
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from website.benchmarking import SERVERS, Request, load, percentile, process_rss, serve, worker_rss
+from website.cache_utils import invalidate_paste_cache
+from website.models import Language, Paste
+
+class Command(BaseCommand):
+    help = (
+        'Serve the site under gunicorn with sync (WSGI) and uvicorn (ASGI) workers in turn and '
+        'compare requests per second and latency of the paste views. With --memory each server gets '
+        'as many workers as fit in that budget instead of --workers. With --ref each server also runs '
+        'that git revision, e.g. one with the sync views, from a temporary worktree sharing this database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes per server')
+        parser.add_argument('--memory', type=int, help='Memory budget in MB of each server, master included')
+        parser.add_argument('--ref', help='Git revision to serve as well, e.g. one before the views went async')
+        parser.add_argument('--concurrency', type=int, default=32, help='Concurrent client connections')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests timed per server')
+        parser.add_argument('--size', type=int, default=4096, help='Paste size in bytes')
+        parser.add_argument('--raw', action='store_true', help='Request the raw view instead of the paste page')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        lang = Language.objects.order_by('id').first()
+        if lang is None:
+            raise CommandError('Add at least one language first')
+        paste = Paste.objects.create(
+            id=secrets.token_hex(3), ciphertext=('x' * 79 + '\n') * (options['size'] // 80 + 1), lang=lang,
+        )
+        path = f'/{paste.id}/raw/' if options['raw'] else f'/{paste.id}/'
+        servers = [(name, name, None) for name in options['servers']]
+        worktree = None
+        try:
+            if options['ref']:
+                worktree = self.checkout(options['ref'])
+                servers += [(f"{name}@{options['ref']}", name, worktree) for name in options['servers']]
+            results = [self.run_server(label, name, path, cwd, options) for label, name, cwd in servers]
+        finally:
+            paste.delete()
+            invalidate_paste_cache([paste.id])
+            if worktree is not None:
+                subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=settings.BASE_DIR, check=False)
+                shutil.rmtree(worktree, ignore_errors=True)
+
+        width = max(8, *(len(label) + 2 for label, _, _ in servers))
+        self.stdout.write(
+            f"{'server':<{width}}{'workers':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'RSS MB':>10}"
+        )
+        for label, workers, rps, p50, p99, errors, rss in results:
+            self.stdout.write(
+                f"{label:<{width}}{workers:>8}{rps:>10.1f}{p50:>10.2f}{p99:>10.2f}{errors:>8}{rss / 2 ** 20:>10.1f}"
+            )
+
+    def checkout(self, ref):
+        worktree = tempfile.mkdtemp(prefix='benchmark-views-')
+        try:
+            subprocess.run(
+                ['git', 'worktree', 'add', '--detach', worktree, ref],
+                cwd=settings.BASE_DIR, check=True, capture_output=True, text=True,
+            )
+        except subprocess.CalledProcessError as e:
+            shutil.rmtree(worktree, ignore_errors=True)
+            raise CommandError(f'Cannot check out {ref}: {e.stderr.strip()}')
+        return worktree
+
+    def workers_for(self, name, path, cwd, options):
+        """How many workers of server name fit in --memory, measured on one warmed up worker"""
+        request = Request('GET', path)
+        with serve(name, 1, options['port'], path, cwd) as server:
+            load(options['port'], lambda i: request, options['concurrency'], options['concurrency'] * 10)
+            total = worker_rss(server.pid)
+            master = process_rss(server.pid)
+        budget = options['memory'] * 2 ** 20
+        return max(1, (budget - master) // max(1, total - master))
+
+    def run_server(self, label, name, path, cwd, options):
+        workers = self.workers_for(name, path, cwd, options) if options['memory'] else options['workers']
+        request = Request('GET', path)
+        with serve(name, workers, options['port'], path, cwd) as server:
+            # Warm every worker's caches and connections before timing
+            load(options['port'], lambda i: request, options['concurrency'], options['concurrency'] * 10)
+            started = time.perf_counter()
+            latencies, errors = load(options['port'], lambda i: request, options['concurrency'], options['requests'])
+            elapsed = time.perf_counter() - started
+            rss = worker_rss(server.pid)
+        latencies.sort()
+        median = statistics.median(latencies) if latencies else 0
+        return label, workers, len(latencies) / elapsed, median * 1000, percentile(latencies, 0.99) * 1000, errors, rss
@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.core.cache import cache
+from website.cache_utils import invalidate_paste_cache
+from website.history import forget_pastes
 from website.models import Paste
+from pastebinir.metrics import CLEANUP_BATCH_PASTES
 import logging
 
 logger = logging.getLogger(__name__)
@@ -46,7 +48,7 @@ class Command(BaseCommand):
         pastes_to_delete = expired_pastes | one_time_viewed_pastes
         
         # Remove duplicates (in case a paste is both expired and one-time viewed)
-        pastes_to_delete = pastes_to_delete.distinct()
+        pastes_to_delete = pastes_to_delete.distinct().listing()
         
         count = pastes_to_delete.count()
         
@@ -56,6 +58,8 @@ class Command(BaseCommand):
             self.stdout.write(f"Total pastes to delete: {count}")
         
         if count == 0:
+            if not dry_run:
+                CLEANUP_BATCH_PASTES.observe(0)
             self.stdout.write(
                 self.style.SUCCESS("No pastes to clean up!")
             )
@@ -71,13 +75,16 @@ class Command(BaseCommand):
                 if count > 10:
                     self.stdout.write(f"  ... and {count - 10} more")
         else:
-            # Delete the pastes
-            pastes_to_delete.delete()
+            # Store paste IDs for cache cleanup
+            paste_ids = list(pastes_to_delete.values_list('id', flat=True))
+
+            # Delete exactly the pastes invalidated below, not whatever the filter matches by now
+            Paste.objects.filter(id__in=paste_ids).delete()
+            forget_pastes(paste_ids)
+            CLEANUP_BATCH_PASTES.observe(count)
             
             # Clear related cache entries
-            for paste in pastes_to_delete:
-                cache_key = f'paste_{paste.id}'
-                cache.delete(cache_key)
+            invalidate_paste_cache(paste_ids)
             
             self.stdout.write(
                 self.style.SUCCESS(f"Successfully deleted {count} pastes")
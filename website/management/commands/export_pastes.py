@@ -0,0 +1,129 @@
+import gzip
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from website import write_behind
+from website.models import Language, Paste
+
+# Exported columns; size, line_count and preview are recomputed on import
+FIELDS = ['id', 'created', 'expires', 'one_time', 'view_count', 'lang_id', 'owner_id', 'salt', 'iv', 'ciphertext']
+ID_SPACE = 16 ** 6
+
+
+def shard_bounds(shards):
+    """[(lower, upper)] ID ranges splitting the 6 hex digit space, None is open"""
+    edges = [f'{ID_SPACE * i // shards:06x}' for i in range(1, shards)]
+    return list(zip([None, *edges], [*edges, None]))
+
+
+def shard_path(output, index):
+    """pastes.ndjson.gz -> pastes.003.ndjson.gz"""
+    path = Path(output)
+    stem, dot, suffixes = path.name.partition('.')
+    return path.with_name(f'{stem}.{index:03d}{dot}{suffixes}')
+
+
+class Command(BaseCommand):
+    help = (
+        'Export pastes as gzipped NDJSON, one paste per line in ID order, for import_pastes. Rows are '
+        'read in keyset pages through server-side cursors, so memory use does not grow with the table. '
+        'With --shards N the ID space is split into N ranges exported in parallel, each to its own file '
+        '(pastes.ndjson.gz becomes pastes.000.ndjson.gz, ...).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write, - for standard output")
+        parser.add_argument('--shards', type=int, default=1, help='ID ranges to export in parallel')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to read, e.g. a replica')
+        parser.add_argument('--page-size', type=int, default=100000,
+                            help='Rows per keyset page; each page is one short transaction')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the cursor at a time')
+        parser.add_argument('--compress-level', type=int, default=6, choices=range(1, 10))
+
+    def handle(self, *args, **options):
+        if options['shards'] < 1:
+            raise CommandError('--shards must be at least 1')
+        if options['output'] == '-' and options['shards'] > 1:
+            raise CommandError('Sharded exports need a file name')
+        if write_behind.enabled():
+            # Queued pastes are not in the table yet
+            write_behind.flush()
+        languages = dict(Language.objects.using(options['database']).values_list('id', 'alias'))
+
+        started = time.perf_counter()
+        if options['shards'] == 1:
+            total = self.export(options['output'], None, None, languages, options)
+        else:
+            with ThreadPoolExecutor(options['shards']) as executor:
+                shards = [
+                    executor.submit(self.export, shard_path(options['output'], index), lower, upper, languages, options)
+                    for index, (lower, upper) in enumerate(shard_bounds(options['shards']))
+                ]
+                total = sum(shard.result() for shard in shards)
+        self.stderr.write(self.style.SUCCESS(f'Exported {total} pastes in {time.perf_counter() - started:.1f}s'))
+
+    def export(self, output, lower, upper, languages, options):
+        """Write the pastes with lower <= id < upper to output; returns their number"""
+        if output == '-':
+            with gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8', compresslevel=options['compress_level']) as f:
+                return self.write(f, lower, upper, languages, options)
+        # Written under a temporary name, so an interrupted export is never mistaken for a complete one
+        partial = Path(f'{output}.partial')
+        try:
+            with gzip.open(partial, 'wt', encoding='utf-8', compresslevel=options['compress_level']) as f:
+                count = self.write(f, lower, upper, languages, options)
+            partial.replace(output)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        finally:
+            # Shards run in threads of their own, each with its own connection
+            connections[options['database']].close()
+        return count
+
+    def write(self, f, lower, upper, languages, options):
+        count = 0
+        for row in self.rows(lower, upper, options):
+            paste = dict(zip(FIELDS, row))
+            line = {
+                'id': paste['id'],
+                'created': paste['created'].isoformat(),
+                'expires': paste['expires'].isoformat() if paste['expires'] else None,
+                'one_time': paste['one_time'],
+                'view_count': paste['view_count'],
+                'language': languages.get(paste['lang_id']),
+                'owner': paste['owner_id'],
+                'salt': paste['salt'],
+                'iv': paste['iv'],
+                'ciphertext': paste['ciphertext'],
+            }
+            f.write(json.dumps(line, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+        return count
+
+    def rows(self, lower, upper, options):
+        """Rows of FIELDS with lower <= id < upper, in ID order"""
+        pastes = Paste.objects.using(options['database']).order_by('id')
+        if lower is not None:
+            pastes = pastes.filter(id__gte=lower)
+        if upper is not None:
+            pastes = pastes.filter(id__lt=upper)
+        last = None
+        while True:
+            page = pastes.filter(id__gt=last) if last is not None else pastes
+            fetched = 0
+            # Outside a transaction PostgreSQL would materialize the whole page for a WITH HOLD cursor
+            with transaction.atomic(using=options['database']):
+                for row in page.values_list(*FIELDS)[:options['page_size']].iterator(chunk_size=options['chunk_size']):
+                    yield row
+                    fetched += 1
+                    last = row[0]
+            if fetched < options['page_size']:
+                return
@@ -0,0 +1,104 @@
+import contextlib
+import gzip
+import io
+import json
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from website.models import Language, Paste, User, paste_metadata
+
+
+@contextlib.contextmanager
+def open_export(name):
+    """Text lines of an export_pastes file, gzipped or not; - is standard input"""
+    with contextlib.ExitStack() as stack:
+        raw = sys.stdin.buffer if name == '-' else stack.enter_context(open(name, 'rb'))
+        if raw.peek(2)[:2] == b'\x1f\x8b':
+            raw = stack.enter_context(gzip.GzipFile(fileobj=raw))
+        yield io.TextIOWrapper(raw, encoding='utf-8')
+
+
+class Command(BaseCommand):
+    help = (
+        'Import pastes written by export_pastes. Rows are inserted in batches and pastes whose ID '
+        'already exists are skipped, so an interrupted import can simply be run again. Memory use does '
+        'not depend on the file size; run one import per shard file to load shards in parallel. '
+        'Languages are matched by alias; owners that do not exist here are dropped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Export files, - for standard input')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT and transaction')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        languages = dict(Language.objects.using(database).values_list('alias', 'id'))
+        totals = {'read': 0, 'inserted': 0, 'skipped': 0, 'unknown_language': 0}
+        started = time.perf_counter()
+
+        for name in options['files']:
+            try:
+                with open_export(name) as f:
+                    lines = enumerate(f, 1)
+                    while batch := list(islice(lines, options['batch_size'])):
+                        pastes = [self.paste(name, number, line, languages, totals) for number, line in batch]
+                        self.insert(pastes, database, totals)
+                        totals['read'] += len(pastes)
+            except (OSError, EOFError) as e:
+                # Also a truncated or corrupt gzip stream
+                raise CommandError(f'Cannot read {name}: {e}')
+            self.stderr.write(f"{name}: {totals['read']} pastes read so far")
+
+        self.stderr.write(self.style.SUCCESS(
+            f"Imported {totals['inserted']} pastes in {time.perf_counter() - started:.1f}s, "
+            f"skipped {totals['skipped']} that already existed"
+        ))
+        if totals['unknown_language']:
+            self.stderr.write(self.style.WARNING(
+                f"{totals['unknown_language']} pastes had a language missing here and were imported without one"
+            ))
+
+    def paste(self, name, number, line, languages, totals):
+        try:
+            row = json.loads(line)
+            paste = Paste(
+                id=row['id'],
+                created=datetime.fromisoformat(row['created']),
+                expires=datetime.fromisoformat(row['expires']) if row['expires'] else None,
+                one_time=row['one_time'],
+                view_count=row['view_count'],
+                lang_id=languages.get(row['language']),
+                owner_id=row['owner'],
+                salt=row['salt'],
+                iv=row['iv'],
+                ciphertext=row['ciphertext'],
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            raise CommandError(f'{name}, line {number}: {e!r}')
+        if row['language'] is not None and paste.lang_id is None:
+            totals['unknown_language'] += 1
+        paste.size, paste.line_count, paste.preview = paste_metadata(paste.ciphertext, paste.salt)
+        return paste
+
+    def insert(self, pastes, database, totals):
+        owners = {paste.owner_id for paste in pastes if paste.owner_id is not None}
+        if owners:
+            owners = set(User.objects.using(database).filter(id__in=owners).values_list('id', flat=True))
+            for paste in pastes:
+                if paste.owner_id not in owners:
+                    paste.owner_id = None
+        with transaction.atomic(using=database):
+            existing = set(
+                Paste.objects.using(database).filter(id__in=[paste.id for paste in pastes]).values_list('id', flat=True)
+            )
+            new = [paste for paste in pastes if paste.id not in existing]
+            # Also skips pastes created by the site between the check and the insert
+            Paste.objects.using(database).bulk_create(new, ignore_conflicts=True)
+        totals['inserted'] += len(new)
+        totals['skipped'] += len(pastes) - len(new)
@@ -0,0 +1,98 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter: boot the way a worker does and report wall time and peak RSS
+BOOT = """
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+for name in sys.argv[1:]:
+    importlib.import_module(name)
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'modules': len(sys.modules),
+}))
+"""
+
+TARGETS = {
+    'asgi': ['pastebinir.asgi'],
+    'wsgi': ['pastebinir.wsgi'],
+}
+
+
+class Command(BaseCommand):
+    help = 'Report the import time per module of a cold worker start, its total boot time and peak memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=list(TARGETS), default='asgi', help='Kind of process to boot')
+        parser.add_argument('--import', dest='modules', nargs='*', default=[],
+                            help='Also import these modules, e.g. api.duck_ai to see the cost of a lazy subsystem')
+        parser.add_argument('--top', type=int, default=25, help='Modules listed')
+        parser.add_argument('--sort', choices=['self', 'cumulative'], default='cumulative')
+        parser.add_argument('--repeat', type=int, default=3, help='Boots measured; medians are reported')
+
+    def handle(self, *args, **options):
+        modules = TARGETS[options['target']] + options['modules']
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        runs = [self.boot(modules, env) for _ in range(options['repeat'])]
+
+        # Per module medians of (self, cumulative) microseconds over the runs
+        samples = defaultdict(list)
+        for timings, _ in runs:
+            for name, timing in timings.items():
+                samples[name].append(timing)
+        timings = {
+            name: (statistics.median(t[0] for t in values), statistics.median(t[1] for t in values))
+            for name, values in samples.items()
+        }
+        column = 0 if options['sort'] == 'self' else 1
+        ranked = sorted(timings.items(), key=lambda item: item[1][column], reverse=True)
+
+        self.stdout.write(f"{'self ms':>9}{'cumul ms':>10}  module")
+        for name, (own, cumulative) in ranked[:options['top']]:
+            self.stdout.write(f"{own / 1000:>9.1f}{cumulative / 1000:>10.1f}  {name}")
+
+        packages = defaultdict(float)
+        for name, (own, _) in timings.items():
+            packages[name.split('.')[0]] += own
+        self.stdout.write('')
+        self.stdout.write(f"{'self ms':>9}  package")
+        for package, own in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:options['top']]:
+            self.stdout.write(f"{own / 1000:>9.1f}  {package}")
+
+        reports = [report for _, report in runs]
+        self.stdout.write('')
+        self.stdout.write(
+            f"Boot: {statistics.median(r['seconds'] for r in reports) * 1000:.0f} ms, "
+            f"peak RSS {statistics.median(r['rss'] for r in reports) / 2 ** 20:.1f} MB, "
+            f"{reports[0]['modules']} modules loaded (median of {len(reports)} runs)"
+        )
+
+    def boot(self, modules, env):
+        """Boot once; returns ({module: (self us, cumulative us)}, report)"""
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT, *modules],
+            env=env, cwd=settings.BASE_DIR, capture_output=True, text=True,
+        )
+        if result.returncode:
+            raise CommandError(f'Boot failed:\n{result.stderr[-2000:]}')
+        timings = {}
+        for line in result.stderr.splitlines():
+            # "import time: <self us> | <cumulative us> | <indented module name>"
+            if not line.startswith('import time:'):
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            if own.strip().isdigit():
+                timings[name.strip()] = (int(own), int(cumulative))
+        return timings, json.loads(result.stdout.strip().splitlines()[-1])
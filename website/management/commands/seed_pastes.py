@@ -0,0 +1,193 @@
+import base64
+import itertools
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from website.models import Language, Paste, paste_metadata
+
+ID_SPACE = 16 ** 6  # generate_unique_id() hands out 6 hex digits
+
+# (share, lifetime) of the expiration choices of the create form; None never expires
+EXPIRATIONS = [
+    (0.40, None),
+    (0.10, timedelta(minutes=10)),
+    (0.10, timedelta(hours=1)),
+    (0.15, timedelta(days=1)),
+    (0.15, timedelta(days=7)),
+    (0.10, timedelta(days=30)),
+]
+
+LINES = [
+    'import os',
+    'from collections import defaultdict',
+    'def handle(request, *args, **kwargs):',
+    '    return render(request, "index.html", context)',
+    '    for item in items:',
+    '        total += item.price * item.quantity',
+    'class Config(object):',
+    '    DEBUG = False',
+    'SELECT id, name FROM users WHERE active = true ORDER BY created DESC;',
+    'const response = await fetch(url, { method: "POST", body: JSON.stringify(data) });',
+    'console.log(`Loaded ${rows.length} rows`);',
+    'if err != nil {',
+    '    return nil, fmt.Errorf("open %s: %w", path, err)',
+    '}',
+    'public static void main(String[] args) {',
+    '    System.out.println("Hello, world");',
+    '#include <stdio.h>',
+    'echo "Deploying $VERSION to $HOST"',
+    '<div class="container"><p>{{ message }}</p></div>',
+    'Traceback (most recent call last):',
+    '  File "/app/manage.py", line 22, in <module>',
+    'ERROR 2024-01-01 12:00:00,000 request failed: connection refused',
+    '',
+    '# TODO: handle the empty case',
+]
+
+
+class IdBitmap:
+    """Set of 6 hex digit paste IDs, one bit each"""
+
+    def __init__(self):
+        self.bits = bytearray(ID_SPACE // 8)
+        self.count = 0
+
+    def add(self, value):
+        byte, bit = divmod(value, 8)
+        if self.bits[byte] >> bit & 1:
+            return False
+        self.bits[byte] |= 1 << bit
+        self.count += 1
+        return True
+
+
+class Command(BaseCommand):
+    help = (
+        'Insert synthetic pastes for capacity testing: sizes, languages, expirations, one-time and '
+        'password-protected pastes follow distributions like the real ones, and IDs come from the same '
+        '6 hex digit space generate_unique_id() uses. Rows are streamed with COPY on PostgreSQL '
+        '(bulk_create elsewhere). The same --seed, --now and existing IDs give the same pastes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Pastes to insert')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--now', type=datetime.fromisoformat,
+                            help='Reference time (ISO 8601), defaults to the current time')
+        parser.add_argument('--days', type=float, default=90, help='Creation times spread over this many days before --now')
+        parser.add_argument('--median-size', type=int, default=1500, help='Median paste size in bytes')
+        parser.add_argument('--max-size', type=int, default=2 * 2 ** 20, help='Largest paste in bytes')
+        parser.add_argument('--one-time', type=float, default=0.05, help='Share of one-time pastes')
+        parser.add_argument('--encrypted', type=float, default=0.10, help='Share of password-protected pastes')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per transaction')
+
+    def handle(self, *args, **options):
+        languages = list(Language.objects.order_by('id').values_list('id', flat=True))
+        if not languages:
+            raise CommandError('Add at least one language first')
+        taken = IdBitmap()
+        for paste_id in Paste.objects.values_list('id', flat=True).iterator(chunk_size=10000):
+            try:
+                taken.add(int(paste_id, 16))
+            except ValueError:
+                continue
+        if taken.count + options['count'] > ID_SPACE:
+            raise CommandError(f'Only {ID_SPACE - taken.count} IDs are left')
+
+        now = options['now'] or timezone.now()
+        if timezone.is_naive(now):
+            now = timezone.make_aware(now)
+        rows = self.rows(random.Random(options['seed']), languages, taken, now, options)
+        insert = self.copy if connection.vendor == 'postgresql' else self.bulk_create
+        columns = [field.column for field in Paste._meta.concrete_fields]
+
+        started = time.perf_counter()
+        inserted = 0
+        while inserted < options['count']:
+            batch = [next(rows) for _ in range(min(options['batch_size'], options['count'] - inserted))]
+            with transaction.atomic():
+                insert(columns, batch)
+            inserted += len(batch)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'{inserted}/{options["count"]} pastes, {inserted / elapsed:.0f}/s')
+
+        used = taken.count / ID_SPACE
+        self.stdout.write(self.style.SUCCESS(
+            f'Inserted {inserted} pastes in {time.perf_counter() - started:.1f}s. {used:.1%} of the ID space '
+            f'is in use; generate_unique_id() now needs {1 / (1 - used):.2f} lookups per paste on average.'
+        ))
+
+    def copy(self, columns, batch):
+        table = connection.ops.quote_name(Paste._meta.db_table)
+        names = ', '.join(connection.ops.quote_name(column) for column in columns)
+        with connection.cursor() as cursor:
+            with cursor.cursor.copy(f'COPY {table} ({names}) FROM STDIN') as copy:
+                for row in batch:
+                    copy.write_row(row)
+
+    def bulk_create(self, columns, batch):
+        attnames = [field.attname for field in Paste._meta.concrete_fields]
+        Paste.objects.bulk_create(Paste(**dict(zip(attnames, row))) for row in batch)
+
+    def rows(self, rng, languages, taken, now, options):
+        """Endless rows of website_paste, in concrete field order"""
+        # Popular languages dominate: weights follow Zipf's law over a seeded ranking
+        ranking = languages[:]
+        rng.shuffle(ranking)
+        language_weights = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(ranking) + 1)))
+        lifetimes = [lifetime for _, lifetime in EXPIRATIONS]
+        lifetime_weights = list(itertools.accumulate(share for share, _ in EXPIRATIONS))
+        # Log-normal sizes: mostly small, a long tail of large ones
+        mu = math.log(options['median_size'])
+        span = timedelta(days=options['days']).total_seconds()
+        fields = [field.attname for field in Paste._meta.concrete_fields]
+        # Bodies are cut from one block of random lines, joining lines per paste is too slow
+        corpus = '\n'.join(rng.choice(LINES) for _ in range(20000))
+
+        while True:
+            value = rng.getrandbits(24)
+            while not taken.add(value):
+                value = rng.getrandbits(24)
+            size = max(1, min(options['max_size'], int(rng.lognormvariate(mu, 1.4))))
+            created = now - timedelta(seconds=rng.random() * span)
+            lifetime = rng.choices(lifetimes, cum_weights=lifetime_weights)[0]
+            one_time = rng.random() < options['one_time']
+            if rng.random() < options['encrypted']:
+                salt = base64.b64encode(rng.randbytes(16)).decode()
+                iv = base64.b64encode(rng.randbytes(16)).decode()
+                ciphertext = base64.b64encode(rng.randbytes(size)).decode()
+            else:
+                salt = iv = None
+                ciphertext = self.content(rng, corpus, size)
+            size, line_count, preview = paste_metadata(ciphertext, salt)
+            # One-time pastes are consumed on their first view, the rest are viewed a few times
+            view_count = rng.choice((0, 1, 1, 2)) if one_time else int(rng.expovariate(1 / 3))
+            row = {
+                'id': f'{value:06x}',
+                'created': created,
+                'one_time': one_time,
+                'view_count': view_count,
+                'expires': created + lifetime if lifetime else None,
+                'lang_id': rng.choices(ranking, cum_weights=language_weights)[0],
+                'owner_id': None,
+                'salt': salt,
+                'iv': iv,
+                'ciphertext': ciphertext,
+                'size': size,
+                'line_count': line_count,
+                'preview': preview,
+            }
+            yield tuple(row[name] for name in fields)
+
+    def content(self, rng, corpus, size):
+        """size characters of corpus from a random offset, wrapping around"""
+        start = rng.randrange(len(corpus))
+        if start + size <= len(corpus):
+            return corpus[start:start + size]
+        return (corpus * ((start + size) // len(corpus) + 1))[start:start + size]
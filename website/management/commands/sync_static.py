@@ -0,0 +1,74 @@
+import hashlib
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+MANIFEST = 'staticfiles.json'
+SOURCE_DIGEST = '.source-digest'
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def source_digest():
+    """Digest of every file collectstatic would collect, names and contents"""
+    digest = hashlib.sha256()
+    found = sorted(
+        (path, storage.path(path))
+        for finder in finders.get_finders()
+        for path, storage in finder.list(['CVS', '.*', '*~'])
+    )
+    for path, location in found:
+        digest.update(path.encode() + b'\0' + file_digest(location).encode())
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        'Bring STATIC_ROOT up to date for boot: copy the collection made at image build time '
+        '(STATIC_BUILD_ROOT) when its manifest differs from the one in STATIC_ROOT, or run '
+        'collectstatic when there is no build and the static sources changed. Does nothing otherwise.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Copy or collect even if nothing changed')
+
+    def handle(self, *args, **options):
+        build_root = Path(settings.STATIC_BUILD_ROOT)
+        static_root = Path(settings.STATIC_ROOT)
+        if (build_root / MANIFEST).exists():
+            self.copy_build(build_root, static_root, options['force'])
+        else:
+            self.collect(static_root, options['force'], options['verbosity'])
+
+    def copy_build(self, build_root, static_root, force):
+        digest = file_digest(build_root / MANIFEST)
+        if not force and digest == file_digest(static_root / MANIFEST):
+            self.stdout.write(f'Static files unchanged ({digest[:12]}), skipping')
+            return
+        static_root.mkdir(parents=True, exist_ok=True)
+        # Files of the previous build stay, pages cached by clients may still use them.
+        # The manifest goes last so an interrupted copy is redone on the next boot.
+        shutil.copytree(build_root, static_root, dirs_exist_ok=True,
+                        ignore=lambda directory, names: [MANIFEST] if Path(directory) == build_root else [])
+        shutil.copy2(build_root / MANIFEST, static_root / MANIFEST)
+        self.stdout.write(f'Copied static files build {digest[:12]} to {static_root}')
+
+    def collect(self, static_root, force, verbosity):
+        digest = source_digest()
+        digest_file = static_root / SOURCE_DIGEST
+        if not force and (static_root / MANIFEST).exists() and digest_file.exists() \
+                and digest_file.read_text() == digest:
+            self.stdout.write(f'Static sources unchanged ({digest[:12]}), skipping collectstatic')
+            return
+        call_command('collectstatic', interactive=False, verbosity=verbosity)
+        digest_file.write_text(digest)
@@ -0,0 +1,34 @@
+# Generated manually based on website/models.py
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_token', models.CharField(max_length=43)),
+                ('created', models.DateTimeField()),
+                ('preview', models.CharField(blank=True, default='', max_length=120)),
+                ('paste', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='website.paste')),
+            ],
+            options={
+                'ordering': ['-created', '-id'],
+                'indexes': [
+                    models.Index(fields=['client_token', '-created', '-id'], name='website_history_token_idx'),
+                    models.Index(fields=['paste'], name='website_history_paste_idx'),
+                ],
+                'constraints': [
+                    models.UniqueConstraint(fields=('client_token', 'paste'), name='unique_history_entry'),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated manually based on website/models.py
+
+from django.db import migrations, models
+
+
+def make_preview(content, length=100):
+    """Copy of website.models.make_preview() as of this migration"""
+    preview = ' '.join(content[:length * 4].split())
+    if len(preview) > length:
+        preview = preview[:length - 3].rstrip() + '...'
+    return preview
+
+
+def fill_metadata(apps, schema_editor):
+    Paste = apps.get_model('website', 'Paste')
+    batch = []
+    for paste in Paste.objects.only('id', 'salt', 'ciphertext').iterator(chunk_size=2000):
+        if paste.salt:
+            paste.size = len(paste.ciphertext) * 3 // 4 - paste.ciphertext[-2:].count('=')
+        else:
+            paste.size = len(paste.ciphertext.encode())
+            paste.line_count = paste.ciphertext.count('\n') + 1 if paste.ciphertext else 0
+            paste.preview = make_preview(paste.ciphertext)
+        batch.append(paste)
+        if len(batch) >= 2000:
+            Paste.objects.bulk_update(batch, ['size', 'line_count', 'preview'])
+            batch = []
+    if batch:
+        Paste.objects.bulk_update(batch, ['size', 'line_count', 'preview'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0002_history_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paste',
+            name='size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='paste',
+            name='line_count',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='paste',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=120),
+        ),
+        migrations.RunPython(fill_metadata, migrations.RunPython.noop),
+    ]
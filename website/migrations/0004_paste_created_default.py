@@ -0,0 +1,19 @@
+# Generated manually based on website/models.py
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0003_paste_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paste',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
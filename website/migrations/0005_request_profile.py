@@ -0,0 +1,33 @@
+# Generated manually based on website/models.py
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0004_paste_created_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=2048)),
+                ('view', models.CharField(blank=True, default='', max_length=200)),
+                ('status', models.PositiveSmallIntegerField()),
+                ('duration', models.FloatField(help_text='Seconds until the response was returned')),
+                ('reason', models.CharField(choices=[('sampled', 'Sampled and slow'), ('requested', 'Requested by header')], max_length=10)),
+                ('query_count', models.PositiveIntegerField(default=0)),
+                ('query_seconds', models.FloatField(default=0)),
+                ('stacks', models.JSONField()),
+                ('queries', models.JSONField(default=list)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -1,7 +1,25 @@
-from datetime import timezone
+import secrets
 from django.db import models
+from django.utils import timezone
 
 
+def make_preview(content, encrypted=False, length=100):
+    """Short single-line preview of a paste body"""
+    if encrypted:
+        return 'Password protected'
+    preview = ' '.join(content[:length * 4].split())
+    if len(preview) > length:
+        preview = preview[:length - 3].rstrip() + '...'
+    return preview
+
+
+def paste_metadata(ciphertext, salt):
+    """(size, line_count, preview) of a paste body, see Paste.compute_metadata()"""
+    if salt:
+        # base64 of AES-CFB output, which is as long as the plaintext
+        return len(ciphertext) * 3 // 4 - ciphertext[-2:].count('='), None, ''
+    line_count = ciphertext.count('\n') + 1 if ciphertext else 0
+    return len(ciphertext.encode()), line_count, make_preview(ciphertext)
 
 
 class Language(models.Model):
@@ -27,9 +45,34 @@ class User(models.Model):
         return self.name
 
 
+class PasteQuerySet(models.QuerySet):
+    def listing(self):
+        """Pastes without their body, for anything that only lists them"""
+        return self.defer('ciphertext')
+
+    def available(self):
+        """Pastes that may still be shown, see pasteCheck()"""
+        return self.exclude(expires__lt=timezone.now()).exclude(one_time=True, view_count__gt=1)
+
+    def allocate_ids(self, count):
+        """
+        count unused paste IDs, probing the table and the write-behind queue
+        for collisions once per round
+        """
+        from .write_behind import pending_ids
+
+        ids = set()
+        while len(ids) < count:
+            candidates = {secrets.token_hex(3) for _ in range(count - len(ids))} - ids
+            taken = set(self.filter(id__in=candidates).values_list('id', flat=True))
+            ids |= candidates - taken - pending_ids(candidates - taken)
+        return list(ids)
+
+
 class Paste(models.Model):
     id = models.CharField(max_length=6, primary_key=True, editable=False, db_index=True)
-    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Not auto_now_add, so pastes flushed later by the write-behind queue keep their creation time
+    created = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
     one_time = models.BooleanField(default=False, db_index=True)
     view_count = models.IntegerField(default=0)
     expires = models.DateTimeField(blank=True, null=True, db_index=True)
@@ -38,9 +81,41 @@ class Paste(models.Model):
     salt = models.CharField(max_length=24, blank=True, null=True, default=None)
     iv = models.CharField(max_length=24, blank=True, null=True, default=None)
     ciphertext = models.TextField()
+    # Derived from the body on save so listings never need the body
+    size = models.PositiveIntegerField(default=0)
+    line_count = models.PositiveIntegerField(blank=True, null=True, default=None)
+    preview = models.CharField(max_length=120, blank=True, default='')
+
+    objects = PasteQuerySet.as_manager()
     
     def __str__(self):
         return f"Paste {self.id}"
+
+    def compute_metadata(self):
+        """
+        Fill size, line_count and preview from the body. Only the size is
+        kept for password-protected pastes.
+        """
+        self.size, self.line_count, self.preview = paste_metadata(self.ciphertext, self.salt)
+
+    def history_preview(self):
+        """Preview stored in HistoryEntry, which also stands in for protected pastes"""
+        return make_preview('', encrypted=True) if self.salt else self.preview
+
+    def save(self, *args, update_fields=None, **kwargs):
+        adding, preview = self._state.adding, self.preview
+        # Whenever the body may be written; a deferred body is not, unless named
+        body_written = (
+            not {'ciphertext', 'salt'} & self.get_deferred_fields() if update_fields is None
+            else bool({'ciphertext', 'salt'} & set(update_fields))
+        )
+        if body_written:
+            self.compute_metadata()
+            if update_fields is not None:
+                update_fields = {*update_fields, 'size', 'line_count', 'preview'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+        if body_written and not adding and self.preview != preview:
+            HistoryEntry.objects.filter(paste_id=self.id).update(preview=self.history_preview())
     
     class Meta:
         ordering = ['-created']
@@ -48,3 +123,53 @@ class Paste(models.Model):
             models.Index(fields=['created', 'expires']),
             models.Index(fields=['one_time', 'view_count']),
         ]
+
+
+class HistoryEntry(models.Model):
+    """A paste in an anonymous client's history, keyed by their history token"""
+    client_token = models.CharField(max_length=43)
+    # No cascade: deleting pastes must stay a fast bulk delete, entries are
+    # removed alongside them explicitly
+    paste = models.ForeignKey(Paste, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    created = models.DateTimeField()
+    preview = models.CharField(max_length=120, blank=True, default='')
+
+    def __str__(self):
+        return f"History {self.client_token[:8]} - {self.paste_id}"
+
+    class Meta:
+        ordering = ['-created', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['client_token', 'paste'], name='unique_history_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['client_token', '-created', '-id'], name='website_history_token_idx'),
+            models.Index(fields=['paste'], name='website_history_paste_idx'),
+        ]
+
+
+class RequestProfile(models.Model):
+    """Sampled stacks and SQL of a profiled request, see pastebinir/profiling.py"""
+    SAMPLED = 'sampled'
+    REQUESTED = 'requested'
+    REASONS = [(SAMPLED, 'Sampled and slow'), (REQUESTED, 'Requested by header')]
+
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2048)
+    view = models.CharField(max_length=200, blank=True, default='')
+    status = models.PositiveSmallIntegerField()
+    duration = models.FloatField(help_text='Seconds until the response was returned')
+    reason = models.CharField(max_length=10, choices=REASONS)
+    query_count = models.PositiveIntegerField(default=0)
+    query_seconds = models.FloatField(default=0)
+    # {'interval', 'frames': [[file, line, function]], 'samples': [[frame indexes]], 'weights': [seconds]}
+    stacks = models.JSONField()
+    # [{'sql', 'seconds', 'alias'}], without parameters
+    queries = models.JSONField(default=list)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration:.3f}s)"
+
+    class Meta:
+        ordering = ['-created']
@@ -0,0 +1,351 @@
+"""
+Two-tier cache of paste rows for the paste views.
+
+Rows are looked up in a small per-process LRU first, then in Redis, then in
+the database. Deletions go through invalidate_paste_cache(), which drops the
+Redis copy and publishes the IDs on a Redis channel; every process listens on
+that channel and evicts its local copies, so a deleted paste stops being
+served everywhere. Local entries also expire after PASTE_LOCAL_CACHE_TTL
+seconds in case a message is missed.
+
+A reader may load a row from the database just before the paste is deleted
+and store it after the invalidation. To keep such rows out, the invalidation
+leaves a tombstone in Redis for PASTE_ROW_TOMBSTONE_TIMEOUT seconds that the
+Redis fill checks atomically, and a local fill is dropped when anything was
+evicted locally since the row was read.
+
+The Redis tier is read through this module's own client rather than the
+Django cache, so a fill can check the tombstone atomically.
+
+One-time pastes are never cached, their view count decides whether they may
+still be shown. For every other paste view counts are buffered per process and
+added to the database every PASTE_VIEW_COUNT_FLUSH_INTERVAL seconds, so a hot
+paste costs neither a read nor a write per view. Counts still buffered when a
+process exits are written by an atexit handler; only a killed process loses
+them. Views of one-time pastes and of pastes still queued for write-behind
+(which have no row to update yet) are saved right away, which inserts a
+queued paste.
+"""
+import atexit
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import redis
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from pastebinir.db_router import PRIMARY, using_replica
+from pastebinir.metrics import cache_lookup
+
+from .models import Language, Paste
+from . import write_behind
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'pastes:invalidate'
+
+_LANG_FIELDS = [field.attname for field in Language._meta.concrete_fields]
+_PASTE_FIELDS = [field.attname for field in Paste._meta.concrete_fields]
+
+
+def paste_row_key(paste_id):
+    """Key of the cached row of a paste in Redis"""
+    return f'paste_row_{paste_id}'
+
+
+def paste_tombstone_key(paste_id):
+    """Key set for a while after a paste is invalidated, see _FILL"""
+    return f'paste_row_deleted_{paste_id}'
+
+
+# KEYS: row, tombstone; ARGV: row, timeout
+_FILL = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+class LocalCache:
+    """Thread-safe LRU of paste rows bounded by entry count and total body size"""
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Bumped by every eviction, see set()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, paste_id):
+        with self.lock:
+            entry = self.entries.get(paste_id)
+            if entry is None:
+                return None
+            expires, row = entry
+            if expires < time.monotonic():
+                self._remove(paste_id)
+                return None
+            self.entries.move_to_end(paste_id)
+            return row
+
+    def set(self, paste_id, row, generation):
+        """
+        Keep row unless something was evicted since generation, the value of
+        self.generation read before the row: it may be a deleted paste's.
+        """
+        size = len(row['ciphertext'])
+        if size > self.max_bytes // 4:
+            # One huge paste would push out everything else
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._remove(paste_id)
+            self.entries[paste_id] = (time.monotonic() + self.ttl, row)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+
+    def evict(self, paste_ids):
+        with self.lock:
+            self.generation += 1
+            for paste_id in paste_ids:
+                self._remove(paste_id)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, paste_id):
+        entry = self.entries.pop(paste_id, None)
+        if entry is not None:
+            self.bytes -= len(entry[1]['ciphertext'])
+
+
+local_cache = LocalCache(
+    settings.PASTE_LOCAL_CACHE_ENTRIES, settings.PASTE_LOCAL_CACHE_MAX_BYTES, settings.PASTE_LOCAL_CACHE_TTL,
+)
+
+_client = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.PASTE_CACHE_INVALIDATION_REDIS_URL)
+    return _client
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Whatever was published while unsubscribed has been missed
+            local_cache.clear()
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    local_cache.evict(message['data'].decode().split(','))
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Paste invalidation channel lost, retrying: {e}")
+            local_cache.clear()
+            time.sleep(1)
+
+
+def _ensure_listener():
+    """Start this process' invalidation listener; a forked worker starts its own"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            threading.Thread(target=_listen, name='paste-cache-invalidation', daemon=True).start()
+            _listener_pid = os.getpid()
+
+
+def _enabled():
+    # Both tiers need the Redis deployment: with the local memory cache backend
+    # a deletion in one process could not reach the others
+    return bool(settings.PASTE_CACHE_INVALIDATION_REDIS_URL)
+
+
+def _to_row(paste):
+    row = {name: getattr(paste, name) for name in _PASTE_FIELDS}
+    row['lang'] = {name: getattr(paste.lang, name) for name in _LANG_FIELDS} if paste.lang_id else None
+    return row
+
+
+def _from_row(row):
+    row = dict(row)
+    lang = row.pop('lang')
+    paste = Paste(**row)
+    paste._state.adding = False
+    paste._state.db = 'default'
+    if lang is not None:
+        language = Language(**lang)
+        language._state.adding = False
+        language._state.db = 'default'
+        paste.lang = language
+    return paste
+
+
+def _loads(data):
+    return pickle.loads(data) if data is not None else None
+
+
+def _cacheable_row(paste):
+    """The row to cache for paste; None when it must not be cached"""
+    if paste.one_time:
+        return None
+    return _to_row(paste)
+
+
+def _fill(paste_id, row, generation):
+    """Cache a row read from the database in both tiers, unless the paste was invalidated meanwhile"""
+    try:
+        stored = get_redis().register_script(_FILL)(
+            keys=[paste_row_key(paste_id), paste_tombstone_key(paste_id)],
+            args=[pickle.dumps(row), settings.PASTE_ROW_CACHE_TIMEOUT],
+        )
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Paste row cache unavailable: {e}")
+        stored = True
+    if stored:
+        local_cache.set(paste_id, row, generation)
+
+
+def get_paste(paste_id):
+    """
+    The paste with that ID from the nearest tier that has it, including pastes
+    still queued for write-behind. Raises Paste.DoesNotExist otherwise.
+    """
+    enabled = _enabled()
+    generation = local_cache.generation
+    if enabled:
+        _ensure_listener()
+        row = local_cache.get(paste_id)
+        cache_lookup('paste_local', row is not None)
+        if row is not None:
+            return _from_row(row)
+        try:
+            row = _loads(get_redis().get(paste_row_key(paste_id)))
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Paste row cache unavailable: {e}")
+        cache_lookup('paste_redis', row is not None)
+        if row is not None:
+            local_cache.set(paste_id, row, generation)
+            return _from_row(row)
+
+    try:
+        paste = Paste.objects.select_related('lang').get(id=paste_id)
+        if paste.one_time and using_replica():
+            # Whether it may still be shown depends on an up to date view count
+            paste = Paste.objects.using(PRIMARY).select_related('lang').get(id=paste_id)
+    except Paste.DoesNotExist:
+        try:
+            if not using_replica():
+                raise
+            # Possibly created moments ago and not replicated yet
+            paste = Paste.objects.using(PRIMARY).select_related('lang').get(id=paste_id)
+        except Paste.DoesNotExist:
+            paste = write_behind.pending_paste(paste_id)
+            if paste is None:
+                raise
+            return paste
+    row = _cacheable_row(paste) if enabled else None
+    if row is not None:
+        _fill(paste_id, row, generation)
+    return paste
+
+
+def publish_invalidation(paste_ids):
+    """
+    Drop the cached rows of the given pastes and tell every process to drop
+    its local copies
+    """
+    local_cache.evict(paste_ids)
+    if not _enabled():
+        return
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            # Tombstones first, so no fill can slip in after the delete
+            for paste_id in paste_ids:
+                pipe.set(paste_tombstone_key(paste_id), 1, ex=settings.PASTE_ROW_TOMBSTONE_TIMEOUT)
+            pipe.delete(*[paste_row_key(paste_id) for paste_id in paste_ids])
+            pipe.publish(INVALIDATION_CHANNEL, ','.join(paste_ids))
+            pipe.execute()
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not publish paste invalidation: {e}")
+
+
+_views = Counter()
+_views_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _buffer_view(paste):
+    """Count a view in memory; returns the counts due for flushing, if any"""
+    global _last_flush
+    with _views_lock:
+        _views[paste.id] += 1
+        now = time.monotonic()
+        if now - _last_flush < settings.PASTE_VIEW_COUNT_FLUSH_INTERVAL:
+            return None
+        pending = dict(_views)
+        _views.clear()
+        _last_flush = now
+    return pending
+
+
+def _save_view(paste):
+    paste.view_count += 1
+    try:
+        with transaction.atomic():
+            # Inserts a queued paste
+            paste.save()
+    except IntegrityError:
+        # A queued paste inserted meanwhile, by the flush or another view
+        Paste.objects.filter(id=paste.id).update(view_count=F('view_count') + 1)
+
+
+def record_view(paste):
+    """Count a view of paste"""
+    if paste.one_time or getattr(paste, 'pending', False):
+        # The count of a one-time paste decides whether it may be shown again,
+        # and a queued paste has no row a buffered count could update
+        _save_view(paste)
+        return
+    pending = _buffer_view(paste)
+    if pending:
+        flush_views(pending)
+
+
+def flush_views(counts):
+    for paste_id, count in counts.items():
+        Paste.objects.filter(id=paste_id).update(view_count=F('view_count') + count)
+
+
+@atexit.register
+def _flush_buffered_views():
+    with _views_lock:
+        counts = dict(_views)
+        _views.clear()
+    if counts:
+        try:
+            flush_views(counts)
+        except Exception as e:
+            logger.warning(f"Could not write buffered view counts at exit: {e}")
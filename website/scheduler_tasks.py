@@ -1,7 +1,10 @@
 from scheduler import job
 from django.utils import timezone
-from django.core.cache import cache
+from .cache_utils import invalidate_paste_cache
+from .history import forget_pastes
 from .models import Paste
+from . import write_behind
+from pastebinir.metrics import CLEANUP_BATCH_PASTES
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,18 +38,18 @@ def cleanup_expired_pastes():
         pastes_to_delete = pastes_to_delete.distinct()
         
         count = pastes_to_delete.count()
+        CLEANUP_BATCH_PASTES.observe(count)
         
         if count > 0:
             # Store paste IDs for cache cleanup
             paste_ids = list(pastes_to_delete.values_list('id', flat=True))
             
-            # Delete the pastes
-            pastes_to_delete.delete()
+            # Delete exactly the pastes invalidated below, not whatever the filter matches by now
+            Paste.objects.filter(id__in=paste_ids).delete()
+            forget_pastes(paste_ids)
             
             # Clear related cache entries
-            for paste_id in paste_ids:
-                cache_key = f'paste_{paste_id}'
-                cache.delete(cache_key)
+            invalidate_paste_cache(paste_ids)
             
             logger.info(f"Automated cleanup: Deleted {count} expired/one-time pastes")
         else:
@@ -59,6 +62,21 @@ def cleanup_expired_pastes():
         raise
 
 
+@job(schedule="* * * * *")  # Every minute
+def flush_pending_pastes():
+    """
+    Insert pastes queued by write-behind creation (PASTE_WRITE_BEHIND).
+    """
+    try:
+        count = write_behind.flush()
+        if count:
+            logger.info(f"Flushed {count} pending pastes")
+        return f"Flushed {count} pending pastes"
+    except Exception as e:
+        logger.error(f"Error flushing pending pastes: {e}")
+        raise
+
+
 @job
 def cleanup_single_paste(paste_id):
     """
@@ -79,7 +97,8 @@ def cleanup_single_paste(paste_id):
         
         if should_delete:
             paste.delete()
-            cache.delete(f'paste_{paste_id}')
+            forget_pastes([paste_id])
+            invalidate_paste_cache([paste_id])
             logger.info(f"Deleted paste {paste_id}")
             return f"Deleted paste {paste_id}"
         else:
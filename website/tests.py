@@ -1,3 +1,357 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import ResolverMatch, get_resolver
+
+from pastebinir import db_router, metrics, ratelimit, sessions
+from pastebinir.db_router import PRIMARY, STICKY_COOKIE, ReplicaRouter, ReplicaRoutingMiddleware, replica_reads, using_replica
+from pastebinir.profiling import ProfilingMiddleware
+from website import history, paste_cache, write_behind
+from website.models import HistoryEntry, Language, Paste, RequestProfile
+
+# Pages render without collected static files
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+@override_settings(PASTE_WRITE_BEHIND=True, PASTE_WRITE_BEHIND_REDIS_URL='redis://write-behind',
+                   PASTE_CACHE_INVALIDATION_REDIS_URL=None, STORAGES=STORAGES)
+class PendingPasteViewTests(TestCase):
+    """Pastes still queued for write-behind, served by the paste views"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lang = Language.objects.create(displayname='Python', alias='python')
+
+    def setUp(self):
+        paste = Paste(id='abc123', ciphertext='print("pending")', lang=self.lang)
+        paste.compute_metadata()
+        client = mock.Mock()
+        client.hget.side_effect = lambda key, paste_id: write_behind._dump(paste) if paste_id == paste.id else None
+        patcher = mock.patch.object(write_behind, 'get_redis', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pending_paste_has_its_language(self):
+        paste = write_behind.pending_paste('abc123')
+        with self.assertNumQueries(0):
+            self.assertEqual(paste.lang.alias, 'python')
+
+    def test_view(self):
+        response = self.client.get('/abc123/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'pending')
+        # The view count cannot be buffered, there is no row yet
+        self.assertEqual(Paste.objects.get(id='abc123').view_count, 1)
+
+    def test_raw_view(self):
+        response = self.client.get('/abc123/raw/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'pending')
+
+
+class PasteMetadataTests(TestCase):
+    def test_edited_body_updates_metadata_and_history(self):
+        paste = Paste.objects.create(id='abc123', ciphertext='old')
+        token = history.record_paste(None, paste)
+        paste.ciphertext = 'new\nbody'
+        paste.save()
+        paste.refresh_from_db()
+        self.assertEqual((paste.size, paste.line_count, paste.preview), (8, 2, 'new body'))
+        self.assertEqual(HistoryEntry.objects.get(client_token=token).preview, 'new body')
+
+    def test_update_fields_naming_the_body(self):
+        Paste.objects.create(id='abc123', ciphertext='old')
+        paste = Paste.objects.listing().get(id='abc123')
+        paste.ciphertext = 'newer'
+        paste.save(update_fields=['ciphertext'])
+        self.assertEqual(Paste.objects.get(id='abc123').preview, 'newer')
+
+    def test_deferred_body_is_left_alone(self):
+        Paste.objects.create(id='abc123', ciphertext='body')
+        paste = Paste.objects.listing().get(id='abc123')
+        paste.view_count = 3
+        with self.assertNumQueries(1):
+            paste.save()
+        self.assertEqual(Paste.objects.get(id='abc123').preview, 'body')
+
+
+# Redis is down, so the pastes are cached in this process only
+@override_settings(PASTE_CACHE_INVALIDATION_REDIS_URL='redis://paste-cache', STORAGES=STORAGES)
+class PasteAdminTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(paste_cache, 'get_redis', side_effect=redis.ConnectionError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(paste_cache, '_ensure_listener')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        paste_cache.local_cache.clear()
+        self.addCleanup(paste_cache.local_cache.clear)
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def cached_paste(self, paste_id):
+        Paste.objects.create(id=paste_id, ciphertext='print(1)')
+        with self.assertLogs('website.paste_cache', 'WARNING'):
+            self.assertEqual(self.client.get(f'/{paste_id}/raw/').status_code, 200)
+        return history.record_paste(None, Paste.objects.get(id=paste_id))
+
+    def assertGone(self, paste_id, token):
+        with self.assertLogs('website.paste_cache', 'WARNING'):
+            self.assertEqual(self.client.get(f'/{paste_id}/raw/').status_code, 404)
+        self.assertFalse(HistoryEntry.objects.filter(client_token=token).exists())
+
+    def test_delete(self):
+        token = self.cached_paste('abc123')
+        with self.assertLogs('website.paste_cache', 'WARNING'):
+            self.client.post('/admin/website/paste/abc123/delete/', {'post': 'yes'})
+        self.assertGone('abc123', token)
+
+    def test_delete_selected(self):
+        token = self.cached_paste('abc123')
+        with self.assertLogs('website.paste_cache', 'WARNING'):
+            self.client.post('/admin/website/paste/', {
+                'action': 'delete_selected', '_selected_action': ['abc123'], 'post': 'yes',
+            })
+        self.assertGone('abc123', token)
+
+
+class WriteBehindFlushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.lang = Language.objects.create(displayname='Python', alias='python')
+
+    def queued(self, paste_id, content):
+        paste = Paste(id=paste_id, ciphertext=content, lang=self.lang)
+        paste.compute_metadata()
+        return write_behind._load(write_behind._dump(paste))
+
+    def test_redelivered_paste_is_skipped(self):
+        paste = self.queued('abc123', 'mine')
+        write_behind._insert([paste])
+        # Delivered again, e.g. after a crash before the acknowledgement
+        write_behind._insert([write_behind._load(write_behind._dump(paste))])
+        self.assertEqual(Paste.objects.get(id='abc123').ciphertext, 'mine')
+        self.assertEqual(Paste.objects.count(), 1)
+
+    def test_colliding_paste_gets_a_new_id(self):
+        Paste.objects.create(id='abc123', ciphertext='theirs', lang=self.lang)
+        with self.assertLogs('website.write_behind', 'ERROR'):
+            write_behind._insert([self.queued('abc123', 'mine')])
+        self.assertEqual(Paste.objects.get(id='abc123').ciphertext, 'theirs')
+        self.assertTrue(Paste.objects.exclude(id='abc123').filter(ciphertext='mine').exists())
+
+    def test_allocation_skips_queued_ids(self):
+        queued = []
+
+        def pending_ids(paste_ids):
+            # Every ID of the first round is queued
+            paste_ids = set(paste_ids)
+            if not queued:
+                queued.extend(paste_ids)
+                return paste_ids
+            return set()
+
+        with mock.patch.object(write_behind, 'pending_ids', side_effect=pending_ids):
+            ids = Paste.objects.allocate_ids(5)
+        self.assertEqual(len(ids), 5)
+        self.assertFalse(set(ids) & set(queued))
+
+
+class HistoryPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        pastes = [Paste.objects.create(id=f'abc12{i}', ciphertext=f'paste {i}') for i in range(3)]
+        cls.token = history.record_pastes(None, pastes)
+        # Deleted without forget_pastes(), e.g. from the admin
+        Paste.objects.filter(id='abc121').delete()
+
+    def test_deleted_pastes_are_left_out(self):
+        entries, _ = history.history_page(self.token)
+        self.assertEqual([entry.paste_id for entry in entries], ['abc122', 'abc120'])
+
+    def test_queued_pastes_are_kept(self):
+        with mock.patch.object(history, 'pending_ids', return_value={'abc121'}):
+            entries, _ = history.history_page(self.token)
+        self.assertEqual(len(entries), 3)
+
+    def test_cursor_skips_past_left_out_entries(self):
+        entries, cursor = history.history_page(self.token, limit=2)
+        self.assertEqual([entry.paste_id for entry in entries], ['abc122'])
+        entries, cursor = history.history_page(self.token, before=cursor, limit=2)
+        self.assertEqual([entry.paste_id for entry in entries], ['abc120'])
+        self.assertIsNone(cursor)
+
+
+REPLICAS = ['replica_0', 'replica_1']
+
+
+@replica_reads
+def marked_view(request):
+    return HttpResponse()
+
+
+def unmarked_view(request):
+    return HttpResponse()
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS)
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        token = db_router._use_replica.set(True)
+        self.addCleanup(db_router._use_replica.reset, token)
+
+    def test_reads_use_a_replica(self):
+        self.assertIn(self.router.db_for_read(Paste), REPLICAS)
+
+    def test_a_write_switches_the_rest_to_the_primary(self):
+        self.assertEqual(self.router.db_for_write(Paste), PRIMARY)
+        self.assertEqual(self.router.db_for_read(Paste), PRIMARY)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertEqual(self.router.db_for_read(Paste), PRIMARY)
+
+    def test_migrations_only_run_on_the_primary(self):
+        self.assertTrue(self.router.allow_migrate(PRIMARY, 'website'))
+        self.assertFalse(self.router.allow_migrate('replica_0', 'website'))
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS, REPLICA_STICKY_SECONDS=15)
+class ReplicaRoutingMiddlewareTests(SimpleTestCase):
+    def handle(self, request, view, status=200):
+        """Whether the view's reads may use a replica, and the response"""
+        replica = []
+
+        def get_response(request):
+            replica.append(using_replica())
+            return HttpResponse(status=status)
+
+        request._resolved = ResolverMatch(view, (), {})
+        response = ReplicaRoutingMiddleware(get_response)(request)
+        self.assertFalse(using_replica())
+        return replica[0], response
+
+    def test_marked_view(self):
+        replica, response = self.handle(RequestFactory().get('/'), marked_view)
+        self.assertTrue(replica)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_unmarked_view(self):
+        replica, _ = self.handle(RequestFactory().get('/'), unmarked_view)
+        self.assertFalse(replica)
+
+    def test_unsafe_request_sets_the_sticky_cookie(self):
+        replica, response = self.handle(RequestFactory().post('/'), marked_view)
+        self.assertFalse(replica)
+        self.assertEqual(response.cookies[STICKY_COOKIE]['max-age'], 15)
+
+    def test_failed_unsafe_request_sets_no_cookie(self):
+        _, response = self.handle(RequestFactory().post('/'), marked_view, status=400)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_sticky_cookie_keeps_reads_on_the_primary(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[STICKY_COOKIE] = '1'
+        replica, _ = self.handle(request, marked_view)
+        self.assertFalse(replica)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        replica, response = self.handle(RequestFactory().post('/'), marked_view)
+        self.assertFalse(replica)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    async def test_async(self):
+        replica = []
+
+        async def get_response(request):
+            replica.append(using_replica())
+            return HttpResponse()
+
+        await ReplicaRoutingMiddleware(get_response)(RequestFactory().get('/abc123/'))
+        self.assertEqual(replica, [True])
+
+
+# The test database stands in for a replica, the router's choices are recorded
+@override_settings(
+    DATABASE_REPLICAS=[PRIMARY],
+    PASTE_CACHE_INVALIDATION_REDIS_URL=None,
+    STORAGES=STORAGES,
+)
+class ReplicaRoutingRequestTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.lang = Language.objects.create(displayname='Python', alias='python')
+        cls.paste = Paste.objects.create(id='abc123', ciphertext='print(1)', lang=cls.lang)
+
+    def setUp(self):
+        patcher = mock.patch.object(db_router.random, 'choice', wraps=db_router.random.choice)
+        self.replica_reads = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_paste_view_reads_from_a_replica(self):
+        response = self.client.get('/abc123/raw/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.replica_reads.called)
+
+    @override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMIT_REDIS_URL='redis://rate-limit')
+    async def test_middleware_resolves_the_view_once(self):
+        resolver = get_resolver()
+
+        def connect(middleware):
+            middleware.script = mock.AsyncMock(return_value=[1, 0, 0])
+
+        with mock.patch.object(ratelimit.RateLimitMiddleware, '_connect', autospec=True, side_effect=connect), \
+                mock.patch.object(resolver, 'resolve', wraps=resolver.resolve) as resolve:
+            response = await self.async_client.get('/abc123/raw/')
+        self.assertEqual(response.status_code, 200)
+        # Once for the middleware, once more by Django for the view
+        self.assertEqual(resolve.call_count, 2)
+
+    def test_client_reads_its_own_writes(self):
+        response = self.client.post('/create/', {'content': 'hello', 'language': self.lang.id, 'expiration': '1'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        self.assertFalse(self.replica_reads.called)
+        # The test client sends the cookie back
+        self.client.get(response.url)
+        self.assertFalse(self.replica_reads.called)
+
+
+@override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_SLOW_THRESHOLD=0)
+class ProfilingMiddlewareTests(TestCase):
+    def test_query_count_is_not_capped_by_the_log(self):
+        def view(request):
+            for _ in range(5):
+                Language.objects.exists()
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(view)
+        request = RequestFactory().get('/')
+        request.user = mock.Mock(is_staff=False)
+        token = metrics._request_stats.set(metrics.RequestStats())
+        self.addCleanup(metrics._request_stats.reset, token)
+        with mock.patch.object(metrics, 'MAX_LOGGED_QUERIES', 3):
+            middleware(request)
+        profile = RequestProfile.objects.get()
+        self.assertEqual(profile.query_count, 5)
+        self.assertEqual(len(profile.queries), 3)
+
+
+class SelectiveSessionMiddlewareTests(SimpleTestCase):
+    async def test_sessionless_request_takes_no_thread_hop(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        request = RequestFactory().get('/abc123/')
+        with mock.patch.object(sessions, 'sync_to_async') as hop:
+            await sessions.SelectiveSessionMiddleware(get_response)(request)
+        self.assertTrue(request.sessionless)
+        hop.assert_not_called()
@@ -2,13 +2,26 @@ import hashlib
 import random
 import re
 from datetime import timedelta
-from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404
+from django.middleware.csrf import get_token
+from django.shortcuts import render, redirect
 from django.utils import timezone
 from .models import Paste, Language
 from .encryption import encrypt, decrypt
+from .cache_utils import invalidate_paste_cache
+from .compressed_pages import cached_page
+from pastebinir.db_router import replica_reads
+from pastebinir.metrics import LANGUAGE_DETECTION_SECONDS, cache_lookup
+from .languages import get_registry
+from .paste_cache import get_paste, record_view
+from .write_behind import pending_ids, save_paste
+from .history import (
+    finish_response, forget_pastes, get_history_token, history_page, import_legacy_history, record_paste,
+)
 from django.core.cache import cache
 from django.conf import settings
 
+@LANGUAGE_DETECTION_SECONDS.time()
 def detect_language_from_content(content):
     """Detect programming language from content using patterns and keywords"""
     if not content or not content.strip():
@@ -129,19 +142,15 @@ def detect_language_from_content(content):
     return None
 
 def get_cached_languages():
-    """Get languages from cache or database"""
-    languages = cache.get(settings.LANGUAGE_CACHE_KEY)
-    if languages is None:
-        languages = list(Language.objects.all().order_by('displayname'))
-        cache.set(settings.LANGUAGE_CACHE_KEY, languages, settings.LANGUAGE_CACHE_TIMEOUT)
-    return languages
+    """All languages, ordered by display name, from the in-process registry"""
+    return get_registry().languages
 
 def generate_unique_id():
     while True:
         unique_string = f"{timezone.now().timestamp()}{random.randint(0, 999999)}"
         hash_object = hashlib.sha256(unique_string.encode())
         unique_id = hash_object.hexdigest()[:6]
-        if not Paste.objects.filter(id=unique_id).exists():
+        if not Paste.objects.filter(id=unique_id).exists() and not pending_ids([unique_id]):
             return unique_id
 
 def pasteCheck(paste):
@@ -151,20 +160,30 @@ def pasteCheck(paste):
         return False
     return True
 
+def remove_paste(paste):
+    """Delete an expired or used up paste along with its history entries and cached copies"""
+    paste_id = paste.id
+    paste.delete()
+    forget_pastes([paste_id])
+    invalidate_paste_cache([paste_id])
+
+def is_available(paste):
+    # Check cache for 10-minute expiration
+    if paste.expires and (paste.expires - paste.created).total_seconds() <= 601:
+        marker = cache.get(f'paste_{paste.id}')
+        cache_lookup('paste_marker', marker is not None)
+        if not marker:
+            return False
+    return pasteCheck(paste)
+
+@replica_reads
 def home(request):
     """Home page showing recent pastes and create paste form"""
-    # Get recent pastes from cookie history
-    pastes = []
-    pastes_cookie = request.COOKIES.get('pasteHistory', '')
-    if pastes_cookie:
-        paste_ids = pastes_cookie.split(',')
-        # Get the most recent 10 pastes with select_related for better performance
-        recent_pastes = Paste.objects.select_related('lang').filter(
-            id__in=paste_ids
-        ).order_by('-created')[:10]
-        pastes = recent_pastes
-    
-    return render(request, 'home.html', {'pastes': pastes})
+    # Get the most recent 10 pastes from the server-side history
+    token = import_legacy_history(request) or get_history_token(request)
+    pastes, _ = history_page(token, limit=10)
+    response = render(request, 'home.html', {'pastes': pastes})
+    return finish_response(request, response, token)
 
 def create_paste(request):
     if request.method == 'POST':
@@ -178,15 +197,9 @@ def create_paste(request):
         if language_id == 'auto':
             # Simple language detection based on content
             detected_lang = detect_language_from_content(content)
-            if detected_lang:
-                try:
-                    lang = Language.objects.get(alias__iexact=detected_lang)
-                except Language.DoesNotExist:
-                    # Fallback to first available language if detected language not found
-                    lang = Language.objects.first()
-            else:
-                # Default to first available language if no language detected
-                lang = Language.objects.first()
+            registry = get_registry()
+            # Fallback to first available language if none detected or not found
+            lang = (detected_lang and registry.get_by_alias(detected_lang)) or registry.first()
             
             # Safety check - if no languages exist, create a default one
             if not lang:
@@ -196,7 +209,9 @@ def create_paste(request):
                     defaults={'displayname': 'Plain Text', 'alias': 'plaintext'}
                 )
         else:
-            lang = get_object_or_404(Language, id=language_id)
+            lang = get_registry().get(language_id)
+            if lang is None:
+                raise Http404("No Language matches the given query.")
 
         if content:
             id = generate_unique_id()
@@ -213,46 +228,38 @@ def create_paste(request):
                     expires = timezone.now() + timedelta(days=float(expiration_days))
             if password:
                 salt, iv, ciphertext = encrypt(content, password)
-                Paste.objects.create(id=id, salt=salt, iv=iv, ciphertext=ciphertext, lang=lang, expires=expires,
-                                     one_time=one_time)
+                paste = Paste(id=id, salt=salt, iv=iv, ciphertext=ciphertext, lang=lang, expires=expires,
+                              one_time=one_time)
             else:
-                Paste.objects.create(id=id, salt=None, iv=None, ciphertext=content, lang=lang, expires=expires,
-                                     one_time=one_time)
+                paste = Paste(id=id, salt=None, iv=None, ciphertext=content, lang=lang, expires=expires,
+                              one_time=one_time)
+            # Queued for a later bulk insert when write-behind is enabled
+            paste = save_paste(paste)
+            id = paste.id
             if use_cache:
                 cache.set(f'paste_{id}', True, timeout=600)  # 10 minutes
-            pastes_cookie = request.COOKIES.get('pasteHistory', '')
-            if pastes_cookie:
-                pastes_list = pastes_cookie.split(',')
-                if id not in pastes_list:
-                    pastes_list.append(id)
-            else:
-                pastes_list = [id]
+            token = record_paste(get_history_token(request), paste)
 
             response = redirect('view_encrypted_paste', paste_id=id)
-            response.set_cookie('pasteHistory', ','.join(pastes_list), max_age=31536000)
-            return response
+            return finish_response(request, response, token)
 
     # Use cached languages for better performance
     languages = get_cached_languages()
     return render(request, 'create.html', {'languages': languages})
 
+@replica_reads
 def about(request):
     return render(request,'about.html')
 
+@replica_reads
 def view_raw_paste(request, paste_id):
     try:
-        paste = Paste.objects.get(id=paste_id)
+        paste = get_paste(paste_id)
     except Paste.DoesNotExist:
         return render(request, '404.html', status=404)
 
-    # Check cache for 10-minute expiration
-    if paste.expires and (paste.expires - paste.created).total_seconds() <= 601:
-        if not cache.get(f'paste_{paste_id}'):
-            paste.delete()
-            return render(request, 'raw_clean.html', {'error': 'This paste is no longer available.'})
-
-    if not pasteCheck(paste):
-        paste.delete()
+    if not is_available(paste):
+        remove_paste(paste)
         return render(request, 'raw_clean.html', {'error': 'This paste is no longer available.'})
 
     if paste.salt:
@@ -261,36 +268,30 @@ def view_raw_paste(request, paste_id):
             if password:
                 try:
                     decrypted_content = decrypt(paste.salt, paste.iv, paste.ciphertext, password)
-                    paste.view_count += 1
-                    paste.save()
+                    record_view(paste)
                     return render(request, 'raw_clean.html', {'content': decrypted_content, 'lang': paste.lang})
                 except Exception as e:
                     print(f"Decryption error: {e}")
                     return render(request, 'raw_clean.html', {'error': 'Incorrect password. Please try again.', 'lang': paste.lang})
-        paste.view_count += 1
-        paste.save()
+        record_view(paste)
         return render(request, 'raw_clean.html', {'lang': paste.lang, 'has_password': True})
 
     else:
         decrypted_content = paste.ciphertext
-        paste.view_count += 1
-        paste.save()
-        return render(request, 'raw_clean.html', {'content': decrypted_content, 'lang': paste.lang})
+        record_view(paste)
+        return cached_page(request, paste, 'raw', lambda: render(
+            request, 'raw_clean.html', {'content': decrypted_content, 'lang': paste.lang},
+        ))
 
+@replica_reads
 def view_encrypted_paste(request, paste_id):
     try:
-        paste = Paste.objects.get(id=paste_id)
+        paste = get_paste(paste_id)
     except Paste.DoesNotExist:
         return render(request, '404.html', status=404)
 
-    # Check cache for 10-minute expiration
-    if paste.expires and (paste.expires - paste.created).total_seconds() <= 601:
-        if not cache.get(f'paste_{paste_id}'):
-            paste.delete()
-            return render(request, 'view.html', {'error': 'This paste is no longer available.'})
-
-    if not pasteCheck(paste):
-        paste.delete()
+    if not is_available(paste):
+        remove_paste(paste)
         return render(request, 'view.html', {'error': 'This paste is no longer available.'})
 
     if paste.salt:
@@ -299,32 +300,30 @@ def view_encrypted_paste(request, paste_id):
             if password:
                 try:
                     decrypted_content = decrypt(paste.salt, paste.iv, paste.ciphertext, password)
-                    paste.view_count += 1
-                    paste.save()
+                    record_view(paste)
                     return render(request, 'view.html', {'content': decrypted_content, 'lang': paste.lang, 'paste': paste})
                 except Exception as e:
                     print(f"Decryption error: {e}")
                     return render(request, 'view.html', {'error': 'Incorrect password. Please try again.', 'lang': paste.lang, 'paste': paste})
-        paste.view_count += 1
-        paste.save()
+        record_view(paste)
 
         return render(request, 'view.html', {'lang': paste.lang, 'has_password': True, 'paste': paste})
 
     else:
         decrypted_content = paste.ciphertext
-        paste.view_count += 1
-        paste.save()
-
-        return render(request, 'view.html', {'content': decrypted_content, 'lang': paste.lang, 'paste': paste})
+        record_view(paste)
+        # The page itself holds no token, the chat script reads it from the cookie
+        get_token(request)
+        return cached_page(request, paste, 'view', lambda: render(
+            request, 'view.html', {'content': decrypted_content, 'lang': paste.lang, 'paste': paste},
+        ))
 
+@replica_reads
 def history(request):
-    pastes = []
-    pastes_cookie = request.COOKIES.get('pasteHistory', '')
-    if pastes_cookie:
-        paste_ids = pastes_cookie.split(',')
-        # Use select_related to avoid N+1 queries
-        pastes = Paste.objects.select_related('lang').filter(id__in=paste_ids).order_by('-created')
-    return render(request, 'history.html', {'pastes': pastes})
+    token = import_legacy_history(request) or get_history_token(request)
+    pastes, next_cursor = history_page(token, before=request.GET.get('before'))
+    response = render(request, 'history.html', {'pastes': pastes, 'next_cursor': next_cursor})
+    return finish_response(request, response, token)
 def err404(request, exception):
     return render(request,'404.html',status=404)
 
@@ -0,0 +1,301 @@
+"""
+Write-behind paste creation.
+
+With PASTE_WRITE_BEHIND enabled, new pastes are not inserted by the request
+that creates them. The row is stored in a Redis hash (readable at once through
+pending_paste()) and its ID appended to a Redis stream; the flush_pending_pastes
+scheduler job reads the stream through a consumer group and bulk inserts the
+rows. Entries are acknowledged only after the insert commits, and entries left
+unacknowledged by a crashed flusher are claimed again, so delivery is
+at-least-once; inserts ignore IDs that already exist, which makes redelivery
+harmless. Redis must persist to disk (appendonly) for the queue to be durable.
+
+ID allocation checks the queue as well as the table (pending_ids()), so a
+paste inserted directly cannot take the ID of a queued one. Should it happen
+anyway, the flush stores the queued paste under a new ID and logs both.
+
+A pending paste that gets viewed is written by the view itself when it saves
+the view count; the flush then skips it.
+"""
+import json
+import logging
+import os
+import socket
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+
+from .languages import get_registry
+from .models import Paste
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'pastes:pending'
+STREAM_KEY = 'pastes:pending:stream'
+GROUP = 'flushers'
+
+# KEYS: pending rows, stream; ARGV: paste id, row
+_ENQUEUE = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('XADD', KEYS[2], '*', 'id', ARGV[1])
+return 1
+"""
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.PASTE_WRITE_BEHIND_REDIS_URL)
+    return _client
+
+
+def enabled():
+    return settings.PASTE_WRITE_BEHIND and bool(settings.PASTE_WRITE_BEHIND_REDIS_URL)
+
+
+def _dump(paste):
+    row = {field.attname: field.value_from_object(paste) for field in Paste._meta.concrete_fields}
+    # isoformat() directly, DjangoJSONEncoder would cut datetimes to milliseconds
+    return json.dumps({name: value.isoformat() if isinstance(value, datetime) else value for name, value in row.items()})
+
+
+def _load(data):
+    row = json.loads(data)
+    paste = Paste(**{
+        field.attname: field.to_python(row[field.attname])
+        for field in Paste._meta.concrete_fields if field.attname in row
+    })
+    # Saving it must still insert the row, but not recompute the metadata
+    paste._state.adding = False
+    return paste
+
+
+def save_paste(paste):
+    """
+    Persist a new paste: queued when write-behind is enabled, inserted right
+    away otherwise or when Redis cannot be reached. paste.id may be changed
+    to avoid a collision with another pending paste.
+    """
+    if not enabled():
+        paste.save()
+        return paste
+    paste.compute_metadata()
+    try:
+        enqueue = get_redis().register_script(_ENQUEUE)
+        while not enqueue(keys=[PENDING_KEY, STREAM_KEY], args=[paste.id, _dump(paste)]):
+            paste.id = Paste.objects.allocate_ids(1)[0]
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Write-behind queue unavailable, inserting paste directly: {e}")
+        paste.save()
+        return paste
+    # Reads treat it like a stored row from now on
+    paste._state.adding = False
+    return paste
+
+
+def save_pastes(pastes):
+    """
+    save_paste() for several new pastes, which are given their IDs here:
+    queued in one round trip when write-behind is enabled, bulk inserted
+    otherwise or when Redis cannot be reached.
+    """
+    pastes = list(pastes)
+    for paste in pastes:
+        # bulk_create() does not call save()
+        paste.compute_metadata()
+    remaining = pastes
+    if enabled():
+        try:
+            client = get_redis()
+            enqueue = client.register_script(_ENQUEUE)
+            while remaining:
+                for paste, paste_id in zip(remaining, Paste.objects.allocate_ids(len(remaining))):
+                    paste.id = paste_id
+                with client.pipeline(transaction=False) as pipe:
+                    for paste in remaining:
+                        enqueue(keys=[PENDING_KEY, STREAM_KEY], args=[paste.id, _dump(paste)], client=pipe)
+                    queued = pipe.execute()
+                for paste, ok in zip(remaining, queued):
+                    if ok:
+                        paste._state.adding = False
+                # Another request queued the same ID meanwhile
+                remaining = [paste for paste, ok in zip(remaining, queued) if not ok]
+            return pastes
+        except (redis.RedisError, OSError) as e:
+            logger.warning(f"Write-behind queue unavailable, inserting {len(remaining)} pastes directly: {e}")
+    _bulk_insert(remaining)
+    return pastes
+
+
+def _bulk_insert(pastes, attempts=3):
+    for attempt in range(attempts):
+        for paste, paste_id in zip(pastes, Paste.objects.allocate_ids(len(pastes))):
+            paste.id = paste_id
+        try:
+            # A concurrent request may have taken one of the probed IDs
+            with transaction.atomic():
+                Paste.objects.bulk_create(pastes)
+            return
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+def pending_paste(paste_id):
+    """
+    The queued paste with that ID, or None. Its language is attached from
+    the registry, so reading paste.lang runs no query.
+    """
+    if not enabled():
+        return None
+    try:
+        data = get_redis().hget(PENDING_KEY, paste_id)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not read pending paste {paste_id}: {e}")
+        return None
+    if data is None:
+        return None
+    paste = _load(data)
+    # Views save it at once instead of buffering their count, see paste_cache.record_view()
+    paste.pending = True
+    if paste.lang_id is not None:
+        # None when the language was deleted since; the flush drops such pastes
+        paste.lang = get_registry().get(paste.lang_id)
+    return paste
+
+
+def pending_ids(paste_ids):
+    """Those of paste_ids that are queued; empty when Redis cannot be reached"""
+    paste_ids = list(paste_ids)
+    if not enabled() or not paste_ids:
+        return set()
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for paste_id in paste_ids:
+                pipe.hexists(PENDING_KEY, paste_id)
+            queued = pipe.execute()
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not check pending paste IDs: {e}")
+        return set()
+    return {paste_id for paste_id, exists in zip(paste_ids, queued) if exists}
+
+
+def get_paste(paste_id):
+    """Paste.objects.get() that also finds pastes still waiting to be flushed"""
+    try:
+        return Paste.objects.get(id=paste_id)
+    except Paste.DoesNotExist:
+        paste = pending_paste(paste_id)
+        if paste is None:
+            raise
+        return paste
+
+
+def discard(paste_ids):
+    """Drop queued pastes so a later flush does not insert them"""
+    paste_ids = list(paste_ids)
+    if not enabled() or not paste_ids:
+        return
+    try:
+        get_redis().hdel(PENDING_KEY, *paste_ids)
+    except (redis.RedisError, OSError) as e:
+        logger.warning(f"Could not discard pending pastes: {e}")
+
+
+def _insert(pastes):
+    pastes = _resolve_conflicts(pastes)
+    try:
+        with transaction.atomic():
+            Paste.objects.bulk_create(pastes, ignore_conflicts=True)
+    except DatabaseError:
+        # One bad row must not hold back the rest; insert them one by one and
+        # drop those that fail (e.g. their language was deleted meanwhile)
+        for paste in pastes:
+            try:
+                with transaction.atomic():
+                    Paste.objects.bulk_create([paste], ignore_conflicts=True)
+            except DatabaseError as e:
+                logger.error(f"Dropping pending paste {paste.id}: {e}")
+
+
+def _resolve_conflicts(pastes):
+    """
+    The pastes still to insert. Rows already stored are either this paste
+    (a redelivery, or a view saved it) and skipped, or another paste that took
+    the ID; the queued one then gets a new ID rather than being lost.
+    """
+    stored = {
+        paste_id: (created, ciphertext)
+        for paste_id, created, ciphertext in
+        Paste.objects.filter(id__in=[paste.id for paste in pastes]).values_list('id', 'created', 'ciphertext')
+    }
+    if not stored:
+        return pastes
+    remaining = []
+    for paste in pastes:
+        if paste.id not in stored:
+            remaining.append(paste)
+        elif stored[paste.id] != (paste.created, paste.ciphertext):
+            old_id = paste.id
+            paste.id = Paste.objects.allocate_ids(1)[0]
+            logger.error(f"Pending paste {old_id} collided with a stored paste, inserting it as {paste.id}")
+            remaining.append(paste)
+    return remaining
+
+
+def flush(batch_size=None):
+    """Insert every queued paste. Returns the number of stream entries handled."""
+    if not enabled():
+        return 0
+    batch_size = batch_size or settings.PASTE_WRITE_BEHIND_BATCH_SIZE
+    client = get_redis()
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    try:
+        client.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    handled = 0
+    # Entries a crashed flusher read but never acknowledged come first
+    start = '0-0'
+    while True:
+        start, entries, *_ = client.xautoclaim(
+            STREAM_KEY, GROUP, consumer, min_idle_time=settings.PASTE_WRITE_BEHIND_CLAIM_IDLE * 1000,
+            start_id=start, count=batch_size,
+        )
+        handled += _flush_entries(client, entries)
+        if start in (b'0-0', '0-0'):
+            break
+    while True:
+        response = client.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=batch_size)
+        entries = response[0][1] if response else []
+        if not entries:
+            break
+        handled += _flush_entries(client, entries)
+    return handled
+
+
+def _flush_entries(client, entries):
+    if not entries:
+        return 0
+    entry_ids = [entry_id for entry_id, _ in entries]
+    # Entries trimmed from the stream come back without fields
+    paste_ids = [fields[b'id'].decode() for _, fields in entries if fields]
+    if paste_ids:
+        rows = client.hmget(PENDING_KEY, paste_ids)
+        # Missing rows were discarded or already flushed by an earlier delivery
+        _insert([_load(row) for row in rows if row is not None])
+    with client.pipeline() as pipe:
+        pipe.xack(STREAM_KEY, GROUP, *entry_ids)
+        pipe.xdel(STREAM_KEY, *entry_ids)
+        if paste_ids:
+            pipe.hdel(PENDING_KEY, *paste_ids)
+        pipe.execute()
+    return len(entries)